@@ -1,3 +1,6 @@
+import importlib
+from typing import TYPE_CHECKING
+
 __author__ = "AICS"
 
 # Do not edit this string manually, always use bumpversion
@@ -9,29 +12,124 @@ def get_module_version():
     return __version__
 
 
-from .celigo_orchestration import (
-    job_complete_check,
-    job_in_queue_check,
-    run_all,
-    run_all_dir,
-)
-from .celigo_single_image.celigo_image import (
-    CeligoImage,
-)
-from .celigo_single_image.celigo_single_image_core import (
-    CeligoSingleImageCore,
-)
-from .celigo_single_image.celigo_six_well_core import (
-    CeligoSixWellCore,
-)
-from .notifcations import (
-    get_channel_emails,
-    send_slack_notification_on_failure,
-    slack_day_report,
-)
-from .postgres_db_functions import (
-    add_FMS_IDs_to_SQL_table,
-    add_to_table,
-)
+# Public names and the module defining them. Modules are imported on first access
+# (PEP 562), so importing the package or a CLI does not load pandas, the database driver
+# or the Slack, LabKey and FMS clients until they are used. The modules import those
+# clients inside the functions that use them for the same reason
+_EXPORTS = {
+    "AsyncSlurmJobWatcher": ".celigo_async_orchestration",
+    "run_all_dir_async": ".celigo_async_orchestration",
+    "CeligoBatch": ".celigo_batch",
+    "archive_metrics": ".celigo_metrics_archive",
+    "read_metrics_archive": ".celigo_metrics_archive",
+    "merge_image_data": ".celigo_metrics_io",
+    "read_metrics_csv": ".celigo_metrics_io",
+    "MetricsSink": ".celigo_metrics_sink",
+    "clear_metadata_cache": ".celigo_metadata",
+    "get_metadata": ".celigo_metadata",
+    "get_metadata_batch": ".celigo_metadata",
+    "SlurmJobWatcher": ".celigo_orchestration",
+    "job_complete_check": ".celigo_orchestration",
+    "job_in_queue_check": ".celigo_orchestration",
+    "resume": ".celigo_orchestration",
+    "run_all": ".celigo_orchestration",
+    "run_all_dir": ".celigo_orchestration",
+    "upload_batch": ".celigo_orchestration",
+    "RunStateStore": ".celigo_run_state",
+    "CeligoImage": ".celigo_single_image.celigo_image",
+    "CeligoSingleImageCore": ".celigo_single_image.celigo_single_image_core",
+    "CeligoSixWellCore": ".celigo_single_image.celigo_six_well_core",
+    "StageCache": ".celigo_stage_cache",
+    "get_channel_emails": ".notifcations",
+    "send_slack_notification_on_failure": ".notifcations",
+    "slack_day_report": ".notifcations",
+    "ConnectionPool": ".postgres_db_functions",
+    "add_FMS_IDs_batch_to_SQL_table": ".postgres_db_functions",
+    "add_FMS_IDs_to_SQL_table": ".postgres_db_functions",
+    "add_to_table": ".postgres_db_functions",
+    "close_connection_pool": ".postgres_db_functions",
+    "get_connection_pool": ".postgres_db_functions",
+    "get_table_columns": ".postgres_db_functions",
+    "write_rows": ".postgres_db_functions",
+    "create_date_partitions": ".postgres_schema",
+    "create_schema": ".postgres_schema",
+    "create_unique_key": ".postgres_schema",
+    "verify_schema": ".postgres_schema",
+}
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted([*globals(), *_EXPORTS])
+
+
+if TYPE_CHECKING:
+    from .celigo_async_orchestration import (
+        AsyncSlurmJobWatcher,
+        run_all_dir_async,
+    )
+    from .celigo_batch import CeligoBatch
+    from .celigo_metadata import (
+        clear_metadata_cache,
+        get_metadata,
+        get_metadata_batch,
+    )
+    from .celigo_metrics_archive import (
+        archive_metrics,
+        read_metrics_archive,
+    )
+    from .celigo_metrics_io import (
+        merge_image_data,
+        read_metrics_csv,
+    )
+    from .celigo_metrics_sink import MetricsSink
+    from .celigo_orchestration import (
+        SlurmJobWatcher,
+        job_complete_check,
+        job_in_queue_check,
+        resume,
+        run_all,
+        run_all_dir,
+        upload_batch,
+    )
+    from .celigo_run_state import RunStateStore
+    from .celigo_single_image.celigo_image import (
+        CeligoImage,
+    )
+    from .celigo_single_image.celigo_single_image_core import (
+        CeligoSingleImageCore,
+    )
+    from .celigo_single_image.celigo_six_well_core import (
+        CeligoSixWellCore,
+    )
+    from .celigo_stage_cache import StageCache
+    from .notifcations import (
+        get_channel_emails,
+        send_slack_notification_on_failure,
+        slack_day_report,
+    )
+    from .postgres_db_functions import (
+        ConnectionPool,
+        add_FMS_IDs_batch_to_SQL_table,
+        add_FMS_IDs_to_SQL_table,
+        add_to_table,
+        close_connection_pool,
+        get_connection_pool,
+        get_table_columns,
+        write_rows,
+    )
+    from .postgres_schema import (
+        create_date_partitions,
+        create_schema,
+        create_unique_key,
+        verify_schema,
+    )
 
 __all__ = "CeligoSingleImageCore"
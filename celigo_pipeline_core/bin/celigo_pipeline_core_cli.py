@@ -3,10 +3,6 @@ import logging
 import sys
 import traceback
 
-from celigo_pipeline_core.celigo_orchestration import (
-    run_all,
-)
-
 log = logging.getLogger()
 
 
@@ -15,6 +11,7 @@ class Args(argparse.Namespace):
         super().__init__()
         self.debug = False
         self.image_path = str()
+        self.replace_metrics = False
         self.postgres_password = str()
         self.__parse()
 
@@ -40,6 +37,14 @@ class Args(argparse.Namespace):
             action="store_true",
         )
 
+        p.add_argument(
+            "--replace_metrics",
+            help="Replace the metrics of the image if it was processed before instead of appending them",
+            default=False,
+            required=False,
+            action="store_true",
+        )
+
         # make array with options
         p.add_argument(
             "--env",
@@ -59,8 +64,14 @@ def main():
     debug = args.debug
 
     try:
+        # Imported after parsing, so --help and argument errors return right away
+        from celigo_pipeline_core.celigo_orchestration import (
+            run_all,
+        )
+
         run_all(
             raw_image_path=args.image_path,
+            replace_metrics=args.replace_metrics,
         )
 
     except Exception as e:
@@ -0,0 +1,69 @@
+import argparse
+import logging
+import sys
+import traceback
+
+log = logging.getLogger()
+
+
+class Args(argparse.Namespace):
+    def __init__(self):
+        super().__init__()
+        self.debug = False
+        self.state_path = str()
+        self.__parse()
+
+    def __parse(self):
+        p = argparse.ArgumentParser(
+            prog="CeligoPipeline",
+            description="continues every image of a previous run that has not completed",
+        )
+
+        p.add_argument(
+            "--state_path",
+            dest="state_path",
+            type=str,
+            help="SQLite file the previous run was started with (--state_path of celigo_pipeline_directory)",
+            required=True,
+        )
+
+        p.add_argument(
+            "--debug",
+            help="Enable debug mode",
+            default=False,
+            required=False,
+            action="store_true",
+        )
+
+        p.parse_args(namespace=self)
+
+    ###############################################################################
+
+
+def main():
+    args = Args()
+    debug = args.debug
+
+    try:
+        # Imported after parsing, so --help and argument errors return right away
+        from celigo_pipeline_core.celigo_orchestration import (
+            resume,
+        )
+
+        resume(state_path=args.state_path)
+
+    except Exception as e:
+        log.error("=============================================")
+        if debug:
+            log.error("\n\n" + traceback.format_exc())
+            log.error("=============================================")
+        log.error("\n\n" + str(e) + "\n")
+        log.error("=============================================")
+        sys.exit(1)
+
+
+###############################################################################
+# Allow caller to directly run this module (usually in development scenarios)
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,6 @@ import logging
 import sys
 import traceback
 
-from celigo_pipeline_core.celigo_orchestration import (
-    run_all_dir,
-)
-
 log = logging.getLogger()
 
 
@@ -15,6 +11,15 @@ class Args(argparse.Namespace):
         super().__init__()
         self.debug = False
         self.image_path = str()
+        self.use_job_arrays = False
+        self.batch_ilastik = False
+        self.batch_cellprofiler = False
+        self.use_asyncio = False
+        self.state_path = None
+        self.cache_dir = None
+        self.scratch = False
+        self.batch_metrics = False
+        self.replace_metrics = False
         self.postgres_password = str()
         self.__parse()
 
@@ -40,6 +45,78 @@ class Args(argparse.Namespace):
             action="store_true",
         )
 
+        p.add_argument(
+            "--use_job_arrays",
+            help="Submit each stage once for the whole directory as a SLURM job array",
+            default=False,
+            required=False,
+            action="store_true",
+        )
+
+        p.add_argument(
+            "--batch_ilastik",
+            help="Run Ilastik once for the whole directory instead of once per image",
+            default=False,
+            required=False,
+            action="store_true",
+        )
+
+        p.add_argument(
+            "--batch_cellprofiler",
+            help="Run Cell Profiler once for the whole directory instead of once per image",
+            default=False,
+            required=False,
+            action="store_true",
+        )
+
+        p.add_argument(
+            "--use_asyncio",
+            help="Drive every image from one event loop instead of one thread per image",
+            default=False,
+            required=False,
+            action="store_true",
+        )
+
+        p.add_argument(
+            "--state_path",
+            type=str,
+            help="SQLite file to checkpoint every image in, a failed run can be continued with celigo_pipeline_resume",
+            default=None,
+            required=False,
+        )
+
+        p.add_argument(
+            "--cache_dir",
+            type=str,
+            help="Directory caching stage outputs between runs, cached images are not processed again",
+            default=None,
+            required=False,
+        )
+
+        p.add_argument(
+            "--scratch",
+            help="Run the SLURM stages on node local scratch ($TMPDIR) and copy only their outputs back",
+            default=False,
+            required=False,
+            action="store_true",
+        )
+
+        p.add_argument(
+            "--batch_metrics",
+            help="Insert the metrics of many images in one transaction instead of one per image",
+            default=False,
+            required=False,
+            action="store_true",
+        )
+
+        p.add_argument(
+            "--replace_metrics",
+            help="Replace the metrics of images that were processed before instead of appending them",
+            default=False,
+            required=False,
+            action="store_true",
+        )
+
         # make array with options
         p.add_argument(
             "--env",
@@ -51,6 +128,21 @@ class Args(argparse.Namespace):
 
         p.parse_args(namespace=self)
 
+        # The event loop engine runs every image separately and does not checkpoint
+        if self.use_asyncio:
+            unsupported = [
+                option
+                for option, value in [
+                    ("--use_job_arrays", self.use_job_arrays),
+                    ("--batch_ilastik", self.batch_ilastik),
+                    ("--batch_cellprofiler", self.batch_cellprofiler),
+                    ("--state_path", self.state_path is not None),
+                ]
+                if value
+            ]
+            if unsupported:
+                p.error(f"--use_asyncio does not support {', '.join(unsupported)}")
+
     ###############################################################################
 
 
@@ -59,7 +151,35 @@ def main():
     debug = args.debug
 
     try:
-        run_all_dir(dir_path=args.dir_path)
+        # Imported after parsing, so --help and argument errors return right away
+        if args.use_asyncio:
+            from celigo_pipeline_core.celigo_async_orchestration import (
+                run_all_dir_async,
+            )
+
+            run_all_dir_async(
+                dir_path=args.dir_path,
+                cache_dir=args.cache_dir,
+                scratch=args.scratch,
+                batch_metrics=args.batch_metrics,
+                replace_metrics=args.replace_metrics,
+            )
+        else:
+            from celigo_pipeline_core.celigo_orchestration import (
+                run_all_dir,
+            )
+
+            run_all_dir(
+                dir_path=args.dir_path,
+                use_job_arrays=args.use_job_arrays,
+                batch_ilastik=args.batch_ilastik,
+                batch_cellprofiler=args.batch_cellprofiler,
+                state_path=args.state_path,
+                cache_dir=args.cache_dir,
+                scratch=args.scratch,
+                batch_metrics=args.batch_metrics,
+                replace_metrics=args.replace_metrics,
+            )
 
     except Exception as e:
         log.error("=============================================")
@@ -0,0 +1,429 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
+import pathlib
+from pathlib import Path
+import pwd
+import subprocess
+import time
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    cast,
+)
+
+from .celigo_metrics_sink import MetricsSink
+from .celigo_orchestration import (
+    _accounting_states,
+    _apply_metrics_failures,
+    _create_image,
+    _fail_missing_jobs,
+    _finish_image,
+    _load_environment,
+    _queue_states,
+    _record_flushed_status,
+    _record_status,
+    _sacct_command,
+    _squeue_command,
+    _update_jobs,
+)
+from .celigo_single_image.celigo_image import (
+    CeligoImage,
+    first_missing_stage,
+    parse_job_ID,
+    sbatch_command,
+)
+from .celigo_stage_cache import StageCache
+from .notifcations import (
+    send_slack_notification_on_failure,
+)
+from .postgres_db_functions import (
+    get_connection_pool,
+)
+
+
+def run_all_dir_async(
+    dir_path: str,
+    max_in_flight: int = 500,
+    env: str = "stg",
+    env_vars: str = f"/home/{pwd.getpwuid(os.getuid())[0]}/.env",
+    export_location_path: str = "/allen/aics/microscopy/brian_whitney/temp_output",
+    max_workers: int = 8,
+    max_connections: int = 8,
+    cache_dir: Optional[str] = None,
+    scratch: bool = False,
+    batch_metrics: bool = False,
+    replace_metrics: bool = False,
+) -> Dict[str, str]:
+    """Process Celigo Images from a directory (`dir_path`) and all sub directories from a
+    single event loop. Every image is a coroutine that submits its three SLURM jobs as a
+    dependency chain and then waits on one shared `AsyncSlurmJobWatcher`, so waiting images
+    cost no thread or process of their own. Blocking work (image setup, metric and FMS
+    uploads) runs on a shared thread pool with connections from the shared `ConnectionPool`.
+
+    Parameters
+    ----------
+    dir_path : str
+        Path must point to a Directory. Path must be accessable
+        from SLURM (ISILON[OK])
+    max_in_flight: int
+        Maximum number of images processed simultaniously, the next image starts as soon as any
+        image finishes. Default is set to 500.
+    env: str
+        The Allen institute environment you wish to submit your uploads to. Default is set to `stg` (Staging).
+    env_vars: str
+        Path to a .env file containing database credentials. Default is set to users home directory.
+    export_location_path: str
+        If the user wants to export the output files of the pipeline they can specify a output directory here.
+    max_workers: int
+        Number of threads running the blocking setup and upload work. Default is set to 8.
+    max_connections: int
+        Maximum number of open database connections. Default is set to 8.
+    cache_dir: Optional[str]
+        Directory of a `StageCache` shared between runs, images whose outputs are cached are not
+        processed again.
+    scratch: bool
+        If True the SLURM stages stage their inputs on node local scratch ($TMPDIR), run there and
+        copy only their outputs back, verified by checksum.
+    batch_metrics: bool
+        If True the metrics of many images are inserted in one transaction by a `MetricsSink`
+        instead of one transaction per image.
+    replace_metrics: bool
+        If True the metrics of every image replace those of a previous run instead of being
+        appended, e.g. when a directory is reprocessed.
+
+    Returns
+    -------
+    Dict[str, str]
+        The final status of every processed image, keyed by image path.
+    """
+    start = time.perf_counter()
+
+    # Check if export path exists
+    if not os.path.exists(export_location_path):
+        raise FileNotFoundError(f"{export_location_path} does not exist!")
+
+    # loop through all files
+    paths = [
+        f"{subdir}/{file}"
+        for subdir, _, files in os.walk(dir_path)
+        for file in files
+        if "350000" in file and "escale" not in file
+    ]
+
+    _load_environment(env_vars)
+    get_connection_pool(max_connections)
+    metrics_sink = MetricsSink() if batch_metrics else None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = asyncio.run(
+            _run_images(
+                paths,
+                max_in_flight,
+                env,
+                env_vars,
+                Path(export_location_path),
+                executor,
+                StageCache(cache_dir) if cache_dir is not None else None,
+                scratch,
+                metrics_sink,
+                replace_metrics,
+            )
+        )
+    if metrics_sink is not None:
+        _apply_metrics_failures(results, metrics_sink.close())
+
+    finish = time.perf_counter()
+
+    print(f"Finished in {round(finish - start, 2)} second(s)")
+    return results
+
+
+async def _run_images(
+    paths: List[str],
+    max_in_flight: int,
+    env: str,
+    env_vars: str,
+    export_location: Path,
+    executor: ThreadPoolExecutor,
+    cache: Optional[StageCache] = None,
+    scratch: bool = False,
+    metrics_sink: Optional[MetricsSink] = None,
+    replace_metrics: bool = False,
+) -> Dict[str, str]:
+    watcher = AsyncSlurmJobWatcher()
+    in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def run(path: str) -> str:
+        async with in_flight:
+            return await run_image_async(
+                path,
+                env,
+                env_vars,
+                export_location,
+                watcher,
+                executor,
+                cache,
+                scratch,
+                metrics_sink,
+                replace_metrics,
+            )
+
+    statuses = await asyncio.gather(
+        *(run(path) for path in paths), return_exceptions=True
+    )
+
+    results = {}
+    for path, status in zip(paths, statuses):
+        if isinstance(status, BaseException):
+            results[path] = "Failed"
+            print(f"Error: {path} {status}")
+        else:
+            results[path] = status
+    return results
+
+
+async def run_image_async(
+    raw_image_path: str,
+    env: str,
+    env_vars: str,
+    export_location: Path,
+    watcher: "AsyncSlurmJobWatcher",
+    executor: ThreadPoolExecutor,
+    cache: Optional[StageCache] = None,
+    scratch: bool = False,
+    metrics_sink: Optional[MetricsSink] = None,
+    replace_metrics: bool = False,
+) -> str:
+    """Coroutine equivalent of `run_all` for a single image. Returns the final status of
+    the image, "Complete" or "Failed".
+    """
+    loop = asyncio.get_running_loop()
+
+    # Check if image path exists
+    if not os.path.exists(raw_image_path):
+        raise FileNotFoundError(f"{raw_image_path} does not exist!")
+
+    image, table = await loop.run_in_executor(
+        executor, _create_image, raw_image_path, env, scratch
+    )
+
+    # Starting process
+    status = "Running"
+    fms_IDs, error = None, None
+
+    try:
+        (
+            job_IDs,
+            ilastik_output_file_path,
+            cellprofiler_output_file_paths,
+        ) = await submit_chain_async(image, loop, executor, cache)
+        if job_IDs:
+            await wait_for_job_async(
+                watcher,
+                job_IDs[-1],
+                [ilastik_output_file_path, *cellprofiler_output_file_paths],
+                "cell profiler",
+            )
+        if cache is not None:
+            await loop.run_in_executor(executor, cache.store_chain, image)
+        fms_IDs = await loop.run_in_executor(
+            executor,
+            partial(
+                _finish_image,
+                image,
+                table,
+                ilastik_output_file_path,
+                cellprofiler_output_file_paths,
+                conn=None,
+                env=env,
+                export_location=export_location,
+                metrics_sink=metrics_sink,
+                replace_metrics=replace_metrics,
+                on_flush=partial(
+                    _record_flushed_status, image.raw_image_path, env_vars
+                ),
+            ),
+        )
+        status = "Complete"
+
+    except Exception as e:
+        status, error = "Failed", e
+        await loop.run_in_executor(
+            executor,
+            partial(
+                send_slack_notification_on_failure,
+                file_name=image.raw_image_path.name,
+                error=str(error),
+                env_vars=env_vars,
+            ),
+        )
+        await loop.run_in_executor(executor, image.cleanup)
+        print("Error: " + str(error))
+
+    # With a sink the status is recorded once the metrics are inserted
+    if metrics_sink is None or status == "Failed":
+        await loop.run_in_executor(
+            executor,
+            partial(
+                _record_status,
+                image.raw_image_path,
+                status,
+                conn=None,
+                fms_IDs=fms_IDs,
+                error=error,
+            ),
+        )
+
+    print(status)
+    return status
+
+
+async def submit_chain_async(
+    image: CeligoImage,
+    loop: asyncio.AbstractEventLoop,
+    executor: ThreadPoolExecutor,
+    cache: Optional[StageCache] = None,
+) -> Tuple[List[int], Path, List[Path]]:
+    """Coroutine equivalent of `CeligoImage.submit_chain`. Scripts are rendered (and cached
+    outputs restored) on `executor` and submitted with `sbatch_async`.
+    """
+    stages = await loop.run_in_executor(executor, image.prepare_chain)
+
+    start = 0
+    if cache is not None:
+        await loop.run_in_executor(executor, cache.restore_chain, image, stages)
+        start = first_missing_stage(stages)
+
+    job_IDs = []  # type: List[int]
+    for script_path, _ in stages[start:]:
+        job_IDs.append(
+            await sbatch_async(script_path, job_IDs[-1] if job_IDs else None)
+        )
+
+    return job_IDs, stages[1][1], stages[2][1]
+
+
+async def sbatch_async(
+    script_path: Path,
+    dependency: Optional[Union[int, str]] = None,
+    dependency_type: str = "afterok",
+) -> int:
+    """Coroutine equivalent of `sbatch`, returns the SLURM job ID."""
+    command = sbatch_command(script_path, dependency, dependency_type)
+    returncode, stdout, stderr = await _run_command(command)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, stdout, stderr)
+    return parse_job_ID(stdout)
+
+
+async def wait_for_job_async(
+    watcher: "AsyncSlurmJobWatcher",
+    job_ID: Union[int, str],
+    filelist: List[pathlib.Path],
+    name: str,
+):
+    """Coroutine equivalent of `wait_for_job`, raises if the job failed."""
+    if await watcher.watch(job_ID, filelist, name) == "failed":
+        raise RuntimeError(f"Job: {job_ID} {name} has failed!")
+
+
+class AsyncSlurmJobWatcher:
+    """Coroutine equivalent of `SlurmJobWatcher`, polls from a task on the running event
+    loop instead of a thread. `squeue` and `sacct` run as async subprocesses, so a poll
+    never blocks the coroutines waiting on their jobs. Job Status is dictated as for
+    `SlurmJobWatcher`.
+    """
+
+    def __init__(self, poll_interval: float = 3, max_checks: int = 1000):
+        """Constructor.
+
+        Parameters
+        ----------
+        poll_interval: float
+            Seconds to wait between queue checks. Default is 3 seconds.
+        max_checks: int
+            Number of polls after which a job that is no longer queued and has not produced
+            its files is marked as failed.
+        """
+        self.poll_interval = poll_interval
+        self.max_checks = max_checks
+        self._jobs: List[dict] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def watch(
+        self,
+        job_ID: Union[int, str],
+        filelist: List[pathlib.Path],
+        name: str = "",
+    ) -> asyncio.Future:
+        """Registers a job with the watcher, must be called from the event loop.
+
+        Returns
+        -------
+        asyncio.Future
+            Resolves to the final job status, either "complete" or "failed".
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._jobs.append(
+            {
+                "job_ID": str(job_ID),
+                "filelist": filelist,
+                "name": name,
+                "status": "waiting",
+                "checks": 0,
+                "future": future,
+            }
+        )
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return future
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if not self._jobs:
+                self._task = None
+                return
+            jobs = list(self._jobs)
+            try:
+                finished = await self.poll(jobs)
+            except Exception as e:
+                print(f"Job watcher error: {e}")
+                continue
+            done = {id(job) for job in finished}
+            self._jobs = [job for job in self._jobs if id(job) not in done]
+            for job in finished:
+                if not job["future"].done():
+                    job["future"].set_result(job["status"])
+
+    async def poll(self, jobs: List[dict]) -> List[dict]:
+        """Runs a single check over `jobs` and returns the jobs that have finished."""
+        queued = _queue_states(
+            *await _run_command(_squeue_command([job["job_ID"] for job in jobs]))
+        )
+        if queued is None:
+            # SLURM could not be reached this tick, try again on the next one
+            return []
+
+        finished, missing = _update_jobs(jobs, queued)
+        if missing:
+            returncode, stdout, _ = await _run_command(
+                _sacct_command([job["job_ID"] for job in missing])
+            )
+            finished += _fail_missing_jobs(
+                missing, _accounting_states(returncode, stdout), self.max_checks
+            )
+        return finished
+
+
+async def _run_command(command: List[str]) -> Tuple[int, bytes, bytes]:
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    # The process has exited once communicate returns, so it has a return code
+    return cast(int, process.returncode), stdout, stderr
@@ -0,0 +1,294 @@
+import os
+from pathlib import Path
+import pwd
+import shutil
+import tempfile
+from typing import List, Optional, Tuple
+
+from .celigo_single_image.celigo_image import (
+    CeligoImage,
+    sbatch,
+)
+from .celigo_templates import render_template
+
+
+class CeligoBatch:
+    """This Class submits the Celigo pipeline for a batch of celigo images
+    with one SLURM job array per stage.
+
+    """
+
+    def __init__(self, images: List[CeligoImage], throttle: int = 30) -> None:
+        """Constructor.
+
+        Parameters
+        ----------
+        images : List[CeligoImage]
+            Images to process. Every task of an array is given the same SLURM resources, so
+            all images in a batch must be of the same type.
+        throttle : int
+            Maximum number of array tasks SLURM runs simultaniously for each stage. Default
+            is set to 30.
+        """
+        if not images:
+            raise ValueError("A batch needs at least one image")
+        if len({type(image) for image in images}) > 1:
+            raise ValueError("All images in a batch must be of the same type")
+
+        self.images = images
+        self.throttle = throttle
+
+        # Working Directory Creation, holds the manifests and array scripts
+        self.working_dir = Path(
+            tempfile.mkdtemp(
+                prefix="celigo_batch_", dir=f"/home/{pwd.getpwuid(os.getuid())[0]}"
+            )
+        )
+
+    def submit_chain(
+        self, batch_ilastik: bool = False, batch_cellprofiler: bool = False
+    ) -> Tuple[List[int], List[Path], List[List[Path]]]:
+        """Submits downsampling, Ilastik and Cell Profiler for every image in the batch as
+        three job arrays. Each array task depends on the matching task of the previous
+        array (`aftercorr`), so an image moves on to its next stage as soon as its own
+        previous stage is done.
+
+        Parameters
+        ----------
+        batch_ilastik : bool
+            If True Ilastik runs as a single job over all images once every downsampling task
+            completed (see `submit_ilastik`) instead of as a job array.
+        batch_cellprofiler : bool
+            If True Cell Profiler runs as a single job over all images once Ilastik completed
+            for every image (see `submit_cellprofiler`) instead of as a job array. The per image
+            outputs only exist after `split_cellprofiler_outputs` has been called.
+
+        Returns
+        -------
+        tuple[list[int],list[pathlib.Path],list[list[pathlib.Path]]]
+            The SLURM job IDs of the three stages, the Ilastik probability map Path of each
+            image and the Cell Profiler output Paths of each image, in the order of `images`.
+        """
+        downsample = [image.prepare_downsample() for image in self.images]
+        downsample_job_ID = self.submit_array(
+            "downsample", [script for script, _ in downsample]
+        )
+
+        if batch_ilastik:
+            ilastik_job_ID, ilastik_output_file_paths = self.submit_ilastik(
+                downsample_job_ID
+            )
+        else:
+            ilastik = [image.prepare_ilastik() for image in self.images]
+            ilastik_output_file_paths = [output for _, output in ilastik]
+            ilastik_job_ID = self.submit_array(
+                "ilastik", [script for script, _ in ilastik], downsample_job_ID
+            )
+
+        if batch_cellprofiler:
+            cellprofiler_job_ID, _ = self.submit_cellprofiler(ilastik_job_ID)
+        else:
+            cellprofiler = [image.prepare_cellprofiler() for image in self.images]
+            self.cellprofiler_output_file_paths = [
+                outputs for _, outputs in cellprofiler
+            ]
+            # A single Ilastik job has no tasks to correspond to
+            cellprofiler_job_ID = self.submit_array(
+                "cellprofiler",
+                [script for script, _ in cellprofiler],
+                ilastik_job_ID,
+                "afterok" if batch_ilastik else "aftercorr",
+            )
+
+        return (
+            [downsample_job_ID, ilastik_job_ID, cellprofiler_job_ID],
+            ilastik_output_file_paths,
+            self.cellprofiler_output_file_paths,
+        )
+
+    def submit_array(
+        self,
+        stage: str,
+        script_paths: List[Path],
+        dependency: Optional[int] = None,
+        dependency_type: str = "aftercorr",
+    ) -> int:
+        """Submits one job array running `script_paths`, one task per script.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, one of the keys of `CeligoImage.memory`.
+        script_paths : List[pathlib.Path]
+            Per image scripts rendered by the `prepare_` methods of each image.
+        dependency : Optional[int]
+            Job array whose matching task has to complete sucessfully before each task starts.
+        dependency_type : str
+            SLURM dependency type, default is `aftercorr`. Use `afterok` when `dependency` is
+            not a job array.
+
+        Returns
+        -------
+        int
+            The SLURM job ID of the array.
+        """
+
+        # Manifest of scripts, indexed by SLURM_ARRAY_TASK_ID
+        manifest_path = self.working_dir / f"{stage}_manifest.txt"
+        with open(manifest_path, "w+") as mfl:
+            mfl.write("\n".join(str(path) for path in script_paths) + "\n")
+
+        script_config = {
+            "memory": self.images[0].memory[stage],
+            "count": len(script_paths),
+            "throttle": self.throttle,
+            "manifest_path": str(manifest_path),
+        }
+
+        # Generates script for SLURM submission from templates.
+        script_body = render_template("array_template.j2", script_config)
+        with open(self.working_dir / f"{stage}.sh", "w+") as rsh:
+            rsh.write(script_body)
+
+        return sbatch(self.working_dir / f"{stage}.sh", dependency, dependency_type)
+
+    def submit_ilastik(
+        self, dependency: Optional[int] = None
+    ) -> Tuple[int, List[Path]]:
+        """Submits one Ilastik job for every image in the batch, so the Ilastik project and
+        its classifier are loaded once instead of once per image. Every probability map is
+        written next to its image with the same name as a single image run would give it.
+
+        Parameters
+        ----------
+        dependency : Optional[int]
+            Job (array) that has to complete sucessfully, for every task, before the job starts.
+
+        Returns
+        -------
+        tuple[int,list[pathlib.Path]]
+            The SLURM job ID and the probability map Path of each image, in the order of `images`.
+        """
+        ilastik_output_file_paths = [
+            image.prepare_ilastik()[1] for image in self.images
+        ]
+
+        # Ilastik names each output after its input ({nickname} is the file name without
+        # extension), so one pattern covers every image
+        first = self.images[0]
+        suffix = ilastik_output_file_paths[0].name[len(first.image_path.stem) :]
+
+        # Parameters to input to bash script template
+        script_config = {
+            "memory": first.memory["ilastik"],
+            "image_path": " ".join(
+                f"'{str(image.image_path)}'" for image in self.images
+            ),
+            "output_path": f"'{{dataset_dir}}/{{nickname}}{suffix}'",
+            "output_suffix": suffix,
+            "scratch": first.scratch,
+        }
+
+        # Generates script for SLURM submission from templates.
+        script_body = render_template(first.ilastik_template, script_config)
+        with open(self.working_dir / "ilastik.sh", "w+") as rsh:
+            rsh.write(script_body)
+
+        return (
+            sbatch(self.working_dir / "ilastik.sh", dependency),
+            ilastik_output_file_paths,
+        )
+
+    def submit_cellprofiler(
+        self, dependency: Optional[int] = None
+    ) -> Tuple[int, List[Path]]:
+        """Submits one Cell Profiler job for every image in the batch, so CellProfiler
+        starts up and parses its pipeline once instead of once per image. The per image
+        file lists written by `prepare_cellprofiler` are combined into a single file list.
+
+        Parameters
+        ----------
+        dependency : Optional[int]
+            Job (array) that has to complete sucessfully, for every task, before the job starts.
+
+        Returns
+        -------
+        tuple[int,list[pathlib.Path]]
+            The SLURM job ID and the combined output Paths. Use `split_cellprofiler_outputs`
+            to get the per image outputs once the job is complete.
+        """
+        self.cellprofiler_output_file_paths = [
+            image.prepare_cellprofiler()[1] for image in self.images
+        ]
+
+        # Combined filelist of every image and its probability map
+        with open(self.working_dir / "filelist.txt", "w+") as rfl:
+            for image in self.images:
+                with open(image.filelist_path) as ifl:
+                    rfl.write(ifl.read().strip() + "\n")
+
+        self.cell_profiler_output_path = self.working_dir / "cell_profiler_outputs"
+
+        # Parameters to input to bash script template.
+        script_config = {
+            "filelist_path": str(self.working_dir / "filelist.txt"),
+            "output_dir": str(self.cell_profiler_output_path),
+            "pipeline_path": str(self.images[0].cellprofiler_pipeline_path),
+            "memory": self.images[0].memory["cellprofiler"],
+            "scratch": self.images[0].scratch,
+        }
+
+        # Generates script for SLURM submission from templates.
+        script_body = render_template("cellprofiler_template.j2", script_config)
+        with open(self.working_dir / "cellprofiler.sh", "w+") as rsh:
+            rsh.write(script_body)
+
+        job_ID = sbatch(self.working_dir / "cellprofiler.sh", dependency)
+
+        # Outlines are written per image, the csv's hold the rows of every image
+        return job_ID, list(
+            dict.fromkeys(
+                self.cell_profiler_output_path / path.name
+                for outputs in self.cellprofiler_output_file_paths
+                for path in outputs
+            )
+        )
+
+    def split_cellprofiler_outputs(self):
+        """Splits the outputs of `submit_cellprofiler` into the Cell Profiler output directory
+        of each image, so that every image can be finished as if it had been processed on its
+        own. Rows are matched to images through the rescaled image file name (`FileName_BF`)
+        in ImageDATA.csv.
+        """
+        import pandas as pd
+
+        csvs = {
+            path.name: pd.read_csv(self.cell_profiler_output_path / path.name)
+            for path in self.cellprofiler_output_file_paths[0]
+            if path.suffix == ".csv"
+        }
+        image_data = csvs["ImageDATA.csv"]
+
+        for image, outputs in zip(self.images, self.cellprofiler_output_file_paths):
+            image_numbers = image_data.loc[
+                image_data["FileName_BF"] == image.image_path.name, "ImageNumber"
+            ]
+            for path in outputs:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                if path.suffix == ".csv":
+                    frame = csvs[path.name]
+                    frame = frame[frame["ImageNumber"].isin(image_numbers)].copy()
+                    frame["ImageNumber"] = 1
+                    frame.to_csv(path, index=False)
+                else:
+                    shutil.move(self.cell_profiler_output_path / path.name, path)
+
+    def task_ID(self, job_ID: int, index: int) -> str:
+        """Returns the SLURM ID of the array task that processes `images[index]`."""
+        return f"{job_ID}_{index + 1}"
+
+    def cleanup(self):
+        """Removes the batch working directory. The working directories of the images
+        are cleaned up by the images themselves.
+        """
+        shutil.rmtree(self.working_dir)
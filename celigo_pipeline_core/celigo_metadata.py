@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import (
+    Dict,
+    Iterable,
+    Union,
+)
+
+# Number of parsed raw images kept, more than a night of plates
+METADATA_CACHE_SIZE = 4096
+
+
+def get_metadata(raw_image_path: Union[str, Path]):
+    """Returns the `CeligoUploader` holding the metadata of a raw image (barcode, well, scan
+    date and time and the well ID looked up from LabKey), parsed from its file name. Every
+    file is parsed once per process, the `METADATA_CACHE_SIZE` most recently used are kept.
+    Failed parses are not cached.
+
+    Parameters
+    ----------
+    raw_image_path: Union[str, pathlib.Path]
+        Path of the raw Celigo image.
+
+    Returns
+    -------
+    CeligoUploader
+        Uploader of type "temp" whose attributes hold the parsed metadata.
+    """
+    return _parse(str(raw_image_path))
+
+
+def get_metadata_batch(
+    raw_image_paths: Iterable[Union[str, Path]], max_workers: int = 8
+) -> Dict[str, object]:
+    """Parses the metadata of many raw images, e.g. a whole directory, at most `max_workers`
+    at a time, and caches them for `get_metadata`. Every file is parsed once, no matter how
+    often it is listed.
+
+    Parameters
+    ----------
+    raw_image_paths: Iterable[Union[str, pathlib.Path]]
+        Paths of the raw Celigo images.
+    max_workers: int
+        Number of files parsed simultaniously. Default is 8.
+
+    Returns
+    -------
+    Dict[str, object]
+        The `CeligoUploader` of every image, or the exception its parse raised, keyed by path.
+    """
+    paths = list(dict.fromkeys(str(path) for path in raw_image_paths))
+
+    def parse(path: str):
+        try:
+            return _parse(path)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(parse, paths)))
+
+
+def clear_metadata_cache():
+    """Forgets every parsed file, e.g. after a LabKey correction."""
+    _parse.cache_clear()
+
+
+@lru_cache(maxsize=METADATA_CACHE_SIZE)
+def _parse(raw_image_path: str):
+    from aics_pipeline_uploaders import (
+        CeligoUploader,
+    )
+
+    return CeligoUploader(Path(raw_image_path), file_type="temp")
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+from functools import lru_cache
+import os
+from pathlib import Path
+import tempfile
+from typing import (
+    TYPE_CHECKING,
+    List,
+    Optional,
+    Sequence,
+    Union,
+)
+from urllib.parse import quote
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+# Partition columns of the archive, in directory order
+PARTITIONS = ("barcode", "scan_date")
+
+
+def archive_metrics(
+    metrics: pd.DataFrame,
+    archive_dir: Union[str, Path],
+    table: str,
+    barcode: str,
+    scan_date: str,
+    name: str,
+) -> Path:
+    """Writes the metrics of one image to the Parquet archive at `archive_dir`, a dataset per
+    metrics table partitioned by plate barcode and scan date:
+    `<archive_dir>/<table>/barcode=<barcode>/scan_date=<scan_date>/<name>.parquet`.
+    A reprocessed image replaces its previous file. Requires the `arrow` extra.
+
+    Parameters
+    ----------
+    metrics: pd.DataFrame
+        The metrics of the image, as inserted into `table`.
+    archive_dir: Union[str, pathlib.Path]
+        Root directory of the archive.
+    table: str
+        Metrics table the rows belong to, names the dataset.
+    barcode: str
+        Plate barcode of the image.
+    scan_date: str
+        Scan date of the image.
+    name: str
+        Name of the image (the Experiment ID).
+
+    Returns
+    -------
+    pathlib.Path
+        The written Parquet file.
+    """
+    partition = _dataset_dir(archive_dir, table).joinpath(
+        *(
+            f"{column}={quote(str(value), safe='')}"
+            for column, value in zip(PARTITIONS, (barcode, scan_date))
+        )
+    )
+    partition.mkdir(parents=True, exist_ok=True)
+    path = partition / f"{Path(name).stem}.parquet"
+
+    # The partition values live in the path, so they are not repeated in the file.
+    # Written next to the destination first, so readers never see a partial file
+    # (hidden files are skipped by `read_metrics_archive`)
+    fd, tmp_path = tempfile.mkstemp(prefix=".", dir=partition)
+    os.close(fd)
+    try:
+        metrics.drop(
+            columns=[c for c in PARTITIONS if c in metrics.columns]
+        ).to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return path
+
+
+def archive_configured_metrics(
+    metrics: pd.DataFrame,
+    table: str,
+    barcode: str,
+    scan_date: str,
+    name: str,
+) -> Optional[Path]:
+    """Writes the metrics of one image with `archive_metrics` if an archive is configured with
+    the CELIGO_METRICS_ARCHIVE environment variable. The archive is a copy of the database, so
+    failing to write it (e.g. without the `arrow` extra) is reported and does not fail the image.
+    Returns the written Parquet file, if any.
+    """
+    archive_dir = configured_archive_dir()
+    if not archive_dir:
+        return None
+    try:
+        return archive_metrics(metrics, archive_dir, table, barcode, scan_date, name)
+    except Exception as e:
+        print(f"Archive Error: {name} {e}")
+        return None
+
+
+@lru_cache(maxsize=None)
+def configured_archive_dir() -> Optional[str]:
+    # Read on first use rather than at import, after the environment file has been loaded
+    return os.getenv("CELIGO_METRICS_ARCHIVE")
+
+
+def read_metrics_archive(
+    archive_dir: Union[str, Path],
+    table: str,
+    columns: Optional[List[str]] = None,
+    barcodes: Optional[Sequence[str]] = None,
+    scan_dates: Optional[Sequence[str]] = None,
+) -> pd.DataFrame:
+    """Reads metrics from the Parquet archive written by `archive_metrics`. Only the requested
+    columns are read, and only from the partitions of the requested plates and scan dates.
+    Requires the `arrow` extra.
+
+    Parameters
+    ----------
+    archive_dir: Union[str, pathlib.Path]
+        Root directory of the archive.
+    table: str
+        Metrics table whose dataset is read.
+    columns: Optional[List[str]]
+        Columns to read, may include "barcode" and "scan_date". Default is every column.
+    barcodes: Optional[Sequence[str]]
+        Only read these plates. Default is every plate.
+    scan_dates: Optional[Sequence[str]]
+        Only read images scanned on these dates. Default is every date.
+
+    Returns
+    -------
+    pd.DataFrame
+        The archived metrics, with the "barcode" and "scan_date" of every row.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(
+        _dataset_dir(archive_dir, table),
+        format="parquet",
+        partitioning=ds.partitioning(
+            pa.schema([(column, pa.string()) for column in PARTITIONS]),
+            flavor="hive",
+        ),
+    )
+
+    filters = []
+    if barcodes is not None:
+        filters.append(ds.field("barcode").isin([str(b) for b in barcodes]))
+    if scan_dates is not None:
+        filters.append(ds.field("scan_date").isin([str(d) for d in scan_dates]))
+    expression = None
+    for condition in filters:
+        expression = condition if expression is None else expression & condition
+
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def _dataset_dir(archive_dir: Union[str, Path], table: str) -> Path:
+    return Path(archive_dir) / table.strip('"')
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import importlib.util
+from pathlib import Path
+import re
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Optional,
+    Sequence,
+    Union,
+)
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+# Multi threaded CSV parsing if pyarrow is installed (the `arrow` extra). Only looked up
+# here, pandas imports pyarrow when it parses the first file
+CSV_ENGINE = "pyarrow" if importlib.util.find_spec("pyarrow") is not None else "c"
+
+# Column dtypes declared for postgres data types, other columns are inferred
+_DTYPES = {
+    "smallint": "Int64",
+    "integer": "Int64",
+    "bigint": "Int64",
+    "real": "float64",
+    "double precision": "float64",
+    "numeric": "float64",
+    "boolean": "boolean",
+    "text": "str",
+    "character varying": "str",
+}
+
+
+def read_metrics_csv(
+    path: Union[str, Path],
+    table_columns: Optional[Dict[str, str]] = None,
+    keep: Sequence[str] = (),
+    exclude: Optional[str] = None,
+) -> pd.DataFrame:
+    """Reads a Cell Profiler output CSV, parsing only the columns of the table it is
+    inserted into, with their dtypes declared instead of inferred.
+
+    Parameters
+    ----------
+    path: Union[str, pathlib.Path]
+        Cell Profiler output CSV.
+    table_columns: Optional[Dict[str, str]]
+        Postgres data type of every column of the target table, as returned by
+        `get_table_columns`. If empty or None every column is read and dtypes are inferred.
+    keep: Sequence[str]
+        Columns read even if they are not in the table, e.g. the keys the outputs are merged on.
+    exclude: Optional[str]
+        Regular expression of columns never read, e.g. "Metadata".
+
+    Returns
+    -------
+    pd.DataFrame
+        The selected columns of the CSV, in file order.
+    """
+    import pandas as pd
+
+    header = pd.read_csv(path, nrows=0).columns
+    usecols = [
+        column
+        for column in header
+        if (not table_columns or column in table_columns or column in keep)
+        and (exclude is None or not re.search(exclude, column))
+    ]
+    dtype = {
+        column: _DTYPES[table_columns[column]]
+        for column in usecols
+        if table_columns and table_columns.get(column) in _DTYPES
+    }
+
+    try:
+        return pd.read_csv(path, usecols=usecols, dtype=dtype, engine=CSV_ENGINE)
+    except (TypeError, ValueError):
+        # A column does not parse as its declared type, fall back to inference
+        return pd.read_csv(path, usecols=usecols)
+
+
+def merge_image_data(
+    object_data: pd.DataFrame, image_data: pd.DataFrame, on: str = "ImageNumber"
+) -> pd.DataFrame:
+    """Left joins per image measurements onto per object measurements (e.g. ImageDATA onto
+    ColonyDATA) and drops the join column, the equivalent of
+    `pd.merge(object_data, image_data, how="left", on=on).drop(columns=[on])`.
+
+    Every column of `image_data` is gathered once by position into the object rows, without
+    the intermediate copies and hash join of `pd.merge`, and keeps its dtype.
+    """
+    import pandas as pd
+
+    overlap = set(object_data.columns) & set(image_data.columns) - {on}
+    images = pd.Index(image_data[on])
+    if overlap or not images.is_unique:
+        # Suffixed or duplicated rows, leave those to pandas
+        return pd.merge(object_data, image_data, how="left", on=on).drop(columns=[on])
+
+    # Position of the image of every object, -1 (missing values) for unknown images
+    positions = images.get_indexer(object_data[on])
+    gathered = pd.DataFrame(
+        {
+            column: image_data[column].array.take(
+                positions, allow_fill=bool((positions < 0).any())
+            )
+            for column in image_data.columns
+            if column != on
+        },
+        index=object_data.index,
+    )
+    return pd.concat([object_data.drop(columns=[on]), gathered], axis=1)
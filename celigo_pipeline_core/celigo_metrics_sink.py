@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import threading
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import psycopg2
+
+from .postgres_db_functions import (
+    _mode_key,
+    borrow_connection,
+    update_FMS_IDs,
+    write_rows,
+)
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+class MetricsSink:
+    """Buffers the metrics of many images and inserts them into the metrics tables in one
+    transaction, instead of one insert and commit per image. The buffer is flushed once it
+    holds `max_rows` rows or its oldest metrics have waited `max_delay` seconds, and when the
+    sink is closed.
+
+    Every image is inserted under its own savepoint, so metrics that fail to insert (e.g. a
+    malformed Cell Profiler CSV) are rolled back and reported without losing the metrics of
+    the other images in the transaction. The sink can be shared between threads.
+
+    The metrics of an image whose files are still being uploaded to FMS are held back (see
+    `hold`) until its FMS IDs are known, the IDs are then set in the transaction that
+    inserts the metrics, and the outcome of the image is passed to its `on_flush` callback
+    once that transaction is over.
+    """
+
+    def __init__(self, max_rows: int = 50000, max_delay: float = 60, conn=None):
+        """Constructor.
+
+        Parameters
+        ----------
+        max_rows: int
+            Number of buffered rows, over all images, that triggers a flush. Default is 50000.
+        max_delay: float
+            Seconds metrics may wait in the buffer before they are flushed. Default is 60 seconds.
+        conn
+            A psycopg2 database connection. If None a connection is borrowed from the shared pool
+            for every flush.
+        """
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.conn = conn
+        self.failures: Dict[str, Exception] = {}
+        self._buffer: List[
+            Tuple[
+                str,
+                str,
+                pd.DataFrame,
+                str,
+                Sequence[str],
+                Optional[dict],
+                Optional[Callable[[Optional[Exception]], None]],
+            ]
+        ] = []
+        # Metrics of held images, None until they are added
+        self._held: Dict[
+            str, Optional[Tuple[str, pd.DataFrame, str, Sequence[str]]]
+        ] = {}
+        self._rows = 0
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def add(
+        self,
+        index: str,
+        table: str,
+        metadata: pd.DataFrame,
+        mode: str = "append",
+        key: Optional[Sequence[str]] = None,
+        fms_IDs: Optional[dict] = None,
+        on_flush: Optional[Callable[[Optional[Exception]], None]] = None,
+    ):
+        """Buffers the metrics of one image, or keeps them until `release` if the image is held.
+
+        Parameters
+        ----------
+        index: str
+            Index of the image (the Experiment ID), used to report failed inserts.
+        table: str
+            Table the metrics are inserted into.
+        metadata: pd.DataFrame
+            The metrics of the image, as passed to `add_to_table`.
+        mode: str
+            Insert mode of the metrics, see `add_to_table`. Default is "append".
+        key: Sequence[str]
+            Columns identifying a row, required for "upsert", see `add_to_table`.
+        fms_IDs: Optional[dict]
+            FMS IDs of the image in form [KEY] : [VALUE], set on its rows in the transaction
+            that inserts them.
+        on_flush: Optional[Callable[[Optional[Exception]], None]]
+            Called once the transaction is over, with None if the metrics were committed and
+            with the error otherwise.
+        """
+        key = _mode_key(mode, key)
+
+        with self._lock:
+            if index in self._held:
+                self._held[index] = (table, metadata, mode, key)
+                return
+        self._buffer_metrics(index, table, metadata, mode, key, fms_IDs, on_flush)
+
+    def hold(self, index: str):
+        """Holds back the metrics of the image `index` added from now on until `release`,
+        e.g. while its files are uploaded to FMS.
+        """
+        with self._lock:
+            self._held.setdefault(index, None)
+
+    def release(
+        self,
+        index: str,
+        fms_IDs: Optional[dict] = None,
+        on_flush: Optional[Callable[[Optional[Exception]], None]] = None,
+    ):
+        """Buffers the held metrics of the image `index`, to be inserted with `fms_IDs`.
+
+        Parameters
+        ----------
+        index: str
+            Index of the held image (the Experiment ID).
+        fms_IDs: Optional[dict]
+            FMS IDs of the image in form [KEY] : [VALUE], set on its rows in the transaction
+            that inserts them.
+        on_flush: Optional[Callable[[Optional[Exception]], None]]
+            Called once the transaction is over, with None if the metrics were committed and
+            with the error otherwise.
+        """
+        with self._lock:
+            held = self._held.pop(index)
+        if held is None:
+            raise ValueError(f"No metrics were added for {index}")
+        self._buffer_metrics(index, *held, fms_IDs, on_flush)
+
+    def discard(self, index: str):
+        """Drops the held metrics of the image `index`, e.g. after its FMS upload failed."""
+        with self._lock:
+            self._held.pop(index, None)
+
+    def _buffer_metrics(
+        self,
+        index: str,
+        table: str,
+        metadata: pd.DataFrame,
+        mode: str,
+        key: Sequence[str],
+        fms_IDs: Optional[dict],
+        on_flush: Optional[Callable[[Optional[Exception]], None]],
+    ):
+        with self._lock:
+            self._buffer.append((index, table, metadata, mode, key, fms_IDs, on_flush))
+            self._rows += len(metadata)
+            # The first buffered image starts the clock of `max_delay`
+            if self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+            full = self._rows >= self.max_rows
+
+        if full:
+            self.flush()
+
+    def flush(self) -> Dict[str, Exception]:
+        """Inserts every buffered image and sets their FMS IDs in one transaction, then calls
+        the `on_flush` callback of every image. Held images are not inserted.
+
+        Returns
+        -------
+        Dict[str, Exception]
+            The error of every image whose metrics could not be inserted, keyed by index.
+        """
+        with self._flush_lock:
+            with self._lock:
+                buffer, self._buffer = self._buffer, []
+                self._rows = 0
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not buffer:
+                return {}
+
+            failures = {}
+            try:
+                with borrow_connection(self.conn) as conn:
+                    with conn.cursor() as cursor:
+                        # FMS IDs of the inserted images, keyed by table
+                        fms_IDs: Dict[str, Dict[str, dict]] = {}
+                        for index, table, metadata, mode, key, ids, _ in buffer:
+                            cursor.execute("SAVEPOINT image_metrics")
+                            try:
+                                write_rows(cursor, metadata, table, mode, key)
+                                cursor.execute("RELEASE SAVEPOINT image_metrics")
+                            except (Exception, psycopg2.DatabaseError) as e:
+                                cursor.execute("ROLLBACK TO SAVEPOINT image_metrics")
+                                failures[index] = e
+                                continue
+                            if ids:
+                                fms_IDs.setdefault(table, {})[index] = ids
+
+                        for table, ids in fms_IDs.items():
+                            update_FMS_IDs(cursor, ids, table)
+                    conn.commit()
+            except (Exception, psycopg2.DatabaseError) as e:
+                # The transaction itself failed, nothing of the buffer was inserted
+                failures = {index: e for index, *_ in buffer}
+
+            for index, error in failures.items():
+                print(f"Error: metrics of {index} {error}")
+            self.failures.update(failures)
+
+            # After the connection is returned, callbacks may borrow one themselves
+            for index, *_, on_flush in buffer:
+                if on_flush is None:
+                    continue
+                try:
+                    on_flush(failures.get(index))
+                except Exception as e:
+                    print(f"Error: {index} {e}")
+            return failures
+
+    def close(self) -> Dict[str, Exception]:
+        """Flushes the remaining metrics and returns the failures of every flush. Images that
+        are still held are reported as failed.
+        """
+        self.flush()
+        with self._lock:
+            held, self._held = self._held, {}
+        for index in held:
+            print(f"Error: metrics of {index} were never released")
+            self.failures[index] = RuntimeError("Metrics were never released")
+        return self.failures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
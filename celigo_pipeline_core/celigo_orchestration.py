@@ -1,31 +1,49 @@
+from concurrent.futures import (
+    Executor,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from datetime import date, datetime
-import multiprocessing
+from functools import partial
 import os
 import pathlib
 from pathlib import Path
 import pwd
-import shutil
 import subprocess
+import threading
 import time
-from typing import List
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
-from aics_pipeline_uploaders import CeligoUploader
 from dotenv import load_dotenv
-import pandas as pd
-import psycopg2
 
+from .celigo_batch import CeligoBatch
+from .celigo_metadata import get_metadata_batch
+from .celigo_metrics_sink import MetricsSink
+from .celigo_run_state import RunStateStore
 from .celigo_single_image import (
     CeligoImage,
     CeligoSingleImageCore,
     CeligoSixWellCore,
 )
+from .celigo_stage_cache import StageCache
+from .celigo_staging import stage_file
 from .notifcations import (
     send_slack_notification_on_failure,
 )
 from .postgres_db_functions import (
     add_FMS_IDs_to_SQL_table,
     add_to_table,
+    get_connection_pool,
 )
+from .postgres_schema import STATUS_KEY
 
 
 def run_all(
@@ -33,7 +51,13 @@ def run_all(
     env: str = "stg",
     env_vars: str = f"/home/{pwd.getpwuid(os.getuid())[0]}/.env",
     export_location_path: str = "/allen/aics/microscopy/brian_whitney/temp_output",
-):
+    chain_jobs: bool = True,
+    state_path: Optional[str] = None,
+    cache: Optional[StageCache] = None,
+    scratch: bool = False,
+    metrics_sink: Optional[MetricsSink] = None,
+    replace_metrics: bool = False,
+) -> str:
     """Process Celigo Image from `raw_image_path`. Submits jobs for Image Downsampling,
     Image Ilastik Processing, and Image Celigo Processing. After job completion,
     Image Metrics are uploaded to an external database.
@@ -49,18 +73,170 @@ def run_all(
         Path to a .env file containing database credentials. Default is set to users home directory.
     export_location_path: str
         If the user wants to export the output files of the pipeline they can specify a output directory here.
+    chain_jobs: bool
+        If True (default) all three jobs are submitted at once with SLURM dependencies and only the
+        final job is waited on. If False each job is submitted after the previous one completed.
+    state_path: Optional[str]
+        SQLite file of a `RunStateStore`. If given the progress of the image is checkpointed after
+        every stage, the working directory is kept when the image fails and an image that is already
+        in the store continues from its last checkpoint (see `resume`). Implies `chain_jobs`.
+    cache: Optional[StageCache]
+        Cache of stage outputs. Stages whose outputs are cached are restored instead of being
+        submitted, and the outputs of the image are added to the cache. Implies `chain_jobs`.
+    scratch: bool
+        If True the SLURM stages stage their inputs on node local scratch ($TMPDIR), run there and
+        copy only their outputs back, verified by checksum.
+    metrics_sink: Optional[MetricsSink]
+        If given the metrics of the image are inserted with the metrics of other images by
+        `metrics_sink` instead of right away, together with its FMS IDs. The status of the image
+        is recorded once they are inserted. Not supported with `state_path`.
+    replace_metrics: bool
+        If True the metrics of the image replace those of a previous run instead of being appended,
+        e.g. when an image is reprocessed. Costs a delete per image, which needs the Experiment ID
+        index of `create_schema` on large metrics tables.
+
+    Returns
+    -------
+    str
+        The final status of the image, "Complete" or "Failed".
     """
 
     # Check if image path exists
     if not os.path.exists(raw_image_path):
         raise FileNotFoundError(f"{raw_image_path} does not exist!")
-    raw_image = Path(raw_image_path)
 
     # Check if export path exists
     if not os.path.exists(export_location_path):
         raise FileNotFoundError(f"{export_location_path} does not exist!")
     export_location = Path(export_location_path)
 
+    # A checkpointed metrics stage must be in the database
+    if state_path is not None and metrics_sink is not None:
+        raise ValueError("metrics_sink is not supported with state_path")
+
+    _load_environment(env_vars)
+    image, table = _create_image(raw_image_path, env, scratch)
+
+    store = None
+    if state_path is not None:
+        store = RunStateStore(state_path)
+        if store.get(image.raw_image_path) is None:
+            store.update(
+                image.raw_image_path,
+                stage="created",
+                status="Running",
+                env=env,
+                export_location=export_location,
+            )
+
+    # The raw image does not depend on any stage, so it is uploaded (and its metadata
+    # parsed) in the background while SLURM processes it
+    background = ThreadPoolExecutor(max_workers=2)
+    image.parse_metadata(background)
+    raw_upload = _start_raw_upload(image, env, background, store)
+
+    def run_stages() -> Tuple[Path, List[Path]]:
+        if store is not None:
+            outputs = _run_stages_resumable(image, store, cache)
+        elif chain_jobs or cache is not None:
+            (
+                job_IDs,
+                ilastik_output_file_path,
+                cellprofiler_output_file_paths,
+            ) = image.submit_chain(cache=cache)
+            outputs = ilastik_output_file_path, cellprofiler_output_file_paths
+            if job_IDs:
+                _wait_for_outputs(job_IDs[-1], *outputs)
+        else:
+            job_ID, downsample_output_file_path = image.downsample()
+            wait_for_job(job_ID, [downsample_output_file_path], "downsample")
+            job_ID, ilastik_output_file_path = image.run_ilastik()
+            wait_for_job(job_ID, [ilastik_output_file_path], "ilastik")
+            job_ID, cellprofiler_output_file_paths = image.run_cellprofiler()
+            wait_for_job(job_ID, cellprofiler_output_file_paths, "cell profiler")
+            return ilastik_output_file_path, cellprofiler_output_file_paths
+
+        if cache is not None:
+            cache.store_chain(image)
+        return outputs
+
+    try:
+        return _process_image(
+            image,
+            table,
+            run_stages,
+            env,
+            env_vars,
+            export_location,
+            store,
+            raw_upload,
+            metrics_sink,
+            replace_metrics,
+        )
+    finally:
+        background.shutdown()
+        if store is not None:
+            store.close()
+
+
+def resume(
+    state_path: str,
+    chunk_size: int = 30,
+    env_vars: str = f"/home/{pwd.getpwuid(os.getuid())[0]}/.env",
+    scratch: bool = False,
+) -> Dict[str, str]:
+    """Continues every image of the `RunStateStore` at `state_path` that has not completed,
+    e.g. after a failed night or a crashed `run_all_dir`. Each image restarts from its last
+    checkpoint: SLURM jobs that are still queued are re-attached to, only the stages whose
+    outputs are missing are resubmitted, and metrics and FMS uploads that already happened
+    are not repeated.
+
+    Parameters
+    ----------
+    state_path: str
+        SQLite file the images were run with (`state_path` of `run_all` / `run_all_dir`).
+    chunk_size: int
+        Maximum number of images processed simultaniously. Default is set to 30.
+    env_vars: str
+        Path to a .env file containing database credentials. Default is set to users home directory.
+    scratch: bool
+        If True the SLURM stages stage their inputs on node local scratch ($TMPDIR), run there and
+        copy only their outputs back, verified by checksum.
+
+    Returns
+    -------
+    Dict[str, str]
+        The final status of every resumed image, keyed by image path.
+    """
+    store = RunStateStore(state_path)
+    records = store.incomplete()
+    store.close()
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=chunk_size) as executor:
+        futures = {
+            executor.submit(
+                run_all,
+                record["raw_image_path"],
+                record["env"],
+                env_vars,
+                record["export_location"],
+                state_path=state_path,
+                scratch=scratch,
+            ): record["raw_image_path"]
+            for record in records
+        }
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                results[path] = future.result()
+            except Exception as e:
+                results[path] = "Failed"
+                print(f"Error: {path} {e}")
+    return results
+
+
+def _load_environment(env_vars: str):
     load_dotenv(env_vars)
 
     # Check that all variables from .env are  present
@@ -84,6 +260,10 @@ def run_all(
             "Environment variables were not loaded correctly. Try adding 'load_dotenv(find_dotenv())' to your script"
         )
 
+
+def _create_image(
+    raw_image_path: str, env: str, scratch: bool = False
+) -> Tuple[CeligoImage, str]:
     # Determine if Image is 6 well or 96 well
     if os.path.getsize(raw_image_path) > 100000000:
         image = CeligoSixWellCore(
@@ -95,73 +275,332 @@ def run_all(
         image = CeligoSingleImageCore(raw_image_path=raw_image_path)
         table = str(os.getenv("CELIGO_METRICS_DB"))
         print("96 Well")
+    image.scratch = scratch
+    return image, table
+
+
+def _wait_for_outputs(
+    job_ID: Union[int, str],
+    ilastik_output_file_path: Path,
+    cellprofiler_output_file_paths: List[Path],
+) -> Tuple[Path, List[Path]]:
+    wait_for_job(
+        job_ID,
+        [ilastik_output_file_path, *cellprofiler_output_file_paths],
+        "cell profiler",
+    )
+    return ilastik_output_file_path, cellprofiler_output_file_paths
+
+
+def _run_stages_resumable(
+    image: CeligoImage, store: RunStateStore, cache: Optional[StageCache] = None
+) -> Tuple[Path, List[Path]]:
+    """Gets the SLURM outputs of `image`, starting from its checkpoint in `store`."""
+    raw_image = str(image.raw_image_path)
+    record = store.get(raw_image)
+    if record is None:
+        raise KeyError(f"{raw_image} is not in the run state store")
+    job_IDs = [str(job_ID) for job_ID in record["job_IDs"] or []]
+
+    if store.reached(record, "processed") or (
+        record["stage"] == "submitted"
+        and job_IDs
+        and job_IDs[-1] in (job_queue_states(job_IDs) or {})
+    ):
+        # Outputs exist or the submitted chain is still in SLURM, only the paths the image
+        # tracks between stages need restoring, the working directory is left untouched
+        (
+            _,
+            (_, ilastik_output_file_path),
+            (
+                _,
+                cellprofiler_output_file_paths,
+            ),
+        ) = image.prepare_chain(render=False)
+        if store.reached(record, "processed"):
+            return ilastik_output_file_path, cellprofiler_output_file_paths
+    else:
+        (
+            submitted,
+            ilastik_output_file_path,
+            cellprofiler_output_file_paths,
+        ) = image.submit_chain(resume=True, cache=cache)
+        job_IDs = [str(job_ID) for job_ID in submitted]
+        store.update(
+            raw_image,
+            stage="submitted",
+            job_IDs=job_IDs,
+            ilastik_output_file_path=ilastik_output_file_path,
+            cellprofiler_output_file_paths=cellprofiler_output_file_paths,
+        )
 
-    try:
-        # Establish connection to database
-        conn = psycopg2.connect(
-            database=os.getenv("MICROSCOPY_DB"),
-            user=os.getenv("MICROSCOPY_DB_USER"),
-            password=os.getenv("MICROSCOPY_DB_PASSWORD"),
-            host=os.getenv("MICROSCOPY_DB_HOST"),
-            port=os.getenv("MICROSCOPY_DB_PORT"),
+    if job_IDs:
+        _wait_for_outputs(
+            job_IDs[-1], ilastik_output_file_path, cellprofiler_output_file_paths
         )
-    except Exception as e:
-        print("Connection Error: " + str(e))
+    store.update(raw_image, stage="processed")
+    return ilastik_output_file_path, cellprofiler_output_file_paths
+
+
+def _process_image(
+    image: CeligoImage,
+    table: str,
+    run_stages: Callable[[], Tuple[Path, List[Path]]],
+    env: str,
+    env_vars: str,
+    export_location: Path,
+    store: Optional[RunStateStore] = None,
+    raw_upload: Optional[Future] = None,
+    metrics_sink: Optional[MetricsSink] = None,
+    replace_metrics: bool = False,
+) -> str:
+    """Runs `run_stages` to get the SLURM outputs of `image`, then uploads its metrics and
+    files and records the outcome in the status table (and `store`, if given). Returns the
+    status of the image. With a `metrics_sink` a completed image is recorded when the sink
+    inserts its metrics, and recorded as failed if that insert fails.
+    """
+    raw_image = image.raw_image_path
+
+    # Connections are borrowed from the shared pool, and only while they are used
+    conn = None
 
     # Starting process
     status = "Running"
+    fms_IDs, error = None, None
 
     try:
-        job_ID, downsample_output_file_path = image.downsample()
-        job_complete_check(job_ID, [downsample_output_file_path], "downsample")
-        job_ID, ilastik_output_file_path = image.run_ilastik()
-        job_complete_check(job_ID, [ilastik_output_file_path], "ilastik")
-        job_ID, cellprofiler_output_file_paths = image.run_cellprofiler()
-        job_complete_check(job_ID, cellprofiler_output_file_paths, "cell profiler")
-
-        # Upload metrics from pipeline
-        index = image.upload_metrics(conn, table)
-
-        # Copy files off isilon for off cluster upload
-        shutil.copyfile(
+        ilastik_output_file_path, cellprofiler_output_file_paths = run_stages()
+        fms_IDs = _finish_image(
+            image,
+            table,
+            ilastik_output_file_path,
+            cellprofiler_output_file_paths,
+            conn,
+            env,
+            export_location,
+            store,
+            raw_upload,
+            metrics_sink,
+            partial(_record_flushed_status, raw_image, env_vars),
+            replace_metrics,
+        )
+        status = "Complete"  # this wont be needed if we check after each task
+        if store is not None:
+            store.update(raw_image, stage="complete", status=status)
+
+    except Exception as e:
+        status, error = "Failed", e
+        if fms_IDs is None:
+            fms_IDs = _settle_raw_upload(raw_upload)
+        send_slack_notification_on_failure(
+            file_name=raw_image.name, error=str(error), env_vars=env_vars
+        )
+        if store is None:
+            image.cleanup()
+        else:
+            # Keep the working directory so the image can be resumed
+            store.update(raw_image, status=status, error=error)
+        print("Error: " + str(error))
+
+    # With a sink the status is recorded once the metrics are inserted
+    if metrics_sink is None or status == "Failed":
+        _record_status(raw_image, status, conn, fms_IDs, error)
+
+    print(status)
+    return status
+
+
+def _finish_image(
+    image: CeligoImage,
+    table: str,
+    ilastik_output_file_path: Path,
+    cellprofiler_output_file_paths: List[Path],
+    conn,
+    env: str,
+    export_location: Path,
+    store: Optional[RunStateStore] = None,
+    raw_upload: Optional[Future] = None,
+    metrics_sink: Optional[MetricsSink] = None,
+    on_flush: Optional[Callable[[dict, Optional[Exception]], None]] = None,
+    replace_metrics: bool = False,
+) -> dict:
+    """Uploads the metrics and files of `image` once its SLURM stages are complete and
+    returns the FMS IDs of the uploaded files. With a `store` every step is checkpointed
+    and steps that already completed in a previous run are skipped. `raw_upload` is the
+    upload of the raw image if it was started earlier (see `_start_raw_upload`).
+
+    With a `metrics_sink` the metrics are held in the sink until the files are uploaded and
+    then inserted together with their FMS IDs, `on_flush` is called with the FMS IDs and the
+    outcome of that insert.
+    """
+    if metrics_sink is None:
+        return _finish_image_stages(
+            image,
+            table,
+            ilastik_output_file_path,
+            cellprofiler_output_file_paths,
+            conn,
+            env,
+            export_location,
+            store,
+            raw_upload,
+            replace_metrics=replace_metrics,
+        )
+
+    index = image.raw_image_path.name
+    metrics_sink.hold(index)
+    try:
+        fms_IDs = _finish_image_stages(
+            image,
+            table,
+            ilastik_output_file_path,
+            cellprofiler_output_file_paths,
+            conn,
+            env,
+            export_location,
+            store,
+            raw_upload,
+            metrics_sink,
+            replace_metrics,
+        )
+    except BaseException:
+        metrics_sink.discard(index)
+        raise
+    metrics_sink.release(
+        index, fms_IDs, partial(on_flush, fms_IDs) if on_flush is not None else None
+    )
+    return fms_IDs
+
+
+def _finish_image_stages(
+    image: CeligoImage,
+    table: str,
+    ilastik_output_file_path: Path,
+    cellprofiler_output_file_paths: List[Path],
+    conn,
+    env: str,
+    export_location: Path,
+    store: Optional[RunStateStore] = None,
+    raw_upload: Optional[Future] = None,
+    metrics_sink: Optional[MetricsSink] = None,
+    replace_metrics: bool = False,
+) -> dict:
+    # Without a store no step has completed before
+    record = (store.get(image.raw_image_path) if store is not None else None) or {}
+
+    def checkpoint(stage: str, **fields):
+        if store is not None:
+            store.update(image.raw_image_path, stage=stage, **fields)
+
+    # Upload metrics from pipeline
+    if RunStateStore.reached(record, "metrics"):
+        index = record["metrics_index"]
+    else:
+        index = image.upload_metrics(conn, table, metrics_sink, replace_metrics)
+        checkpoint("metrics", metrics_index=index)
+
+    # Copy files off isilon for off cluster upload
+    if not RunStateStore.reached(record, "exported"):
+        # The working directory is removed below, so never symlink
+        stage_file(
             ilastik_output_file_path,
             export_location / ilastik_output_file_path.name,
+            symlink=False,
         )
-        shutil.copyfile(
+        stage_file(
             cellprofiler_output_file_paths[0],
             export_location / cellprofiler_output_file_paths[0].name,
+            symlink=False,
         )
+        checkpoint("exported")
 
-        # Cleans temporary files from slurm node
-        image.cleanup()
-
-        # Upload produced files to FMS
+    # Upload produced files to FMS
+    if RunStateStore.reached(record, "uploaded"):
+        fms_IDs = record["fms_IDs"]
+    else:
         fms_IDs = upload(
-            raw_image_path=raw_image,
+            raw_image_path=image.raw_image_path,
             probabilities_image_path=export_location / ilastik_output_file_path.name,
             outlines_image_path=export_location
             / cellprofiler_output_file_paths[0].name,
             env=env,
+            raw_upload=raw_upload,
         )
+        checkpoint("uploaded", fms_IDs=fms_IDs)
+
+    # Cleans temporary files from slurm node, only once the files are safely in FMS so a
+    # failed upload can still be resumed
+    image.cleanup()
 
-        # Add FMS ID's from uploaded files to postgres database
+    # Add FMS ID's from uploaded files to postgres database, a sink sets them with the metrics
+    if metrics_sink is None:
         add_FMS_IDs_to_SQL_table(
             metadata=fms_IDs,
             conn=conn,
             index=index,
             table=table,
         )
+    return fms_IDs
 
-        status = "Complete"  # this wont be needed if we check after each task
 
+def _settle_raw_upload(raw_upload: Optional[Future]) -> Optional[dict]:
+    """Stops the early raw image upload of a failed image. An upload that has not started
+    is cancelled, one that has is waited for, so the FMS ID of the raw image is recorded
+    with the failure instead of being lost. Returns the FMS ID, if the raw image was uploaded.
+    """
+    if raw_upload is None or raw_upload.cancel():
+        return None
+    try:
+        return {"RawCeligoFMSId": raw_upload.result()}
     except Exception as e:
-        status, error = "Failed", e
-        send_slack_notification_on_failure(
-            file_name=raw_image.name, error=str(error), env_vars=env_vars
-        )
-        image.cleanup()
-        print("Error: " + str(error))
+        print("Upload Error: " + str(e))
+        return None
+
+
+def _record_flushed_status(
+    raw_image: Path,
+    env_vars: str,
+    fms_IDs: dict,
+    error: Optional[Exception] = None,
+):
+    """Records the status of an image whose metrics were inserted by a `MetricsSink`."""
+    if error is None:
+        _record_status(raw_image, "Complete", None, fms_IDs)
+        return
+
+    send_slack_notification_on_failure(
+        file_name=raw_image.name, error=str(error), env_vars=env_vars
+    )
+    _record_status(raw_image, "Failed", None, fms_IDs, error)
+
+
+def _apply_metrics_failures(results: Dict[str, str], failures: Dict[str, Exception]):
+    """Marks the images of `results` whose metrics a `MetricsSink` failed to insert."""
+    for path in results:
+        if Path(path).name in failures:
+            results[path] = "Failed"
 
+
+def _record_status(
+    raw_image: Path,
+    status: str,
+    conn,
+    fms_IDs: Optional[dict] = None,
+    error: Optional[Exception] = None,
+):
+    try:
+        _add_status(raw_image, status, conn, fms_IDs, error)
+    except Exception as e:
+        print("Connection Error: " + str(e))
+
+
+def _add_status(
+    raw_image: Path,
+    status: str,
+    conn,
+    fms_IDs: Optional[dict] = None,
+    error: Optional[Exception] = None,
+):
     now = datetime.now()
     current_time = now.strftime("%H:%M:%S")
 
@@ -169,118 +608,356 @@ def run_all(
     submission = {
         "File Name": [raw_image.name],
         "Status": [status],
-        "Date": [str(date.today())],
+        # A date rather than its string, so it compares with the column of the status key
+        "Date": [date.today()],
         "Time": [current_time],
     }
 
-    if status == "Complete":
+    # Failed images record their raw image too if it was uploaded before they failed
+    if fms_IDs is not None and "RawCeligoFMSId" in fms_IDs:
         submission["FMS ID"] = [fms_IDs["RawCeligoFMSId"]]
     if status == "Failed":
         submission["Error Code"] = [str(error)]
 
+    import pandas as pd
+
     row_data = pd.DataFrame.from_dict(submission)
 
-    # Add status metrics to table
-    add_to_table(metadata=row_data, conn=conn, table=str(os.getenv("CELIGO_STATUS_DB")))
+    # Add status metrics to table, replacing the status of an earlier attempt that day. Unlike
+    # an upsert this needs no unique index, which status tables with history may not allow
+    add_to_table(
+        metadata=row_data,
+        conn=conn,
+        table=str(os.getenv("CELIGO_STATUS_DB")),
+        mode="replace",
+        key=STATUS_KEY,
+    )
 
-    print(status)
 
+# SLURM job states that mean a job left the queue without producing its outputs.
+SLURM_FAILED_STATES = {
+    "BOOT_FAIL",
+    "CANCELLED",
+    "DEADLINE",
+    "FAILED",
+    "NODE_FAIL",
+    "OUT_OF_MEMORY",
+    "PREEMPTED",
+    "TIMEOUT",
+}
 
-def job_complete_check(
-    job_ID: int,
-    filelist: List[pathlib.Path],
-    name: str = "",
-):
-    """Provides a tool to check job status of SLURM Job ID. Job Status is Dictated by the following
+
+class SlurmJobWatcher:
+    """Tracks the status of many SLURM jobs from a single polling thread. Instead of every
+    pipeline calling `squeue` for its own job, outstanding jobs are registered with the
+    watcher and one `squeue` call per tick updates all of them. Jobs that leave the queue
+    without their output files are looked up with a single `sacct` call so failures are
+    reported as soon as SLURM knows about them.
+
+    Job Status is Dictated by the following
     1) Status : waiting
-        job has not yet entered the SLURM queue. This could indicate heavy traffic or that
-        the job was submitted incorrectly and will not execute.
+        job has not yet entered the SLURM queue.
     2) Status : running
-        Job has been sucessfully submitted to SLURM and is currently in the queue. This is not
-        an indicator of sucess, only that the given job was submitted
+        Job is currently in the SLURM queue.
     3) Status : failed
-        Job has failed, the specified `endfile` was not created within the specified time
-        criteria. Most likely after this time it will never complete.
+        Job ended in a failed SLURM state, or the expected files were not created within
+        `max_checks` polls.
     4) Status : complete
-        Job has completed! and it is ok to use the endfile locationn for further processing
+        All expected files exist.
+    """
+
+    def __init__(self, poll_interval: float = 3, max_checks: int = 1000):
+        """Constructor.
+
+        Parameters
+        ----------
+        poll_interval: float
+            Seconds to wait between queue checks. Default is 3 seconds.
+        max_checks: int
+            Number of polls after which a job that is no longer queued and has not produced
+            its files is marked as failed.
+        """
+        self.poll_interval = poll_interval
+        self.max_checks = max_checks
+        self._jobs: List[dict] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def watch(
+        self,
+        job_ID: Union[int, str],
+        filelist: List[pathlib.Path],
+        name: str = "",
+    ) -> Future:
+        """Registers a job with the watcher.
+
+        Parameters
+        ----------
+        job_ID: Union[int, str]
+            The given job ID from a bash submission to SLURM.
+        filelist: List[pathlib.Path]
+            Files whose existence marks the job as sucessful.
+
+        Keyword Arguments
+        -----------------
+        name : Optional[str]
+            Name or Type of job submitted to SLURM for tracking / monitering purposes
+
+        Returns
+        -------
+        Future
+            Resolves to the final job status, either "complete" or "failed".
+        """
+        future: Future = Future()
+        with self._lock:
+            self._jobs.append(
+                {
+                    "job_ID": str(job_ID),
+                    "filelist": filelist,
+                    "name": name,
+                    "status": "waiting",
+                    "checks": 0,
+                    "future": future,
+                }
+            )
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return future
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                if not self._jobs:
+                    self._thread = None
+                    return
+                jobs = list(self._jobs)
+            try:
+                finished = self.poll(jobs)
+            except Exception as e:
+                print(f"Job watcher error: {e}")
+                continue
+            done = {id(job) for job in finished}
+            with self._lock:
+                self._jobs = [job for job in self._jobs if id(job) not in done]
+            for job in finished:
+                job["future"].set_result(job["status"])
+
+    def poll(self, jobs: List[dict]) -> List[dict]:
+        """Runs a single check over `jobs` and returns the jobs that have finished."""
+        queued = job_queue_states([job["job_ID"] for job in jobs])
+        if queued is None:
+            # SLURM could not be reached this tick, try again on the next one
+            return []
+
+        finished, missing = _update_jobs(jobs, queued)
+        if missing:
+            accounted = job_accounting_states([job["job_ID"] for job in missing])
+            finished += _fail_missing_jobs(missing, accounted, self.max_checks)
+        return finished
+
+
+def _update_jobs(
+    jobs: List[dict], queued: Dict[str, str]
+) -> Tuple[List[dict], List[dict]]:
+    """Returns the jobs whose files all exist and the jobs missing from the queue."""
+    finished, missing = [], []
+    for job in jobs:
+        job["checks"] += 1
+        if all([os.path.isfile(f) for f in job["filelist"]]):
+            job["status"] = "complete"
+            print(f"Job: {job['job_ID']} {job['name']} is complete!")
+            finished.append(job)
+        elif job["job_ID"] in queued:
+            if job["status"] != "running":
+                print(f"Job: {job['job_ID']} {job['name']} is running")
+            job["status"] = "running"
+        else:
+            missing.append(job)
+    return finished, missing
+
+
+def _fail_missing_jobs(
+    missing: List[dict], accounted: Dict[str, str], max_checks: int
+) -> List[dict]:
+    """Returns the jobs of `missing` that have failed."""
+    failed = []
+    for job in missing:
+        if (
+            accounted.get(job["job_ID"]) in SLURM_FAILED_STATES
+            or job["checks"] > max_checks
+        ):
+            job["status"] = "failed"
+            print(f"Job: {job['job_ID']} {job['name']} has failed!")
+            failed.append(job)
+    return failed
+
+
+_job_watcher: Optional[SlurmJobWatcher] = None
+_job_watcher_lock = threading.Lock()
+
+
+def get_job_watcher() -> SlurmJobWatcher:
+    """Returns the process wide `SlurmJobWatcher`, creating it on first use."""
+    global _job_watcher
+    with _job_watcher_lock:
+        if _job_watcher is None:
+            _job_watcher = SlurmJobWatcher()
+        return _job_watcher
+
+
+def job_complete_check(
+    job_ID: Union[int, str],
+    filelist: List[pathlib.Path],
+    name: str = "",
+) -> str:
+    """Provides a tool to check job status of SLURM Job ID. The job is registered with the
+    shared `SlurmJobWatcher` and this call blocks until it has either completed or failed,
+    see `SlurmJobWatcher` for how Job Status is Dictated.
 
     Parameters
     ----------
-    job_ID: int
+    job_ID: Union[int, str]
         The given job ID from a bash submission to SLURM. This is used to check SLURM's
         running queue and determine when the job is no longer in queue (Either Failed or Sucess)
-    endfile: pathlib.Path
-        `endfile` is our sucess indicator. After 'job_ID' is no longer in SLURM's queue, we confirm the
-        process was sucessful with the existence of `endfile`. If the file does not exist after an
+    filelist: List[pathlib.Path]
+        `filelist` is our sucess indicator. After 'job_ID' is no longer in SLURM's queue, we confirm the
+        process was sucessful with the existence of every file in `filelist`. If the files do not exist after an
         extended time the job is marked as failed
 
     Keyword Arguments
     -----------------
     name : Optional[str]
         Name or Type of job submitted to SLURM for tracking / monitering purposes
+
+    Returns
+    -------
+    str
+        The final job status, either "complete" or "failed".
     """
+    return get_job_watcher().watch(job_ID, filelist, name).result()
 
-    job_status = "waiting"  # Status Code
-    count = 0  # Runtime Counter
 
-    # Main Logic Loop: waiting for file to exist or maximum wait-time reached.
-    while (not all([os.path.isfile(f) for f in filelist])) and (
-        job_status != "complete"
-    ):
+def wait_for_job(
+    job_ID: Union[int, str],
+    filelist: List[pathlib.Path],
+    name: str = "",
+):
+    """Blocks like `job_complete_check` but raises if the job failed, so a failed stage stops
+    the image's pipeline instead of being picked up by the next stage.
 
-        # Wait between checks
-        time.sleep(3)
+    Raises
+    ------
+    RuntimeError
+        If the job failed.
+    """
+    if job_complete_check(job_ID, filelist, name) == "failed":
+        raise RuntimeError(f"Job: {job_ID} {name} has failed!")
 
-        # Initial check to see if job was ever added to queue, Sometimes this can take a bit.
-        if (not (job_in_queue_check(job_ID))) and (job_status == "waiting"):
-            job_status = "waiting"
-            print("waiting")
 
-        # If the job is in the queue (running) prints "Job; <Number> <Name> is running"
-        elif job_in_queue_check(job_ID):
-            job_status = "running"
-            print(f"Job: {job_ID} {name} is running")
+def job_queue_states(job_IDs: List[str]) -> Optional[Dict[str, str]]:
+    """Looks up every job in `job_IDs` with a single `squeue` call.
 
-            # Once job is in the queue the loop will continue printing running until
-            # the job is no longer in the queue. Then the next logic statements come
-            # into play to determine if the run was sucessful
+    Parameters
+    ----------
+    job_IDs: List[str]
+        Job IDs to look up. Array tasks may be given as `<job>_<task>`.
 
-        elif not all([os.path.isfile(f) for f in filelist]) and count > 1000:
-            # This logic is only reached if the process ran and is no longer in the queue
-            # Counts to 600 to wait and see if the output file gets created. If it doesnt then
-            # prints that the job has failed and breaks out of the loop.
+    Returns
+    -------
+    Optional[Dict[str, str]]
+        Maps each queued job ID to its SLURM state. Array tasks are listed both under
+        `<job>_<task>` and `<job>`. None if SLURM could not be reached.
+    """
+    output = subprocess.run(_squeue_command(job_IDs), capture_output=True)
+    return _queue_states(output.returncode, output.stdout, output.stderr)
 
-            job_status = "failed"
-            print(f"Job: {job_ID} {name} has failed!")
-            break
 
-        # The final statement confirming if the process was sucessful.
-        elif all([os.path.isfile(f) for f in filelist]):
-            job_status = "complete"
-            print(f"Job: {job_ID} {name} is complete!")
+def job_accounting_states(job_IDs: List[str]) -> Dict[str, str]:
+    """Looks up the accounting state of every job in `job_IDs` with a single `sacct` call.
 
-        count = count + 1  # Runtime Increase
+    Parameters
+    ----------
+    job_IDs: List[str]
+        Job IDs to look up. Array tasks may be given as `<job>_<task>`.
+
+    Returns
+    -------
+    Dict[str, str]
+        Maps each job ID known to SLURM accounting to its state. Empty if accounting is not
+        available.
+    """
+    output = subprocess.run(_sacct_command(job_IDs), capture_output=True)
+    return _accounting_states(output.returncode, output.stdout)
 
 
-# Function that checks if a current job ID is in the squeue. Returns True if it is and False if it isnt.
-def job_in_queue_check(job_ID: int):
+def _squeue_command(job_IDs: List[str]) -> List[str]:
+    return ["squeue", "-h", "-r", "-o", "%i %T", "-j", ",".join(job_IDs)]
+
+
+def _sacct_command(job_IDs: List[str]) -> List[str]:
+    return ["sacct", "-n", "-X", "-P", "-o", "JobID,State", "-j", ",".join(job_IDs)]
+
+
+def _queue_states(
+    returncode: int, stdout: bytes, stderr: bytes
+) -> Optional[Dict[str, str]]:
+    if returncode != 0:
+        # squeue errors out when none of the requested jobs are known anymore
+        if "Invalid job id" in stderr.decode("utf-8"):
+            return {}
+        return None
+    return _parse_job_states(stdout.decode("utf-8"), " ")
+
+
+def _accounting_states(returncode: int, stdout: bytes) -> Dict[str, str]:
+    if returncode != 0:
+        return {}
+    return _parse_job_states(stdout.decode("utf-8"), "|")
 
-    """Checks if a given `job_ID` is in SLURM queue.
+
+def _parse_job_states(output: str, separator: str) -> Dict[str, str]:
+    states = {}
+    for line in output.splitlines():
+        if separator not in line:
+            continue
+        job, state = line.strip().split(separator, 1)
+        # sacct reports states such as "CANCELLED by 1234"
+        state = state.split(" ")[0]
+        states[job] = state
+        states.setdefault(job.split("_")[0], state)
+    return states
+
+
+# Function that checks if a current job ID is in the squeue. Returns True if it is and False if it isnt.
+def job_in_queue_check(job_ID: Union[int, str]) -> bool:
+    """Checks if a given `job_ID` is in SLURM queue. Uses the same `squeue` lookup as the
+    `SlurmJobWatcher`, prefer `job_queue_states` to check many jobs at once.
 
     Parameters
     ----------
-    job_ID: int
-        The given job ID from a bash submission to SLURM.
+    job_ID: Union[int, str]
+        The given job ID from a bash submission to SLURM. Array tasks may be given as
+        `<job>_<task>`.
+
+    Returns
+    -------
+    bool
+        True while the job is queued or running.
     """
-    output = subprocess.run(
-        ["squeue", "-j", f"{job_ID}"], check=True, capture_output=True
-    )
+    queued = job_queue_states([str(job_ID)])
+    if queued is None:
+        raise RuntimeError(f"SLURM could not be reached to check job {job_ID}")
+    return str(job_ID) in queued
 
-    # The output of subprocess is an array turned into a string so in order to
-    # count the number of entries we count the frequency of "\n" to show if the
-    # array was not empty, indicating the job is in the queue.
 
-    return output.stdout.decode("utf-8").count("\n") >= 2
+# FMS ID key and file type of every file uploaded per image, in argument order of `upload`
+FMS_UPLOADS = (
+    ("RawCeligoFMSId", "Tiff Image"),
+    ("ProbabilitiesMapFMSId", "Probability Map"),
+    ("OutlinesFMSId", "Outline PNG"),
+)
 
 
 def upload(
@@ -288,10 +965,11 @@ def upload(
     probabilities_image_path: pathlib.Path,
     outlines_image_path: pathlib.Path,
     env: str = "stg",
+    executor: Optional[Executor] = None,
+    raw_upload: Optional[Future] = None,
 ) -> dict:
-
     """Provides wrapped process for FMS upload. Throughout the Celigo pipeline there are a few files
-    We want to preserve in FMS.
+    We want to preserve in FMS. The three files are uploaded in parallel.
 
     1) Original Image
 
@@ -312,29 +990,140 @@ def upload(
         name through `CeligoUploader`
     env: str
         The Allen institute environment you wish to submit your uploads to. Default is set to `stg` (Staging).
+    executor: Optional[Executor]
+        Executor to run the uploads on, e.g. to limit the number of concurrent uploads across images. By
+        default each call uploads its three files on its own threads.
+    raw_upload: Optional[Future]
+        Upload of the raw image that was already started (see `run_all`), resolving to its FMS ID.
+        The raw image is not uploaded again.
 
     Returns
     -------
     metadata: dictionary of FMS ID'S
     """
-    # Image types
-    raw_file_type = "Tiff Image"
-    probabilities_file_type = "Probability Map"
-    outlines_file_type = "Outline PNG"
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=len(FMS_UPLOADS)) as executor:
+            return upload(
+                raw_image_path,
+                probabilities_image_path,
+                outlines_image_path,
+                env,
+                executor,
+                raw_upload,
+            )
+
+    return _upload_result(
+        _submit_uploads(
+            executor,
+            [raw_image_path, probabilities_image_path, outlines_image_path],
+            env,
+            raw_upload,
+        ),
+        probabilities_image_path,
+        outlines_image_path,
+    )
 
-    metadata = {}
 
-    metadata["RawCeligoFMSId"] = CeligoUploader(
-        raw_image_path, raw_file_type, env=env
-    ).upload()
+def upload_batch(
+    images: List[Tuple[pathlib.Path, pathlib.Path, pathlib.Path]],
+    env: str = "stg",
+    max_workers: int = 8,
+) -> List[Union[dict, Exception]]:
+    """Uploads the files of many images to FMS, at most `max_workers` files at a time.
+
+    Parameters
+    ----------
+    images: List[Tuple[pathlib.Path, pathlib.Path, pathlib.Path]]
+        Raw image, probability map and outlines Path of every image, as passed to `upload`.
+    env: str
+        The Allen institute environment you wish to submit your uploads to. Default is set to `stg` (Staging).
+    max_workers: int
+        Maximum number of concurrent uploads. Default is set to 8.
+
+    Returns
+    -------
+    List[Union[dict, Exception]]
+        The dictionary of FMS ID's of every image, in the order of `images`, or the exception
+        raised by its uploads if any of them failed.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        uploads = [_submit_uploads(executor, list(paths), env) for paths in images]
+        results = []  # type: List[Union[dict, Exception]]
+        for futures, (_, probabilities_image_path, outlines_image_path) in zip(
+            uploads, images
+        ):
+            try:
+                results.append(
+                    _upload_result(
+                        futures, probabilities_image_path, outlines_image_path
+                    )
+                )
+            except Exception as e:
+                results.append(e)
+    return results
+
+
+def _submit_uploads(
+    executor: Executor,
+    paths: List[pathlib.Path],
+    env: str,
+    raw_upload: Optional[Future] = None,
+) -> Dict[str, Future]:
+    return {
+        key: (
+            raw_upload
+            if raw_upload is not None and key == "RawCeligoFMSId"
+            else executor.submit(_upload_file, path, file_type, env)
+        )
+        for (key, file_type), path in zip(FMS_UPLOADS, paths)
+    }
+
+
+def _start_raw_upload(
+    image: CeligoImage,
+    env: str,
+    executor: Executor,
+    store: Optional[RunStateStore] = None,
+) -> Optional[Future]:
+    """Starts uploading the raw image of `image` on `executor`. With a `store` the FMS ID is
+    checkpointed as soon as the upload finishes, and an image whose raw image was uploaded in
+    a previous run is not uploaded again. Returns None if every file of the image has already
+    been uploaded.
+    """
+    record = store.get(image.raw_image_path) if store is not None else None
+    if RunStateStore.reached(record, "uploaded"):
+        return None
+
+    future: Future = Future()
+    fms_IDs = (record or {}).get("fms_IDs") or {}
+    if "RawCeligoFMSId" in fms_IDs:
+        future.set_result(fms_IDs["RawCeligoFMSId"])
+        return future
+
+    def upload_raw() -> str:
+        fms_ID = _upload_file(image.raw_image_path, FMS_UPLOADS[0][1], env)
+        if store is not None:
+            # Checkpointed before the future resolves, so it never overwrites later checkpoints
+            store.update(image.raw_image_path, fms_IDs={"RawCeligoFMSId": fms_ID})
+        return fms_ID
+
+    return executor.submit(upload_raw)
+
+
+def _upload_file(path: pathlib.Path, file_type: str, env: str) -> str:
+    from aics_pipeline_uploaders import (
+        CeligoUploader,
+    )
+
+    return CeligoUploader(path, file_type, env=env).upload()
 
-    metadata["ProbabilitiesMapFMSId"] = CeligoUploader(
-        probabilities_image_path, probabilities_file_type, env=env
-    ).upload()
 
-    metadata["OutlinesFMSId"] = CeligoUploader(
-        outlines_image_path, outlines_file_type, env=env
-    ).upload()
+def _upload_result(
+    futures: Dict[str, Future],
+    probabilities_image_path: pathlib.Path,
+    outlines_image_path: pathlib.Path,
+) -> dict:
+    metadata = {key: future.result() for key, future in futures.items()}
 
     # If no new output directory, remove files
     if (
@@ -353,7 +1142,16 @@ def run_all_dir(
     env: str = "stg",
     env_vars: str = f"/home/{pwd.getpwuid(os.getuid())[0]}/.env",
     export_location_path: str = "/allen/aics/microscopy/brian_whitney/temp_output",
-):
+    use_job_arrays: bool = False,
+    batch_ilastik: bool = False,
+    batch_cellprofiler: bool = False,
+    state_path: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+    scratch: bool = False,
+    max_connections: int = 8,
+    batch_metrics: bool = False,
+    replace_metrics: bool = False,
+) -> Dict[str, str]:
     """Process Celigo Images from a directory (`dir_path`) and all sub directories  in batches. Submits jobs for Images Downsampling,
     Images Ilastik Processing, and Images Celigo Processing. After job completion,
     Images Metrics are uploaded to an external database.
@@ -364,41 +1162,255 @@ def run_all_dir(
         Path must point to a Directory. Path must be accessable
         from SLURM (ISILON[OK])
     chunk_size: int
-        Size of each Batch to run simultaniously. Default is set to 30. For 6 well it is reccomended that you
-        overwrite this number (3-5).
+        Maximum number of images processed simultaniously, the next image starts as soon as any image finishes.
+        Default is set to 30. For 6 well it is reccomended that you overwrite this number (3-5).
     env: str
         The Allen institute environment you wish to submit your uploads to. Default is set to `stg` (Staging).
     env_vars: str
         Path to a .env file containing database credentials. Default is set to users home directory.
     export_location_path: str
         If the user wants to export the output files of the pipeline they can specify a output directory here.
+    use_job_arrays: bool
+        If True every stage is submitted once for all images of the same type as a SLURM job array, with
+        `chunk_size` as the maximum number of array tasks running simultaniously.
+    batch_ilastik: bool
+        If True Ilastik runs once for all images of the same type instead of once per image. Implies
+        `use_job_arrays` for the other stages.
+    batch_cellprofiler: bool
+        If True Cell Profiler runs once for all images of the same type instead of once per image. Implies
+        `use_job_arrays` for the other stages.
+    state_path: Optional[str]
+        SQLite file to checkpoint the progress of every image in, so that a failed run can be
+        continued with `resume`. Not supported with job arrays or batching.
+    cache_dir: Optional[str]
+        Directory of a `StageCache` shared between runs, images whose outputs are cached are not
+        processed again. Not supported with job arrays or batching.
+    scratch: bool
+        If True the SLURM stages stage their inputs on node local scratch ($TMPDIR), run there and
+        copy only their outputs back, verified by checksum.
+    max_connections: int
+        Maximum number of database connections shared by all images. Default is set to 8.
+    batch_metrics: bool
+        If True the metrics of many images are inserted in one transaction by a `MetricsSink`
+        instead of one transaction per image. Not supported with `state_path`.
+    replace_metrics: bool
+        If True the metrics of every image replace those of a previous run instead of being
+        appended, e.g. when a directory is reprocessed.
+
+    Returns
+    -------
+    Dict[str, str]
+        The final status of every processed image, keyed by image path.
     """
-    processes = []
     start = time.perf_counter()
 
-    # loop through all files
-    for subdir, _, files in os.walk(dir_path):
-        for files in list(split(files, chunk_size)):
-            for file in files:
-                if "350000" in file and "escale" not in file:
-                    path = f"{subdir}/{file}"
-                    p = multiprocessing.Process(
-                        target=run_all, args=[path, env, env_vars, export_location_path]
-                    )
-                    p.start()
-                    processes.append(p)
-                else:
-                    continue
+    if (state_path is not None or cache_dir is not None) and (
+        use_job_arrays or batch_ilastik or batch_cellprofiler
+    ):
+        raise ValueError(
+            "state_path and cache_dir are not supported with job arrays or batching"
+        )
+    if state_path is not None and batch_metrics:
+        raise ValueError("batch_metrics is not supported with state_path")
+    cache = StageCache(cache_dir) if cache_dir is not None else None
+    metrics_sink = MetricsSink() if batch_metrics else None
 
-            for process in processes:
-                process.join()
+    # Every image borrows its connections from one pool
+    _load_environment(env_vars)
+    get_connection_pool(max_connections)
+
+    # loop through all files
+    paths = [
+        f"{subdir}/{file}"
+        for subdir, _, files in os.walk(dir_path)
+        for file in files
+        if "350000" in file and "escale" not in file
+    ]
+
+    if use_job_arrays or batch_ilastik or batch_cellprofiler:
+        results = _run_all_arrays(
+            paths,
+            chunk_size,
+            env,
+            env_vars,
+            export_location_path,
+            batch_ilastik,
+            batch_cellprofiler,
+            scratch,
+            metrics_sink,
+            replace_metrics,
+        )
+    else:
+        results = {}
+
+        # Keeps `chunk_size` images in flight. Threads share one SlurmJobWatcher, so all
+        # images in flight are polled with a single squeue call per tick
+        with ThreadPoolExecutor(max_workers=chunk_size) as executor:
+            futures = {
+                executor.submit(
+                    run_all,
+                    path,
+                    env,
+                    env_vars,
+                    export_location_path,
+                    state_path=state_path,
+                    cache=cache,
+                    scratch=scratch,
+                    metrics_sink=metrics_sink,
+                    replace_metrics=replace_metrics,
+                ): path
+                for path in paths
+            }
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    results[path] = future.result()
+                except Exception as e:
+                    results[path] = "Failed"
+                    print(f"Error: {path} {e}")
+
+    if metrics_sink is not None:
+        _apply_metrics_failures(results, metrics_sink.close())
 
     finish = time.perf_counter()
 
     print(f"Finished in {round(finish-start,2)} second(s)")
+    return results
+
+
+def _run_all_arrays(
+    paths: List[str],
+    throttle: int,
+    env: str,
+    env_vars: str,
+    export_location_path: str,
+    batch_ilastik: bool = False,
+    batch_cellprofiler: bool = False,
+    scratch: bool = False,
+    metrics_sink: Optional[MetricsSink] = None,
+    replace_metrics: bool = False,
+) -> Dict[str, str]:
+    """Processes `paths` with one `CeligoBatch` per image type, then finishes every image
+    as soon as its Cell Profiler outputs are available, at most `throttle` images at a time.
+    Returns the final status of every image, keyed by image path.
+    """
+    if not os.path.exists(export_location_path):
+        raise FileNotFoundError(f"{export_location_path} does not exist!")
+    export_location = Path(export_location_path)
+
+    _load_environment(env_vars)
+
+    # Metadata of the whole directory is parsed while SLURM processes the images, with its
+    # own workers so it never takes the place of an image being finished
+    threading.Thread(target=get_metadata_batch, args=[paths], daemon=True).start()
+
+    # Group images by table, which is also grouping them by image type. An image that
+    # can't be prepared fails on its own, the rest of the directory is still processed
+    results = {}
+    batches: Dict[str, List[CeligoImage]] = {}
+    for path in paths:
+        try:
+            image, table = _create_image(path, env, scratch)
+        except Exception as e:
+            results[path] = "Failed"
+            send_slack_notification_on_failure(
+                file_name=Path(path).name, error=str(e), env_vars=env_vars
+            )
+            _record_status(Path(path), "Failed", None, error=e)
+            print(f"Error: {path} {e}")
+            continue
+        batches.setdefault(table, []).append(image)
+
+    # At most `throttle` images are finished at once, like the images in flight of
+    # `run_all_dir`, which bounds the CSV reads and FMS uploads running at the same time
+    futures, celigo_batches = {}, []
+    executor = ThreadPoolExecutor(max_workers=max(throttle, 1))
+    # Raw images are uploaded while SLURM processes them, on their own workers so the uploads
+    # never hold up finishing images whose outputs are ready
+    uploads = ThreadPoolExecutor(max_workers=max(throttle, 1))
+
+    for table, images in batches.items():
+        batch = CeligoBatch(images, throttle=throttle)
+        celigo_batches.append(batch)
+        (
+            job_IDs,
+            ilastik_output_file_paths,
+            cellprofiler_output_file_paths,
+        ) = batch.submit_chain(batch_ilastik, batch_cellprofiler)
+
+        if batch_cellprofiler:
+            split: Future = Future()
+            threading.Thread(
+                target=_split_when_complete, args=[batch, job_IDs[-1], split]
+            ).start()
+
+        for index, image in enumerate(images):
+            if batch_cellprofiler:
+                run_stages = partial(
+                    _wait_for_split,
+                    split,
+                    ilastik_output_file_paths[index],
+                    cellprofiler_output_file_paths[index],
+                )
+            else:
+                run_stages = partial(
+                    _wait_for_outputs,
+                    batch.task_ID(job_IDs[-1], index),
+                    ilastik_output_file_paths[index],
+                    cellprofiler_output_file_paths[index],
+                )
+            future = executor.submit(
+                _process_image,
+                image,
+                table,
+                run_stages,
+                env,
+                env_vars,
+                export_location,
+                raw_upload=_start_raw_upload(image, env, uploads),
+                metrics_sink=metrics_sink,
+                replace_metrics=replace_metrics,
+            )
+            futures[future] = str(image.raw_image_path)
+
+    for future in as_completed(futures):
+        try:
+            results[futures[future]] = future.result()
+        except Exception as e:
+            results[futures[future]] = "Failed"
+            print(f"Error: {futures[future]} {e}")
+    executor.shutdown()
+    uploads.shutdown()
+
+    for batch in celigo_batches:
+        batch.cleanup()
+
+    return results
+
+
+def _split_when_complete(batch: CeligoBatch, job_ID: int, split: Future):
+    try:
+        wait_for_job(
+            job_ID,
+            list(
+                {
+                    batch.cell_profiler_output_path / path.name
+                    for outputs in batch.cellprofiler_output_file_paths
+                    for path in outputs
+                }
+            ),
+            "cell profiler",
+        )
+        batch.split_cellprofiler_outputs()
+        split.set_result(None)
+    except Exception as e:
+        split.set_exception(e)
 
 
-# Funciton for generating chunks from an array
-def split(list_a, chunk_size):
-    for i in range(0, len(list_a), chunk_size):
-        yield list_a[i : i + chunk_size]
+def _wait_for_split(
+    split: Future,
+    ilastik_output_file_path: Path,
+    cellprofiler_output_file_paths: List[Path],
+) -> Tuple[Path, List[Path]]:
+    split.result()
+    return ilastik_output_file_path, cellprofiler_output_file_paths
@@ -0,0 +1,142 @@
+from datetime import datetime
+import json
+from pathlib import Path
+import sqlite3
+import threading
+from typing import (
+    List,
+    Optional,
+    Union,
+)
+
+# Checkpoints of an image, in the order they are reached
+STAGES = (
+    "created",
+    "submitted",
+    "processed",
+    "metrics",
+    "exported",
+    "uploaded",
+    "complete",
+)
+
+# Columns holding lists / dicts, stored as JSON
+_JSON_COLUMNS = ("job_IDs", "cellprofiler_output_file_paths", "fms_IDs")
+
+_COLUMNS = (
+    "raw_image_path",
+    "stage",
+    "status",
+    "env",
+    "export_location",
+    "job_IDs",
+    "ilastik_output_file_path",
+    "cellprofiler_output_file_paths",
+    "metrics_index",
+    "fms_IDs",
+    "error",
+    "started",
+    "updated",
+)
+
+
+class RunStateStore:
+    """Records the progress of every image in a local SQLite file so that a run can be
+    resumed from the last checkpoint of each image (see `resume`) instead of reprocessing
+    from the raw image.
+
+    Every image has one record, keyed by its raw image path, holding the last stage it
+    reached (one of `STAGES`), its SLURM job IDs, output paths, the metrics index and FMS IDs
+    and when it was started and last updated. The store can be shared between threads.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        """Constructor.
+
+        Parameters
+        ----------
+        path : Union[str, pathlib.Path]
+            SQLite file of the store, created if it does not exist.
+        """
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "raw_image_path TEXT PRIMARY KEY, "
+                + ", ".join(f"{column} TEXT" for column in _COLUMNS[1:])
+                + ")"
+            )
+
+    def get(self, raw_image_path: Union[str, Path]) -> Optional[dict]:
+        """Returns the record of `raw_image_path`, or None if the image is unknown."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM images WHERE raw_image_path = ?", (str(raw_image_path),)
+            ).fetchone()
+        return None if row is None else self._decode(row)
+
+    def update(self, raw_image_path: Union[str, Path], **fields):
+        """Creates or updates the record of `raw_image_path` with `fields`.
+
+        Parameters
+        ----------
+        raw_image_path : Union[str, pathlib.Path]
+            Raw image the record belongs to.
+        **fields
+            Columns to set, any of `stage`, `status`, `env`, `export_location`, `job_IDs`,
+            `ilastik_output_file_path`, `cellprofiler_output_file_paths`, `metrics_index`,
+            `fms_IDs` and `error`.
+        """
+        now = datetime.now().isoformat()
+        values = {
+            column: (
+                json.dumps(value, default=str)
+                if column in _JSON_COLUMNS
+                else None if value is None else str(value)
+            )
+            for column, value in fields.items()
+        }
+        values["updated"] = now
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO images (raw_image_path, started) VALUES (?, ?)",
+                (str(raw_image_path), now),
+            )
+            self._conn.execute(
+                "UPDATE images SET "
+                + ", ".join(f"{column} = ?" for column in values)
+                + " WHERE raw_image_path = ?",
+                (*values.values(), str(raw_image_path)),
+            )
+
+    def incomplete(self) -> List[dict]:
+        """Returns the records of every image that has not reached the `complete` stage."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM images WHERE stage IS NOT 'complete' ORDER BY started"
+            ).fetchall()
+        return [self._decode(row) for row in rows]
+
+    @staticmethod
+    def reached(record: Optional[dict], stage: str) -> bool:
+        """Returns True if `record` has reached (or passed) `stage`."""
+        return (
+            record is not None
+            and record.get("stage") is not None
+            and STAGES.index(record["stage"]) >= STAGES.index(stage)
+        )
+
+    def close(self):
+        self._conn.close()
+
+    @staticmethod
+    def _decode(row: sqlite3.Row) -> dict:
+        record = dict(row)
+        for column in _JSON_COLUMNS:
+            if record[column] is not None:
+                record[column] = json.loads(record[column])
+        return record
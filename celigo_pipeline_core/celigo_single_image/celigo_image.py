@@ -1,8 +1,94 @@
 import abc
+from concurrent.futures import Executor, Future
+from pathlib import Path
 import shutil
+import subprocess
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from ..celigo_metadata import get_metadata
+from ..celigo_metrics_sink import MetricsSink
+
+# Rendered script and output Path(s) of downsampling, Ilastik and Cell Profiler
+Stages = Tuple[Tuple[Path, Path], Tuple[Path, Path], Tuple[Path, List[Path]]]
+
+
+def sbatch(
+    script_path: Path,
+    dependency: Optional[Union[int, str]] = None,
+    dependency_type: str = "afterok",
+) -> int:
+    """Submits `script_path` to SLURM and returns its job ID.
+
+    Parameters
+    ----------
+    script_path: pathlib.Path
+        Path to the rendered SLURM script.
+    dependency: Optional[Union[int, str]]
+        SLURM job ID that this job depends on. If the dependency can never be satisfied
+        (e.g. the job failed) SLURM cancels this job.
+    dependency_type: str
+        SLURM dependency type, default is `afterok` (start after the job completed sucessfully).
+    """
+    output = subprocess.run(
+        sbatch_command(script_path, dependency, dependency_type),
+        check=True,
+        capture_output=True,
+    )
+    return parse_job_ID(output.stdout)
+
+
+def sbatch_command(
+    script_path: Path,
+    dependency: Optional[Union[int, str]] = None,
+    dependency_type: str = "afterok",
+) -> List[str]:
+    """Returns the `sbatch` command line that submits `script_path`, see `sbatch`."""
+    command = ["sbatch"]
+    if dependency is not None:
+        command += [
+            f"--dependency={dependency_type}:{dependency}",
+            "--kill-on-invalid-dep=yes",
+        ]
+    return command + [str(script_path)]
+
+
+def parse_job_ID(stdout: bytes) -> int:
+    """Returns the job ID from the output of `sbatch` ("Submitted batch job <ID>")."""
+    return int(stdout.decode("utf-8").split(" ")[-1][:-1])
 
 
 class CeligoImage:
+
+    # Memory requested from SLURM for each stage
+    memory: Dict[str, str] = {}
+
+    # Ilastik headless run script, renders one or more images
+    ilastik_template = ""
+
+    # Run the stage scripts on node local scratch ($TMPDIR) and copy only their outputs back
+    scratch = False
+
+    # Metadata of the raw image, see `parse_metadata`
+    _metadata: Optional[Future] = None
+
+    # Set by the constructor of every image type
+    raw_image_path: Path
+    image_path: Path
+    working_dir: Path
+    rescale_pipeline_path: Path
+    cellprofiler_pipeline_path: Path
+
+    # Set while the stage scripts are rendered
+    filelist_path: Path
+    stage_outputs: List[List[Path]]
+
     def __init__(self):
         self.type = CeligoImage
 
@@ -12,18 +98,194 @@ class CeligoImage:
         """
         shutil.rmtree(self.working_dir)
 
+    def parse_metadata(self, executor: Optional[Executor] = None) -> Future:
+        """Parses the metadata of the raw image from its file name with `CeligoUploader`,
+        once per image (and once per process through `get_metadata`).
+
+        Parameters
+        ----------
+        executor: Optional[Executor]
+            If given the metadata is parsed in the background on `executor`, otherwise right
+            away. Only used by the first call.
+
+        Returns
+        -------
+        Future
+            Resolves to the `CeligoUploader` of the raw image.
+        """
+        if self._metadata is None:
+            if executor is not None:
+                self._metadata = executor.submit(get_metadata, self.raw_image_path)
+            else:
+                self._metadata = Future()
+                try:
+                    self._metadata.set_result(get_metadata(self.raw_image_path))
+                except Exception as e:
+                    self._metadata.set_exception(e)
+        return self._metadata
+
+    def submit_chain(
+        self, resume: bool = False, cache=None
+    ) -> Tuple[List[int], Path, List[Path]]:
+        """Submits downsampling, Ilastik and Cell Profiler to SLURM at once. Each job
+        depends on the previous one finishing sucessfully (`afterok`), so SLURM starts every
+        stage as soon as its predecessor is done and only the final job needs to be watched.
+        If a stage fails the jobs depending on it are cancelled by SLURM.
+
+        Parameters
+        ----------
+        resume: bool
+            If True stages are only submitted from the first stage whose outputs do not all
+            exist yet, e.g. from a previous run in the same working directory. No job is
+            submitted if every output exists.
+        cache: Optional[StageCache]
+            If given, the outputs of stages found in the cache are restored instead of being
+            computed. Implies `resume`.
+
+        Returns
+        -------
+        tuple[list[int],pathlib.Path,list[pathlib.Path]]
+            The SLURM job IDs of the submitted stages, the Ilastik probability map Path and the
+            Cell Profiler output Paths.
+        """
+        stages = self.prepare_chain()
+        if cache is not None:
+            cache.restore_chain(self, stages)
+            resume = True
+
+        start = first_missing_stage(stages) if resume else 0
+
+        job_IDs = []  # type: List[int]
+        for script_path, _ in stages[start:]:
+            job_IDs.append(sbatch(script_path, job_IDs[-1] if job_IDs else None))
+
+        return job_IDs, stages[1][1], stages[2][1]
+
+    def prepare_chain(self, render: bool = True) -> Stages:
+        """Renders the scripts of all three stages without submitting them. Also restores
+        the paths the image tracks between stages, e.g. when resuming a previous run.
+
+        Parameters
+        ----------
+        render: bool
+            If False nothing is staged or rendered, only the paths are restored, e.g. while
+            the jobs of a previous run are still queued or running. Default is True.
+
+        Returns
+        -------
+        Stages
+            The rendered script Path and the output Path(s) of downsampling, Ilastik and Cell
+            Profiler.
+        """
+        stages = (
+            self.prepare_downsample(render),
+            self.prepare_ilastik(render),
+            self.prepare_cellprofiler(render),
+        )
+        self.stage_outputs = [_as_list(outputs) for _, outputs in stages]
+        return stages
+
+    def stage_recipes(self) -> List[List[Union[Path, str]]]:
+        """Returns what determines the outputs of downsampling, Ilastik and Cell Profiler
+        besides the raw image: pipeline files and the names of the templates rendering the
+        stage scripts. Used to key the `StageCache`.
+        """
+        return [
+            [self.rescale_pipeline_path, "resize_cellprofiler_template.j2"],
+            [self.ilastik_template],
+            [self.cellprofiler_pipeline_path, "cellprofiler_template.j2"],
+        ]
+
+    def downsample(self, dependency: Optional[int] = None) -> Tuple[int, Path]:
+        """downsample raw images for higher processing speed and streamlining of
+        later steps
+
+        Parameters
+        ----------
+        dependency: Optional[int]
+            SLURM job ID that has to complete sucessfully before this job starts.
+
+        Returns
+        -------
+        tuple[int,pathlib.Path]
+            A list of namedtuples, The first of which being the SLURM job ID and the second
+            being the desired output Path.
+        """
+        script_path, output_path = self.prepare_downsample()
+        return sbatch(script_path, dependency), output_path
+
+    def run_ilastik(self, dependency: Optional[int] = None) -> Tuple[int, Path]:
+        """Applies the Ilastik Pipeline processing to the downsampled image to
+        produce a Probability map of the prior image.
+
+        Parameters
+        ----------
+        dependency: Optional[int]
+            SLURM job ID that has to complete sucessfully before this job starts.
+
+        Returns
+        -------
+        tuple[int,pathlib.Path]
+            A list of namedtuples, The first of which being the SLURM job ID and the second
+            being the desired output Path.
+        """
+        script_path, output_path = self.prepare_ilastik()
+        return sbatch(script_path, dependency), output_path
+
+    def run_cellprofiler(
+        self, dependency: Optional[int] = None
+    ) -> Tuple[int, List[Path]]:
+        """Applies the Cell Profiler Pipeline processing to the downsampled image using the Ilastik
+        probabilities to produce a outlined cell profile and a series of metrics
+
+        Parameters
+        ----------
+        dependency: Optional[int]
+            SLURM job ID that has to complete sucessfully before this job starts.
+
+        Returns
+        -------
+        tuple[int,list[pathlib.Path]]
+            A list of namedtuples, The first of which being the SLURM job ID and the second
+            being the desired output Paths.
+        """
+        script_path, output_paths = self.prepare_cellprofiler()
+        return sbatch(script_path, dependency), output_paths
+
     @abc.abstractmethod
-    def downsample(self):
+    def prepare_downsample(self, render: bool = True) -> Tuple[Path, Path]:
         pass
 
     @abc.abstractmethod
-    def run_ilastik(self):
+    def prepare_ilastik(self, render: bool = True) -> Tuple[Path, Path]:
         pass
 
     @abc.abstractmethod
-    def run_cellprofiler(self):
+    def prepare_cellprofiler(self, render: bool = True) -> Tuple[Path, List[Path]]:
         pass
 
     @abc.abstractmethod
-    def upload_metrics(self, conn, table: str) -> str:
+    def upload_metrics(
+        self,
+        conn,
+        table: str,
+        sink: Optional[MetricsSink] = None,
+        replace: bool = False,
+    ) -> str:
         pass
+
+
+def first_missing_stage(stages: Sequence[Tuple[Path, Union[Path, List[Path]]]]) -> int:
+    """Returns the index of the first of `stages` (as returned by `prepare_chain`) whose
+    outputs do not all exist, or `len(stages)` if every output exists.
+    """
+    start = 0
+    while start < len(stages) and all(
+        path.exists() for path in _as_list(stages[start][1])
+    ):
+        start += 1
+    return start
+
+
+def _as_list(paths: Union[Path, List[Path]]) -> List[Path]:
+    return paths if isinstance(paths, list) else [paths]
@@ -2,15 +2,26 @@ import importlib.resources as pkg_resources
 import os
 from pathlib import Path
 import pwd
-import shutil
-import subprocess
-
-from aics_pipeline_uploaders import CeligoUploader
-from jinja2 import Environment, PackageLoader
-import pandas as pd
+from typing import List, Optional, Tuple, Union
 
 from .. import pipelines
-from ..postgres_db_functions import add_to_table
+from ..celigo_metrics_archive import (
+    archive_configured_metrics,
+)
+from ..celigo_metrics_io import (
+    merge_image_data,
+    read_metrics_csv,
+)
+from ..celigo_metrics_sink import MetricsSink
+from ..celigo_staging import stage_file
+from ..celigo_templates import (
+    render_cached,
+    render_template,
+)
+from ..postgres_db_functions import (
+    add_to_table,
+    get_table_columns,
+)
 from .celigo_image import CeligoImage
 
 
@@ -20,14 +31,20 @@ class CeligoSingleImageCore(CeligoImage):
 
     """
 
+    # Memory requested from SLURM for each stage
+    memory = {"downsample": "6G", "ilastik": "12G", "cellprofiler": "12G"}
+
+    # Ilastik headless run script, renders one or more images
+    ilastik_template = "ilastik_template.j2"
+
     def __init__(self, raw_image_path: str) -> None:
         """Constructor.
 
         Parameters
         ----------
         raw_image_path : str
-            Raw celigo image path. This path is used to copy a version of the image to SLURM for
-            processing.
+            Raw celigo image path. The image is linked (or copied) into a working directory on
+            SLURM for processing.
         """
 
         # Directory Name, used to create working directory.
@@ -42,11 +59,8 @@ class CeligoSingleImageCore(CeligoImage):
             f"/home/{pwd.getpwuid(os.getuid())[0]}/{self.tempdirname}"
         )
 
-        # Copying Image to working directory.
+        # Image path in the working directory, the image is staged by `prepare_downsample`
         self.raw_image_path = Path(raw_image_path)
-        shutil.copyfile(
-            self.raw_image_path, f"{self.working_dir}/{self.raw_image_path.name}"
-        )
         self.image_path = Path(f"{self.working_dir}/{self.raw_image_path.name}")
 
         # Creating pipeline paths for templates
@@ -55,68 +69,67 @@ class CeligoSingleImageCore(CeligoImage):
         with pkg_resources.path(pipelines, "colonymorphology.model") as p:
             self.classification_model_path = p
 
-        # Creating template for 96 well processing
+        # Creating template for 96 well processing, rendered once and shared by every image
         script_config = {
             "classifier_path": str(self.classification_model_path.parent),
         }
-        jinja_env = Environment(
-            loader=PackageLoader(
-                package_name="celigo_pipeline_core", package_path="templates"
-            )
-        )
-        script_body = jinja_env.get_template("96_well_pipeline_v2_tempalate.j2").render(
-            script_config
-        )
-        with open(self.working_dir / "96_well_colony_pipeline_v2.cppipe", "w+") as rsh:
-            rsh.write(script_body)
-        self.cellprofiler_pipeline_path = (
-            self.working_dir / "96_well_colony_pipeline_v2.cppipe"
+        self.cellprofiler_pipeline_path = render_cached(
+            "96_well_pipeline_v2_tempalate.j2",
+            script_config,
+            "96_well_colony_pipeline_v2.cppipe",
         )
 
-    def downsample(self):
-        """downsample raw images for higher processing speed and streamlining of
-        later steps
+    def stage_recipes(self) -> List[List[Union[Path, str]]]:
+        """Returns the recipes of `CeligoImage.stage_recipes` with the colony classifier added
+        to Cell Profiler. The rendered pipeline only names the directory of the classifier, so
+        a new model with the same pipeline would otherwise hit outputs of the old one.
+        """
+        recipes = super().stage_recipes()
+        recipes[2].append(self.classification_model_path)
+        return recipes
+
+    def prepare_downsample(self, render: bool = True) -> Tuple[Path, Path]:
+        """Renders the SLURM script that downsamples raw images for higher processing speed
+        and streamlining of later steps
+
+        Parameters
+        ----------
+        render: bool
+            If False the paths are returned without writing anything. Default is True.
 
         Returns
         -------
-        tuple[int,pathlib.Path]
-            A list of namedtuples, The first of which being the SLURM job ID and the second
-            being the desired output Path.
+        tuple[pathlib.Path,pathlib.Path]
+            The rendered script Path and the desired output Path.
         """
 
-        # Generates filelist for resize pipeline
-        with open(self.working_dir / "resize_filelist.txt", "w+") as rfl:
-            rfl.write(str(self.image_path) + "\n")
+        if render:
+            # Links (or copies) the raw image into the working directory
+            stage_file(self.raw_image_path, self.image_path)
+
+            # Generates filelist for resize pipeline
+            with open(self.working_dir / "resize_filelist.txt", "w+") as rfl:
+                rfl.write(str(self.image_path) + "\n")
         self.resize_filelist_path = self.working_dir / "resize_filelist.txt"
 
         # Defines variables for bash script
         script_config = {
-            "memory": "6G",
+            "memory": self.memory["downsample"],
             "filelist_path": str(self.resize_filelist_path),
             "output_path": str(self.working_dir),
             "pipeline_path": str(self.rescale_pipeline_path),
+            "scratch": self.scratch,
         }
 
-        # Generates script_body from existing templates.
-        jinja_env = Environment(
-            loader=PackageLoader(
-                package_name="celigo_pipeline_core", package_path="templates"
+        if render:
+            # Generates script_body from existing templates.
+            script_body = render_template(
+                "resize_cellprofiler_template.j2", script_config
             )
-        )
-        script_body = jinja_env.get_template("resize_cellprofiler_template.j2").render(
-            script_config
-        )
 
-        # Creates bash script locally.
-        with open(self.working_dir / "resize.sh", "w+") as rsh:
-            rsh.write(script_body)
-
-        # Runs resize on slurm
-        output = subprocess.run(
-            ["sbatch", f"{str(self.working_dir)}/resize.sh"],
-            check=True,
-            capture_output=True,
-        )
+            # Creates bash script locally.
+            with open(self.working_dir / "resize.sh", "w+") as rsh:
+                rsh.write(script_body)
 
         # Sets path to resized image to image path for future use
         self.image_path = (
@@ -124,64 +137,62 @@ class CeligoSingleImageCore(CeligoImage):
             / f"{self.image_path.with_suffix('').name}_rescale.tiff"
         )
 
-        job_ID = int(output.stdout.decode("utf-8").split(" ")[-1][:-1])
-        return job_ID, self.image_path
+        return self.working_dir / "resize.sh", self.image_path
+
+    def prepare_ilastik(self, render: bool = True) -> Tuple[Path, Path]:
+        """Renders the SLURM script that applies the Ilastik Pipeline processing to the
+        downsampled image to produce a Probability map of the prior image.
 
-    def run_ilastik(self):
-        """Applies the Ilastik Pipeline processing to the downsampled image to
-        produce a Probability map of the prior image.
+        Parameters
+        ----------
+        render: bool
+            If False the paths are returned without writing anything. Default is True.
 
         Returns
         -------
-        tuple[int,pathlib.Path]
-            A list of namedtuples, The first of which being the SLURM job ID and the second
-            being the desired output Path.
+        tuple[pathlib.Path,pathlib.Path]
+            The rendered script Path and the desired output Path.
         """
 
         # Parameters to input to bash script template
         script_config = {
-            "memory": "12G",
+            "memory": self.memory["ilastik"],
             "image_path": f"'{str( self.image_path)}'",
             "output_path": f"'{str(self.image_path.with_suffix(''))}_probabilities.tiff'",
+            "output_suffix": "_probabilities.tiff",
+            "scratch": self.scratch,
         }
 
-        # Generates script for SLURM submission from templates.
-        jinja_env = Environment(
-            loader=PackageLoader(
-                package_name="celigo_pipeline_core", package_path="templates"
-            )
-        )
-        script_body = jinja_env.get_template("ilastik_template.j2").render(
-            script_config
-        )
-        with open(self.working_dir / "ilastik.sh", "w+") as rsh:
-            rsh.write(script_body)
-
-        # Submit bash script ilastik.sh on SLURM
-        output = subprocess.run(
-            ["sbatch", f"{str(self.working_dir)}/ilastik.sh"],
-            check=True,
-            capture_output=True,
-        )
+        if render:
+            # Generates script for SLURM submission from templates.
+            script_body = render_template(self.ilastik_template, script_config)
+            with open(self.working_dir / "ilastik.sh", "w+") as rsh:
+                rsh.write(script_body)
 
-        # Creates filelist.txt
-        with open(self.working_dir / "filelist.txt", "w+") as rfl:
-            rfl.write(str(self.image_path) + "\n")
-            rfl.write(str(self.image_path.with_suffix("")) + "_probabilities.tiff")
+            # Creates filelist.txt
+            with open(self.working_dir / "filelist.txt", "w+") as rfl:
+                rfl.write(str(self.image_path) + "\n")
+                rfl.write(str(self.image_path.with_suffix("")) + "_probabilities.tiff")
 
         self.filelist_path = self.working_dir / "filelist.txt"
-        job_ID = int(output.stdout.decode("utf-8").split(" ")[-1][:-1])
-        return job_ID, Path(f"{self.image_path.with_suffix('')}_probabilities.tiff")
+        return self.working_dir / "ilastik.sh", Path(
+            f"{self.image_path.with_suffix('')}_probabilities.tiff"
+        )
 
-    def run_cellprofiler(self):
-        """Applies the Cell Profiler Pipeline processing to the downsampled image using the Ilastik
-        probabilities to produce a outlined cell profile and a series of metrics
+    def prepare_cellprofiler(self, render: bool = True) -> Tuple[Path, List[Path]]:
+        """Renders the SLURM script that applies the Cell Profiler Pipeline processing to the
+        downsampled image using the Ilastik probabilities to produce a outlined cell profile
+        and a series of metrics
+
+        Parameters
+        ----------
+        render: bool
+            If False the paths are returned without writing anything. Default is True.
 
         Returns
         -------
-        tuple[int,pathlib.Path]
-            A list of namedtuples, The first of which being the SLURM job ID and the second
-            being the desired output Path.
+        tuple[pathlib.Path,list[pathlib.Path]]
+            The rendered script Path and the desired output Paths.
         """
 
         # Parameters to input to bash script template.
@@ -189,36 +200,21 @@ class CeligoSingleImageCore(CeligoImage):
             "filelist_path": str(self.filelist_path),
             "output_dir": str(self.working_dir / "cell_profiler_outputs"),
             "pipeline_path": str(self.cellprofiler_pipeline_path),
-            "memory": "12G",
+            "memory": self.memory["cellprofiler"],
+            "scratch": self.scratch,
         }
 
-        # Generates script for SLURM submission from templates.
-        jinja_env = Environment(
-            loader=PackageLoader(
-                package_name="celigo_pipeline_core", package_path="templates"
-            )
-        )
-        script_body = jinja_env.get_template("cellprofiler_template.j2").render(
-            script_config
-        )
-        with open(self.working_dir / "cellprofiler.sh", "w+") as rsh:
-            rsh.write(script_body)
-
-        # Submit bash script cellprofiler.sh on SLURM
-        output = subprocess.run(
-            ["sbatch", f"{str(self.working_dir)}/cellprofiler.sh"],
-            check=True,
-            capture_output=True,
-        )
+        if render:
+            # Generates script for SLURM submission from templates.
+            script_body = render_template("cellprofiler_template.j2", script_config)
+            with open(self.working_dir / "cellprofiler.sh", "w+") as rsh:
+                rsh.write(script_body)
 
         # Set output path
         self.cell_profiler_output_path = self.working_dir / "cell_profiler_outputs"
 
-        # Splits job id int from output
-        job_ID = int(output.stdout.decode("utf-8").split(" ")[-1][:-1])
-
         return (
-            job_ID,
+            self.working_dir / "cellprofiler.sh",
             [
                 Path(
                     f"{script_config['output_dir']}/{self.image_path.with_suffix('').name}_outlines.png"
@@ -231,7 +227,13 @@ class CeligoSingleImageCore(CeligoImage):
             ],
         )
 
-    def upload_metrics(self, conn, table: str) -> str:
+    def upload_metrics(
+        self,
+        conn,
+        table: str,
+        sink: Optional[MetricsSink] = None,
+        replace: bool = False,
+    ) -> str:
         """Uploads the metrics from the cell profiler pipeline run and comnbines them with
         the Images Metadata. Then Uploads metrics to postgres database.
 
@@ -244,23 +246,38 @@ class CeligoSingleImageCore(CeligoImage):
             There are many tables in the Microscopy DB. This parameter specifies which table
             to insert metrics into.
 
+        sink: Optional[MetricsSink]
+            If given the metrics are added to `sink` and inserted with the metrics of other
+            images, instead of being inserted right away.
+
+        replace: bool
+            If True the metrics replace those of a previous run of the image (same Experiment ID)
+            instead of being appended, e.g. when an image is reprocessed.
+
         Returns
         -------
         self.raw_image_path.name
             returns the original files name. This return is used to index 'table_name' in the
             future in order to insert additional metrics.
         """
-        celigo_image = CeligoUploader(self.raw_image_path, file_type="temp")
+        celigo_image = self.parse_metadata().result()
         metadata = celigo_image.metadata["microscopy"]
 
-        # Building Metric Output from Cellprofiler outputs
-        ColonyDATA = pd.read_csv(self.cell_profiler_output_path / "ColonyDATA.csv")
-        ImageDATA = pd.read_csv(self.cell_profiler_output_path / "ImageDATA.csv")
+        # Building Metric Output from Cellprofiler outputs, reading only the table's columns
+        columns = get_table_columns(table, conn)
+        ColonyDATA = read_metrics_csv(
+            self.cell_profiler_output_path / "ColonyDATA.csv",
+            columns,
+            keep=["ImageNumber"],
+            exclude="Metadata",
+        )
+        ImageDATA = read_metrics_csv(
+            self.cell_profiler_output_path / "ImageDATA.csv",
+            columns,
+            keep=["ImageNumber"],
+        )
 
         # formatting
-        ColonyDATA = ColonyDATA[
-            ColonyDATA.columns.drop(list(ColonyDATA.filter(regex="Metadata")))
-        ]
         ColonyDATA["Metadata_DateString"] = (
             metadata["celigo"]["scan_date"] + " " + metadata["celigo"]["scan_time"]
         )
@@ -269,9 +286,21 @@ class CeligoSingleImageCore(CeligoImage):
         ColonyDATA["Experiment ID"] = self.raw_image_path.name
         ColonyDATA["row"] = int(celigo_image.row) - 1
         ColonyDATA["col"] = int(celigo_image.col) - 1
-        result = pd.merge(ColonyDATA, ImageDATA, how="left", on="ImageNumber")
-        result = result.drop(columns=["ImageNumber"])
-
-        add_to_table(conn, result, table)
+        result = merge_image_data(ColonyDATA, ImageDATA)
+
+        mode = "replace" if replace else "append"
+        if sink is not None:
+            sink.add(self.raw_image_path.name, table, result, mode=mode)
+        else:
+            add_to_table(conn, result, table, mode=mode)
+
+        # Columnar copy of the metrics for analysis, if an archive is configured
+        archive_configured_metrics(
+            result,
+            table,
+            metadata["plate_barcode"],
+            metadata["celigo"]["scan_date"],
+            self.raw_image_path.name,
+        )
 
         return self.raw_image_path.name
@@ -2,17 +2,20 @@ import importlib.resources as pkg_resources
 import os
 from pathlib import Path
 import pwd
-import shutil
-import subprocess
-
-from aics_pipeline_uploaders import CeligoUploader
-from jinja2 import Environment, PackageLoader
-from lkaccess import LabKey
-import lkaccess.contexts
-import pandas as pd
+from typing import List, Optional, Tuple
 
 from .. import pipelines
-from ..postgres_db_functions import add_to_table
+from ..celigo_metrics_archive import (
+    archive_configured_metrics,
+)
+from ..celigo_metrics_io import read_metrics_csv
+from ..celigo_metrics_sink import MetricsSink
+from ..celigo_staging import stage_file
+from ..celigo_templates import render_template
+from ..postgres_db_functions import (
+    add_to_table,
+    get_table_columns,
+)
 from .celigo_image import CeligoImage
 
 
@@ -22,18 +25,28 @@ class CeligoSixWellCore(CeligoImage):
 
     """
 
+    # Memory requested from SLURM for each stage
+    memory = {"downsample": "80G", "ilastik": "60G", "cellprofiler": "50G"}
+
+    # Ilastik headless run script, renders one or more images
+    ilastik_template = "6_well_ilastik_template.j2"
+
     def __init__(self, raw_image_path: str, env: str = "stg") -> None:
         """Constructor.
 
         Parameters
         ----------
         raw_image_path : str
-            Raw celigo image path. This path is used to copy a version of the image to SLURM for
-            processing.
+            Raw celigo image path. The image is linked (or copied) into a working directory on
+            SLURM for processing.
         """
 
         # Directory Name, used to create working directory.
         self.tempdirname = Path(raw_image_path).with_suffix("").name
+
+        from lkaccess import LabKey
+        import lkaccess.contexts
+
         if env == "prod":
             self.lk = LabKey(server_context=lkaccess.contexts.PROD)
         elif env == "stg":
@@ -50,11 +63,8 @@ class CeligoSixWellCore(CeligoImage):
             f"/home/{pwd.getpwuid(os.getuid())[0]}/{self.tempdirname}"
         )
 
-        # Copying Image to working directory.
+        # Image path in the working directory, the image is staged by `prepare_downsample`
         self.raw_image_path = Path(raw_image_path)
-        shutil.copyfile(
-            self.raw_image_path, f"{self.working_dir}/{self.raw_image_path.name}"
-        )
         self.image_path = Path(f"{self.working_dir}/{self.raw_image_path.name}")
 
         # Creating pipeline paths for templates
@@ -67,50 +77,48 @@ class CeligoSixWellCore(CeligoImage):
         ) as p:
             self.cellprofiler_pipeline_path = p
 
-    def downsample(self):
-        """downsample raw images for higher processing speed and streamlining of
-        later steps
+    def prepare_downsample(self, render: bool = True) -> Tuple[Path, Path]:
+        """Renders the SLURM script that downsamples raw images for higher processing speed
+        and streamlining of later steps
+
+        Parameters
+        ----------
+        render: bool
+            If False the paths are returned without writing anything. Default is True.
 
         Returns
         -------
-        tuple[int,pathlib.Path]
-            A list of namedtuples, The first of which being the SLURM job ID and the second
-            being the desired output Path.
+        tuple[pathlib.Path,pathlib.Path]
+            The rendered script Path and the desired output Path.
         """
 
-        # Generates filelist for resize pipeline
-        with open(self.working_dir / "resize_filelist.txt", "w+") as rfl:
-            rfl.write(str(self.image_path) + "\n")
+        if render:
+            # Links (or copies) the raw image into the working directory
+            stage_file(self.raw_image_path, self.image_path)
+
+            # Generates filelist for resize pipeline
+            with open(self.working_dir / "resize_filelist.txt", "w+") as rfl:
+                rfl.write(str(self.image_path) + "\n")
         self.resize_filelist_path = self.working_dir / "resize_filelist.txt"
 
         # Defines variables for bash script
         script_config = {
-            "memory": "80G",
+            "memory": self.memory["downsample"],
             "filelist_path": str(self.resize_filelist_path),
             "output_path": str(self.working_dir),
             "pipeline_path": str(self.rescale_pipeline_path),
+            "scratch": self.scratch,
         }
 
-        # Generates script_body from existing templates.
-        jinja_env = Environment(
-            loader=PackageLoader(
-                package_name="celigo_pipeline_core", package_path="templates"
+        if render:
+            # Generates script_body from existing templates.
+            script_body = render_template(
+                "resize_cellprofiler_template.j2", script_config
             )
-        )
-        script_body = jinja_env.get_template("resize_cellprofiler_template.j2").render(
-            script_config
-        )
 
-        # Creates bash script locally.
-        with open(self.working_dir / "resize.sh", "w+") as rsh:
-            rsh.write(script_body)
-
-        # Runs resize on slurm
-        output = subprocess.run(
-            ["sbatch", f"{str(self.working_dir)}/resize.sh"],
-            check=True,
-            capture_output=True,
-        )
+            # Creates bash script locally.
+            with open(self.working_dir / "resize.sh", "w+") as rsh:
+                rsh.write(script_body)
 
         # Sets path to resized image to image path for future use
         self.image_path = (
@@ -118,64 +126,62 @@ class CeligoSixWellCore(CeligoImage):
             / f"{self.image_path.with_suffix('').name}_RescaleAndCrop.tiff"
         )
 
-        job_ID = int(output.stdout.decode("utf-8").split(" ")[-1][:-1])
-        return job_ID, self.image_path
+        return self.working_dir / "resize.sh", self.image_path
+
+    def prepare_ilastik(self, render: bool = True) -> Tuple[Path, Path]:
+        """Renders the SLURM script that applies the Ilastik Pipeline processing to the
+        downsampled image to produce a Probability map of the prior image.
 
-    def run_ilastik(self):
-        """Applies the Ilastik Pipeline processing to the downsampled image to
-        produce a Probability map of the prior image.
+        Parameters
+        ----------
+        render: bool
+            If False the paths are returned without writing anything. Default is True.
 
         Returns
         -------
-        tuple[int,pathlib.Path]
-            A list of namedtuples, The first of which being the SLURM job ID and the second
-            being the desired output Path.
+        tuple[pathlib.Path,pathlib.Path]
+            The rendered script Path and the desired output Path.
         """
 
         # Parameters to input to bash script template
         script_config = {
-            "memory": "60G",
+            "memory": self.memory["ilastik"],
             "image_path": f"'{str( self.image_path)}'",
             "output_path": f"'{str(self.image_path.with_suffix(''))}_Probabilities.tiff'",
+            "output_suffix": "_Probabilities.tiff",
+            "scratch": self.scratch,
         }
 
-        # Generates script for SLURM submission from templates.
-        jinja_env = Environment(
-            loader=PackageLoader(
-                package_name="celigo_pipeline_core", package_path="templates"
-            )
-        )
-        script_body = jinja_env.get_template("6_well_ilastik_template.j2").render(
-            script_config
-        )
-        with open(self.working_dir / "ilastik.sh", "w+") as rsh:
-            rsh.write(script_body)
-
-        # Submit bash script ilastik.sh on SLURM
-        output = subprocess.run(
-            ["sbatch", f"{str(self.working_dir)}/ilastik.sh"],
-            check=True,
-            capture_output=True,
-        )
+        if render:
+            # Generates script for SLURM submission from templates.
+            script_body = render_template(self.ilastik_template, script_config)
+            with open(self.working_dir / "ilastik.sh", "w+") as rsh:
+                rsh.write(script_body)
 
-        # Creates filelist.txt
-        with open(self.working_dir / "filelist.txt", "w+") as rfl:
-            rfl.write(str(self.image_path) + "\n")
-            rfl.write(str(self.image_path.with_suffix("")) + "_Probabilities.tiff")
+            # Creates filelist.txt
+            with open(self.working_dir / "filelist.txt", "w+") as rfl:
+                rfl.write(str(self.image_path) + "\n")
+                rfl.write(str(self.image_path.with_suffix("")) + "_Probabilities.tiff")
 
         self.filelist_path = self.working_dir / "filelist.txt"
-        job_ID = int(output.stdout.decode("utf-8").split(" ")[-1][:-1])
-        return job_ID, Path(f"{self.image_path.with_suffix('')}_Probabilities.tiff")
+        return self.working_dir / "ilastik.sh", Path(
+            f"{self.image_path.with_suffix('')}_Probabilities.tiff"
+        )
+
+    def prepare_cellprofiler(self, render: bool = True) -> Tuple[Path, List[Path]]:
+        """Renders the SLURM script that applies the Cell Profiler Pipeline processing to the
+        downsampled image using the Ilastik probabilities to produce a outlined cell profile
+        and a series of metrics
 
-    def run_cellprofiler(self):
-        """Applies the Cell Profiler Pipeline processing to the downsampled image using the Ilastik
-        probabilities to produce a outlined cell profile and a series of metrics
+        Parameters
+        ----------
+        render: bool
+            If False the paths are returned without writing anything. Default is True.
 
         Returns
         -------
-        tuple[int,pathlib.Path]
-            A list of namedtuples, The first of which being the SLURM job ID and the second
-            being the desired output Path.
+        tuple[pathlib.Path,list[pathlib.Path]]
+            The rendered script Path and the desired output Paths.
         """
 
         # Parameters to input to bash script template.
@@ -183,38 +189,21 @@ class CeligoSixWellCore(CeligoImage):
             "filelist_path": str(self.filelist_path),
             "output_dir": str(self.working_dir / "cell_profiler_outputs"),
             "pipeline_path": str(self.cellprofiler_pipeline_path),
-            "memory": "50G",
+            "memory": self.memory["cellprofiler"],
+            "scratch": self.scratch,
         }
 
-        # Generates script for SLURM submission from templates.
-        jinja_env = Environment(
-            loader=PackageLoader(
-                package_name="celigo_pipeline_core", package_path="templates"
-            )
-        )
-
-        script_body = jinja_env.get_template("cellprofiler_template.j2").render(
-            script_config
-        )
-
-        with open(self.working_dir / "cellprofiler.sh", "w+") as rsh:
-            rsh.write(script_body)
-
-        # Submit bash script cellprofiler.sh on SLURM
-        output = subprocess.run(
-            ["sbatch", f"{str(self.working_dir)}/cellprofiler.sh"],
-            check=True,
-            capture_output=True,
-        )
+        if render:
+            # Generates script for SLURM submission from templates.
+            script_body = render_template("cellprofiler_template.j2", script_config)
+            with open(self.working_dir / "cellprofiler.sh", "w+") as rsh:
+                rsh.write(script_body)
 
         # Set output path
         self.cell_profiler_output_path = self.working_dir / "cell_profiler_outputs"
 
-        # Splits job id int from output
-        job_ID = int(output.stdout.decode("utf-8").split(" ")[-1][:-1])
-
         return (
-            job_ID,
+            self.working_dir / "cellprofiler.sh",
             [
                 Path(
                     f"{script_config['output_dir']}/{self.image_path.with_suffix('').name}_outlines.png"
@@ -223,7 +212,13 @@ class CeligoSixWellCore(CeligoImage):
             ],
         )
 
-    def upload_metrics(self, conn, table: str) -> str:
+    def upload_metrics(
+        self,
+        conn,
+        table: str,
+        sink: Optional[MetricsSink] = None,
+        replace: bool = False,
+    ) -> str:
         """Uploads the metrics from the cell profiler pipeline run and comnbines them with
         the Images Metadata. Then Uploads metrics to postgres database.
 
@@ -236,17 +231,33 @@ class CeligoSixWellCore(CeligoImage):
             There are many tables in the Microscopy DB. This parameter specifies which table
             to insert metrics into.
 
+        sink: Optional[MetricsSink]
+            If given the metrics are added to `sink` and inserted with the metrics of other
+            images, instead of being inserted right away.
+
+        replace: bool
+            If True the metrics replace those of a previous run of the image (same Experiment ID)
+            instead of being appended, e.g. when an image is reprocessed.
+
         Returns
         -------
         self.raw_image_path.name
             returns the original files name. This return is used to index 'table_name' in the
             future in order to insert additional metrics.
         """
-        celigo_image = CeligoUploader(self.raw_image_path, file_type="temp")
+        celigo_image = self.parse_metadata().result()
         self.metadata = celigo_image.metadata["microscopy"]
 
         # Building Metric Output from Cellprofiler outputs
-        ImageDATA = pd.read_csv(self.cell_profiler_output_path / "ImageDATA.csv")
+        ImageDATA = read_metrics_csv(
+            self.cell_profiler_output_path / "ImageDATA.csv",
+            get_table_columns(table, conn),
+            keep=[
+                "ImageNumber",
+                "AreaOccupied_AreaOccupied_Colony",
+                "AreaOccupied_AreaOccupied_WellObjects",
+            ],
+        )
 
         # formatting
         ImageDATA["Metadata_DateString"] = (
@@ -261,7 +272,20 @@ class CeligoSixWellCore(CeligoImage):
         ImageDATA["col"] = int(celigo_image.col) - 1
         result = ImageDATA.drop(columns=["ImageNumber"])
 
-        add_to_table(conn, result, table)
+        mode = "replace" if replace else "append"
+        if sink is not None:
+            sink.add(self.raw_image_path.name, table, result, mode=mode)
+        else:
+            add_to_table(conn, result, table, mode=mode)
+
+        # Columnar copy of the metrics for analysis, if an archive is configured
+        archive_configured_metrics(
+            result,
+            table,
+            self.metadata["plate_barcode"],
+            self.metadata["celigo"]["scan_date"],
+            self.raw_image_path.name,
+        )
 
         row = {
             "WellId": celigo_image.well_id,
@@ -0,0 +1,184 @@
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+from typing import (
+    Dict,
+    List,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from .celigo_single_image.celigo_image import (
+    CeligoImage,
+)
+from .celigo_staging import stage_file
+from .celigo_templates import template_source
+
+# Read size used when hashing raw images
+_CHUNK_SIZE = 1 << 20
+
+
+class StageCache:
+    """Content addressed cache of stage outputs, shared between runs. The outputs of each
+    stage are stored under a key that hashes the raw image together with everything that
+    determines the stage: the templates of the stage scripts (which name the Ilastik project)
+    and the Cell Profiler pipelines. The key of a stage also includes the key of the stage
+    before it, so a changed downsampling pipeline invalidates Ilastik and Cell Profiler too.
+
+    Re-running an image that is already in the cache restores its outputs into the working
+    directory instead of submitting SLURM jobs. Entries name their files by position in the
+    stage's outputs rather than after the image, so a duplicate scan under another file name
+    restores them too. The cache is bounded by `max_size`, the least recently used entries
+    are evicted first.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], max_size: int = 500 * 1024**3):
+        """Constructor.
+
+        Parameters
+        ----------
+        cache_dir : Union[str, pathlib.Path]
+            Directory holding the cache, created if it does not exist. Outputs are linked in
+            and out of the cache with `stage_file`, so it is best placed on the same file
+            system as the working directories.
+        max_size : int
+            Maximum size of the cache in bytes. Default is 500GB.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._image_hashes: Dict[Tuple[str, int, int], str] = {}
+
+    def stage_keys(self, image: CeligoImage) -> List[str]:
+        """Returns the cache key of downsampling, Ilastik and Cell Profiler for `image`."""
+        digest = hashlib.sha256(self.image_hash(image.raw_image_path).encode())
+        keys = []
+        for stage, recipe in zip(
+            ("downsample", "ilastik", "cellprofiler"), image.stage_recipes()
+        ):
+            digest.update(stage.encode())
+            for item in recipe:
+                if isinstance(item, Path):
+                    digest.update(item.read_bytes())
+                else:
+                    digest.update(template_source(item).encode())
+            keys.append(digest.hexdigest())
+        return keys
+
+    def image_hash(self, raw_image_path: Path) -> str:
+        """Returns the sha256 of the raw image, hashed once per file version."""
+        stat = os.stat(raw_image_path)
+        version = (str(raw_image_path), stat.st_size, stat.st_mtime_ns)
+        if version not in self._image_hashes:
+            digest = hashlib.sha256()
+            with open(raw_image_path, "rb") as f:
+                for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            self._image_hashes[version] = digest.hexdigest()
+        return self._image_hashes[version]
+
+    def restore_chain(
+        self,
+        image: CeligoImage,
+        stages: Sequence[Tuple[Path, Union[Path, List[Path]]]],
+    ) -> int:
+        """Restores the cached outputs of `stages` (as returned by `image.prepare_chain`),
+        from the first stage on, until a stage is not in the cache. Returns the number of
+        stages restored.
+        """
+        restored = 0
+        for key, (_, outputs) in zip(self.stage_keys(image), stages):
+            if not self.restore(key, _as_list(outputs)):
+                break
+            restored += 1
+        return restored
+
+    def store_chain(self, image: CeligoImage):
+        """Stores the outputs of every stage of `image` once its chain completed."""
+        for key, outputs in zip(self.stage_keys(image), image.stage_outputs):
+            self.store(key, outputs)
+        self.evict()
+
+    def restore(self, key: str, paths: List[Path]) -> bool:
+        """Links or copies the outputs cached under `key` to `paths`, the outputs of the
+        stage in the order they were stored. Returns False if the key is not in the cache.
+        """
+        entry = self.cache_dir / key
+        restored: List[Path] = []
+        try:
+            for index, path in enumerate(paths):
+                path.parent.mkdir(parents=True, exist_ok=True)
+                stage_file(entry / _entry_name(index), path, symlink=False)
+                restored.append(path)
+            # Mark as recently used
+            os.utime(entry)
+        except FileNotFoundError:
+            # Not cached, or evicted while it was restored. Files that were already linked
+            # stay valid, but an incomplete stage must not look complete
+            for path in restored:
+                if path.exists():
+                    path.unlink()
+            return False
+        return True
+
+    def store(self, key: str, paths: List[Path]):
+        """Stores `paths` under `key`, unless the key is already cached."""
+        entry = self.cache_dir / key
+        if entry.exists():
+            os.utime(entry)
+            return
+
+        # Fill a temporary entry first so a partially stored entry is never restored
+        staging = Path(tempfile.mkdtemp(prefix=".store_", dir=self.cache_dir))
+        try:
+            for index, path in enumerate(paths):
+                stage_file(path, staging / _entry_name(index), symlink=False)
+            os.rename(staging, entry)
+        except OSError:
+            # Stored concurrently by another image with the same key
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in `max_size`.
+
+        An entry is renamed out of the cache before it is deleted, so a concurrent `restore`
+        (of this or another process) sees either the whole entry or none of it.
+        """
+        with self._lock:
+            entries = []
+            for entry in self.cache_dir.iterdir():
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    size = sum(path.stat().st_size for path in entry.iterdir())
+                    entries.append((entry.stat().st_mtime, size, entry))
+                except FileNotFoundError:
+                    # Evicted by another process meanwhile
+                    continue
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total <= self.max_size:
+                    break
+                evicted = self.cache_dir / f".evict_{entry.name}_{os.getpid()}"
+                try:
+                    os.rename(entry, evicted)
+                except OSError:
+                    # Already evicted by another process
+                    continue
+                shutil.rmtree(evicted, ignore_errors=True)
+                total -= size
+
+
+def _entry_name(index: int) -> str:
+    """Returns the name of the `index`th output of a stage inside its cache entry."""
+    return f"output_{index}"
+
+
+def _as_list(paths: Union[Path, List[Path]]) -> List[Path]:
+    return paths if isinstance(paths, list) else [paths]
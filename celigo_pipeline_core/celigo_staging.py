@@ -0,0 +1,67 @@
+import fcntl
+import os
+from pathlib import Path
+import shutil
+from typing import Union
+
+# ioctl that clones (reflinks) a whole file on btrfs / XFS, see ioctl_ficlone(2)
+_FICLONE = 0x40049409
+
+
+def stage_file(
+    source: Union[str, Path], destination: Union[str, Path], symlink: bool = True
+) -> str:
+    """Makes the contents of `source` available at `destination` without copying when
+    possible. Tries, in order, a hard link, a reflink and a symlink and only falls back to a
+    streamed copy when none of them works. An existing `destination` is replaced.
+
+    Parameters
+    ----------
+    source: Union[str, pathlib.Path]
+        File to stage.
+    destination: Union[str, pathlib.Path]
+        Path to stage the file at.
+    symlink: bool
+        If False `destination` is never a symlink, use this when `source` may be removed while
+        `destination` is still in use (e.g. outputs copied out of a working directory).
+
+    Returns
+    -------
+    str
+        How the file was staged, one of "hardlink", "reflink", "symlink" or "copy".
+    """
+    source, destination = Path(source), Path(destination)
+    if not source.is_file():
+        raise FileNotFoundError(f"{source} does not exist!")
+    if destination.is_symlink() or destination.exists():
+        destination.unlink()
+
+    try:
+        os.link(source, destination)
+        return "hardlink"
+    except OSError:
+        pass
+
+    if _reflink(source, destination):
+        return "reflink"
+
+    if symlink:
+        try:
+            destination.symlink_to(source.resolve())
+            return "symlink"
+        except OSError:
+            pass
+
+    shutil.copyfile(source, destination)
+    return "copy"
+
+
+def _reflink(source: Path, destination: Path) -> bool:
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        return True
+    except OSError:
+        if destination.exists():
+            destination.unlink()
+        return False
@@ -0,0 +1,99 @@
+from functools import lru_cache
+import hashlib
+import os
+from pathlib import Path
+import pwd
+import tempfile
+from typing import Optional
+
+from jinja2 import (
+    Environment,
+    PackageLoader,
+    Template,
+)
+
+# Shared directory of rendered pipelines, reachable from SLURM like the working directories
+RENDER_CACHE_DIR = Path(f"/home/{pwd.getpwuid(os.getuid())[0]}/.celigo_pipeline_core")
+
+
+@lru_cache(maxsize=None)
+def get_environment(package_path: str = "templates") -> Environment:
+    """Returns the process wide Jinja environment of a template directory of the package.
+    Templates are compiled on first use and kept, the package's templates do not change
+    while it runs.
+    """
+    return Environment(
+        loader=PackageLoader(
+            package_name="celigo_pipeline_core", package_path=package_path
+        ),
+        auto_reload=False,
+    )
+
+
+def get_template(name: str, package_path: str = "templates") -> Template:
+    """Returns the compiled template `name` of a template directory of the package."""
+    return get_environment(package_path).get_template(name)
+
+
+def render_template(name: str, config: dict, package_path: str = "templates") -> str:
+    """Renders the template `name` of a template directory of the package with `config`."""
+    return get_template(name, package_path).render(config)
+
+
+@lru_cache(maxsize=None)
+def template_source(name: str, package_path: str = "templates") -> str:
+    """Returns the unrendered source of the template `name`."""
+    environment = get_environment(package_path)
+    if environment.loader is None:
+        raise ValueError(f"No template loader for {package_path}")
+    source, _, _ = environment.loader.get_source(environment, name)
+    return source
+
+
+def render_cached(
+    name: str,
+    config: dict,
+    file_name: str,
+    cache_dir: Optional[Path] = None,
+) -> Path:
+    """Renders the template `name` with `config` into a file shared by every image, e.g. a
+    Cell Profiler pipeline that only depends on the install, instead of once per image. The
+    file is named after `file_name` and a hash of the template source and `config`, so it is
+    written once per template version and configuration and then reused.
+
+    Parameters
+    ----------
+    name: str
+        Template to render.
+    config: dict
+        Values to render the template with.
+    file_name: str
+        Name of the rendered file, the hash is added before its suffix.
+    cache_dir: Optional[pathlib.Path]
+        Directory of the rendered files. Default is `RENDER_CACHE_DIR`.
+
+    Returns
+    -------
+    pathlib.Path
+        Path to the rendered file.
+    """
+    items = tuple(sorted((key, str(value)) for key, value in config.items()))
+    path = _rendered_path(name, items, file_name, Path(cache_dir or RENDER_CACHE_DIR))
+
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Rendered next to the destination first, so no image reads a partial file
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}", dir=path.parent)
+        with os.fdopen(fd, "w") as rendered:
+            rendered.write(render_template(name, config))
+        os.replace(tmp_path, path)
+    return path
+
+
+@lru_cache(maxsize=None)
+def _rendered_path(name: str, config: tuple, file_name: str, cache_dir: Path) -> Path:
+    digest = hashlib.sha256(template_source(name).encode())
+    digest.update(repr(config).encode())
+    return cache_dir / (
+        f"{Path(file_name).stem}_{digest.hexdigest()[:12]}{Path(file_name).suffix}"
+    )
@@ -4,9 +4,8 @@ import os
 import pwd
 
 from dotenv import load_dotenv
-from jinja2 import Environment, PackageLoader
-import slack
 
+from .celigo_templates import render_template
 from .postgres_db_functions import get_report_data
 
 
@@ -30,16 +29,12 @@ def send_slack_notification_on_failure(file_name: str, error: str, env_vars: str
         "error": error,
     }
 
-    jinja_env = Environment(
-        loader=PackageLoader(
-            package_name="celigo_pipeline_core", package_path="templates/slack"
-        )
+    message = render_template(
+        "celigo_failed_upload.j2", script_config, package_path="templates/slack"
     )
 
-    message = jinja_env.get_template("celigo_failed_upload.j2").render(script_config)
-
     blocks = json.loads(message)
-    client = slack.WebClient(token=os.getenv("CELIGO_SLACK_TOKEN"))
+    client = _slack_client()
     client.chat_postMessage(channel="#celigo-pipeline", blocks=blocks)
 
 
@@ -54,7 +49,7 @@ def slack_day_report(
     Parameters
     ----------
     conn
-        A psycopg2 database connection.
+        A psycopg2 database connection. If None a connection is borrowed from the shared pool.
     day: date
         The specific date to look at. Default is set to today's date
     env_vars: str
@@ -62,7 +57,7 @@ def slack_day_report(
 
     """
     load_dotenv(env_vars)
-    filename, df = get_report_data(conn, day)
+    filename, df = get_report_data(day, conn, env_vars)
     _ = df.to_csv(filename, index=False)
 
     script_config = {
@@ -72,15 +67,11 @@ def slack_day_report(
         "total_fails": df[df["Status"] == "Failed"]["Status"].count(),
     }
 
-    jinja_env = Environment(
-        loader=PackageLoader(
-            package_name="celigo_pipeline_core", package_path="templates/slack"
-        )
+    message = render_template(
+        "celigo_day_report.j2", script_config, package_path="templates/slack"
     )
-
-    message = jinja_env.get_template("celigo_day_report.j2").render(script_config)
     blocks = json.loads(message)
-    client = slack.WebClient(token=os.getenv("CELIGO_SLACK_TOKEN"))
+    client = _slack_client()
     client.chat_postMessage(channel="#celigo-pipeline", blocks=blocks)
     client.files_upload(
         channels="#celigo-pipeline",
@@ -105,7 +96,7 @@ def get_channel_emails(channel_id: str) -> list:
     emails: list
         list of channel emails
     """
-    client = slack.WebClient(token=os.getenv("CELIGO_SLACK_TOKEN"))
+    client = _slack_client()
     result = dict(client.conversations_members(channel=channel_id))
     emails = []
     for user in result["members"]:
@@ -115,6 +106,12 @@ def get_channel_emails(channel_id: str) -> list:
     return emails
 
 
+def _slack_client():
+    import slack
+
+    return slack.WebClient(token=os.getenv("CELIGO_SLACK_TOKEN"))
+
+
 """
 def email_daily_report_to_channel():
     emails = get_channel_emails(os.getenv("CELIGO_CHANNEL_ID"))
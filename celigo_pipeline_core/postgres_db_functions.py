@@ -1,11 +1,189 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
 from datetime import date
+import io
 import os
 import pwd
+import threading
+import time
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 from dotenv import load_dotenv
-import pandas as pd
 import psycopg2
 import psycopg2.extras as extras
+from psycopg2.pool import ThreadedConnectionPool
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+# Insert modes of `add_to_table`
+MODES = ("append", "upsert", "replace")
+
+# Columns of every table looked up by `get_table_columns`
+_table_columns: Dict[str, Dict[str, str]] = {}
+
+# Temporary table upserts are copied into before they are merged
+_STAGING_TABLE = '"celigo_upsert_staging"'
+
+
+class ConnectionPool:
+    """Thread safe pool of connections to the microscopy DB, shared by every worker of a run so
+    that the number of open connections stays within `max_size` no matter how many images are
+    processed at once. Borrowing blocks while every connection is in use.
+
+    Connections that have been idle for longer than `health_check_interval` are checked with
+    `SELECT 1` before they are handed out, broken connections are replaced.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 8,
+        health_check_interval: float = 30,
+        **connection_parameters,
+    ):
+        """Constructor.
+
+        Parameters
+        ----------
+        max_size: int
+            Maximum number of open connections. Default is 8.
+        health_check_interval: float
+            Seconds a connection may be idle before it is checked on borrow. Default is 30 seconds.
+        **connection_parameters
+            Passed to `psycopg2.connect`, defaults to the microscopy DB variables of the environment
+            (see `connection_parameters_from_env`).
+        """
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self._pool = _LazyConnectionPool(
+            max_size, **(connection_parameters or connection_parameters_from_env())
+        )
+        self._available = threading.BoundedSemaphore(max_size)
+        self._last_used: Dict[int, float] = {}
+
+    @contextmanager
+    def connection(self) -> Iterator:
+        """Borrows a healthy connection for the duration of the `with` block. An open
+        transaction is rolled back when the connection is returned.
+        """
+        with self._available:
+            conn = self._checkout()
+            try:
+                yield conn
+            finally:
+                self._checkin(conn)
+
+    def closeall(self):
+        self._pool.closeall()
+        self._last_used.clear()
+
+    def _checkout(self):
+        # Every broken connection is discarded, at most `max_size` of them are idle, so the
+        # last attempt always gets a newly opened connection, which is not checked
+        for _ in range(self.max_size):
+            conn = self._pool.getconn()
+            last_used = self._last_used.get(id(conn))
+            if last_used is None:
+                return conn
+            idle = time.monotonic() - last_used
+            if not conn.closed and (
+                idle <= self.health_check_interval or _healthy(conn)
+            ):
+                return conn
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+        return self._pool.getconn()
+
+    def _checkin(self, conn):
+        close = bool(conn.closed)
+        if not close:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+        if close:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        self._pool.putconn(conn, close=close)
+
+
+class _LazyConnectionPool(ThreadedConnectionPool):
+    """`ThreadedConnectionPool` that opens connections on first use, yet keeps up to `maxconn`
+    of them open once returned. psycopg2 opens `minconn` connections up front and closes
+    returned connections while `minconn` are idle, so neither behaviour fits `minconn` alone.
+    """
+
+    def __init__(self, maxconn: int, *args, **kwargs):
+        super().__init__(0, maxconn, *args, **kwargs)
+        # Past the constructor psycopg2 only reads `minconn` to decide whether a returned
+        # connection is kept open
+        self.minconn = maxconn
+
+
+def _healthy(conn) -> bool:
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def connection_parameters_from_env() -> Dict[str, Optional[str]]:
+    """Returns the `psycopg2.connect` parameters of the microscopy DB from the environment."""
+    return {
+        "database": os.getenv("MICROSCOPY_DB"),
+        "user": os.getenv("MICROSCOPY_DB_USER"),
+        "password": os.getenv("MICROSCOPY_DB_PASSWORD"),
+        "host": os.getenv("MICROSCOPY_DB_HOST"),
+        "port": os.getenv("MICROSCOPY_DB_PORT"),
+    }
+
+
+_connection_pool: Optional[ConnectionPool] = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool(max_size: int = 8) -> ConnectionPool:
+    """Returns the process wide `ConnectionPool`, creating it on first use. `max_size` only
+    applies to the call that creates the pool.
+    """
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = ConnectionPool(max_size=max_size)
+        return _connection_pool
+
+
+def close_connection_pool():
+    """Closes every connection of the process wide `ConnectionPool`."""
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is not None:
+            _connection_pool.closeall()
+            _connection_pool = None
+
+
+@contextmanager
+def borrow_connection(conn=None) -> Iterator:
+    """Yields `conn`, or a connection borrowed from the process wide pool if `conn` is None."""
+    if conn is not None:
+        yield conn
+    else:
+        with get_connection_pool().connection() as pooled:
+            yield pooled
 
 
 def add_FMS_IDs_to_SQL_table(
@@ -28,21 +206,53 @@ def add_FMS_IDs_to_SQL_table(
     metadata: dict
         List of metadata in form [KEY] : [VALUE] to be inserted into database.
     conn
-        A psycopg2 database connection.
+        A psycopg2 database connection. If None a connection is borrowed from the shared pool.
     index : str
         index defines the rows that the FMS ID's will be inserted into. In most cases this will be the Experiment ID,
         which is just the original filename.
     table: str
         Name of table in Postgres Database intended for import. Default is chosen by DEVS given current DB status
     """
+    # Set every FMS ID column in a single statement and transaction
+    assignments = ", ".join(f'"{key}" = %s' for key in metadata)
+    query = f'UPDATE {table} SET {assignments} WHERE "Experiment ID" = %s;'
+    with borrow_connection(conn) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, (*metadata.values(), index))
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            print("Error: %s" % error)
+            conn.rollback()
+            cursor.close()
+            return 1
 
-    # Connect to DB
-    cursor = conn.cursor()
-    # Submit Queries
-    for key in metadata:
-        query = f'UPDATE {table} SET "{key}" = %s WHERE "Experiment ID" = %s;'
+        cursor.close()
+
+
+def add_FMS_IDs_batch_to_SQL_table(
+    metadata: Dict[str, dict],
+    conn,
+    table: str,
+):
+    """Batch version of `add_FMS_IDs_to_SQL_table`, inserts the FMS IDs of many images with
+    one `UPDATE ... FROM (VALUES ...)` statement per set of FMS ID columns, all in a single
+    transaction.
+
+    Parameters
+    ----------
+    metadata: Dict[str, dict]
+        FMS IDs in form [KEY] : [VALUE] of every image, keyed by the index of the image
+        (the Experiment ID).
+    conn
+        A psycopg2 database connection. If None a connection is borrowed from the shared pool.
+    table: str
+        Name of table in Postgres Database intended for import.
+    """
+    with borrow_connection(conn) as conn:
+        cursor = conn.cursor()
         try:
-            cursor.execute(query, (metadata[key], index))
+            update_FMS_IDs(cursor, metadata, table)
             conn.commit()
         except (Exception, psycopg2.DatabaseError) as error:
             print("Error: %s" % error)
@@ -50,16 +260,52 @@ def add_FMS_IDs_to_SQL_table(
             cursor.close()
             return 1
 
-    cursor.close()
+        cursor.close()
+
+
+def update_FMS_IDs(cursor, metadata: Dict[str, dict], table: str):
+    """Sets the FMS IDs of many images within the open transaction of `cursor` (the caller
+    commits), with one `UPDATE ... FROM (VALUES ...)` statement per set of FMS ID columns.
+
+    Parameters
+    ----------
+    cursor
+        A psycopg2 cursor.
+    metadata: Dict[str, dict]
+        FMS IDs in form [KEY] : [VALUE] of every image, keyed by the index of the image
+        (the Experiment ID).
+    table: str
+        Name of table in Postgres Database intended for import.
+    """
+    # Images are grouped by their FMS ID columns, each group is one statement
+    groups: Dict[Tuple[str, ...], List[tuple]] = {}
+    for index, fms_IDs in metadata.items():
+        groups.setdefault(tuple(fms_IDs), []).append((index, *fms_IDs.values()))
 
+    for keys, rows in groups.items():
+        assignments = ", ".join(f'"{key}" = v."{key}"' for key in keys)
+        columns = ", ".join(f'"{key}"' for key in ("Experiment ID", *keys))
+        query = (
+            f"UPDATE {table} AS t SET {assignments} FROM (VALUES %s) AS v({columns}) "
+            'WHERE t."Experiment ID" = v."Experiment ID";'
+        )
+        extras.execute_values(cursor, query, rows, page_size=len(rows))
 
-def add_to_table(conn, metadata: pd.DataFrame, table: str):
+
+def add_to_table(
+    conn,
+    metadata: pd.DataFrame,
+    table: str,
+    method: str = "copy",
+    mode: str = "append",
+    key: Optional[Sequence[str]] = None,
+):
     """A function to insert a dateframe into a postgres database.
 
     Parameters
     ----------
     conn
-        A psycopg2 database connection.
+        A psycopg2 database connection. If None a connection is borrowed from the shared pool.
     metadata : pd.DataFrame
         The intended data to be inserted. This table is usually formatted
         by the upload_metrics funciton.
@@ -67,62 +313,307 @@ def add_to_table(conn, metadata: pd.DataFrame, table: str):
         The specific table you wish to insert metrics into. The table name
         needs to be within quotes inside the string in order to be processed
         correctly by the database.
+    method : str
+        "copy" streams the dataframe into the table as CSV with `COPY ... FROM STDIN`,
+        falling back to "values" (a multi row `INSERT` with `execute_values`) if the copy
+        fails. Default is "copy".
+    mode : str
+        "append" (default) inserts every row. "upsert" updates the rows whose `key` already
+        exists (`ON CONFLICT`), `key` must be a unique index of the table. "replace" first
+        deletes every row that shares its `key` with a row of the dataframe, e.g. the metrics
+        of a reprocessed image with the default key.
+    key : Optional[Sequence[str]]
+        Columns identifying a row. Required for "upsert", e.g. ("Experiment ID", "ObjectNumber")
+        for the metrics tables, which hold many rows per image (see `create_unique_key`).
+        Default for "replace" is ("Experiment ID",).
     """
-    metadata = metadata.add_suffix('"')
-    metadata = metadata.add_prefix('"')
-    tuples = [tuple(x) for x in metadata.to_numpy()]
+    if method not in ("copy", "values"):
+        raise ValueError(f"Unknown insert method: {method}")
+    key = _mode_key(mode, key)
 
+    metadata = _quote_columns(metadata)
     cols = ",".join(list(metadata.columns))
-    # SQL query to execute
-    query = "INSERT INTO %s(%s) VALUES %%s" % (table, cols)
-    cursor = conn.cursor()
-    try:
-        extras.execute_values(cursor, query, tuples)
-        conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print("Error: %s" % error)
-        conn.rollback()
+
+    with borrow_connection(conn) as conn:
+        if method == "copy":
+            try:
+                with conn.cursor() as cursor:
+                    write_rows(cursor, metadata, table, mode, key)
+                conn.commit()
+                return
+            except (Exception, psycopg2.DatabaseError) as error:
+                print("Copy Error: %s, falling back to insert into %s" % (error, table))
+                conn.rollback()
+
+        # SQL query to execute
+        query = "INSERT INTO %s(%s) VALUES %%s" % (table, cols)
+        if mode == "upsert":
+            query += _on_conflict(metadata, key)
+        tuples = [tuple(x) for x in metadata.to_numpy()]
+        cursor = conn.cursor()
+        try:
+            if mode == "replace":
+                _delete_keys(cursor, metadata, table, key)
+            extras.execute_values(cursor, query, tuples)
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            print("Error: %s" % error)
+            conn.rollback()
+            cursor.close()
+            return 1
         cursor.close()
-        return 1
-    cursor.close()
+
+
+def write_rows(
+    cursor,
+    metadata: pd.DataFrame,
+    table: str,
+    mode: str = "append",
+    key: Optional[Sequence[str]] = None,
+):
+    """Writes `metadata` into `table` with `COPY ... FROM STDIN` according to `mode` (see
+    `add_to_table`), within the open transaction of `cursor` (the caller commits). Upserts
+    are copied into a temporary table first and merged with a single `INSERT ... ON CONFLICT`.
+
+    Parameters
+    ----------
+    cursor
+        A psycopg2 cursor.
+    metadata : pd.DataFrame
+        The intended data to be inserted, columns are quoted if they are not already.
+    table : str
+        The specific table you wish to insert metrics into.
+    mode : str
+        One of "append", "upsert" and "replace". Default is "append".
+    key : Optional[Sequence[str]]
+        Columns identifying a row, required for "upsert". Default for "replace" is
+        ("Experiment ID",).
+    """
+    key = _mode_key(mode, key)
+    metadata = _quote_columns(metadata)
+    if mode == "replace":
+        _delete_keys(cursor, metadata, table, key)
+
+    if mode == "upsert":
+        cols = ",".join(list(metadata.columns))
+        # Only the column types are copied, so the columns the frame leaves out are nullable
+        cursor.execute(
+            f"CREATE TEMP TABLE {_STAGING_TABLE} AS SELECT {cols} FROM {table} WITH NO DATA"
+        )
+        copy_rows(cursor, metadata, _STAGING_TABLE)
+        cursor.execute(
+            f"INSERT INTO {table}({cols}) SELECT {cols} FROM {_STAGING_TABLE}"
+            + _on_conflict(metadata, key)
+        )
+        cursor.execute(f"DROP TABLE {_STAGING_TABLE}")
+    else:
+        copy_rows(cursor, metadata, table)
+
+
+def copy_rows(cursor, metadata: pd.DataFrame, table: str):
+    """Streams `metadata` into `table` as CSV with `COPY ... FROM STDIN`, within the open
+    transaction of `cursor` (the caller commits).
+
+    Parameters
+    ----------
+    cursor
+        A psycopg2 cursor.
+    metadata : pd.DataFrame
+        The intended data to be inserted, columns are quoted if they are not already.
+    table : str
+        The specific table you wish to insert metrics into.
+    """
+    metadata = _whole_numbers_as_integers(_quote_columns(metadata))
+    cols = ",".join(list(metadata.columns))
+
+    # Missing values are written as empty fields, which COPY reads as NULL
+    buffer = io.StringIO()
+    metadata.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.copy_expert(
+        "COPY %s(%s) FROM STDIN WITH (FORMAT csv)" % (table, cols), buffer
+    )
+
+
+def _whole_numbers_as_integers(metadata: pd.DataFrame) -> pd.DataFrame:
+    """Casts float columns holding only whole numbers and missing values to `Int64`. pandas
+    stores an integer column with missing values as floats, written as "3.0", which COPY
+    rejects for integer columns. Float columns take the whole numbers just as well.
+    """
+    whole = []
+    for column in metadata.select_dtypes("float").columns:
+        values = metadata[column]
+        present = values.dropna()
+        if (
+            len(present) < len(values)
+            and ((present % 1 == 0) & (present.abs() < 2**53)).all()
+        ):
+            whole.append(column)
+    if not whole:
+        return metadata
+    return metadata.astype({column: "Int64" for column in whole})
+
+
+def _mode_key(mode: str, key: Optional[Sequence[str]] = None) -> Sequence[str]:
+    """Checks an insert `mode` of `add_to_table` and returns the key it uses, `key` or the
+    default ("Experiment ID",) of "append" and "replace".
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown insert mode: {mode}")
+    if key is not None:
+        return key
+    if mode == "upsert":
+        # The Experiment ID alone is not unique in the metrics tables
+        raise ValueError(
+            "mode='upsert' needs the key of a unique index, e.g. "
+            "('Experiment ID', 'ObjectNumber') for the metrics tables"
+        )
+    return ("Experiment ID",)
+
+
+def _delete_keys(cursor, metadata: pd.DataFrame, table: str, key: Sequence[str]):
+    cols = ",".join(f'"{column}"' for column in key)
+    keys = [
+        tuple(row)
+        for row in metadata[cols.split(",")].drop_duplicates().to_numpy(object)
+    ]
+    if keys:
+        extras.execute_values(
+            cursor,
+            f"DELETE FROM {table} WHERE ({cols}) IN (VALUES %s)",
+            keys,
+            page_size=len(keys),
+        )
+
+
+def _on_conflict(metadata: pd.DataFrame, key: Sequence[str]) -> str:
+    target = [f'"{column}"' for column in key]
+    updates = [
+        f"{column} = EXCLUDED.{column}"
+        for column in metadata.columns
+        if column not in target
+    ]
+    action = "DO UPDATE SET " + ", ".join(updates) if updates else "DO NOTHING"
+    return f" ON CONFLICT ({','.join(target)}) {action}"
+
+
+def _quote_columns(metadata: pd.DataFrame) -> pd.DataFrame:
+    if all(str(column).startswith('"') for column in metadata.columns):
+        return metadata
+    metadata = metadata.add_suffix('"')
+    return metadata.add_prefix('"')
+
+
+def get_table_columns(table: str, conn=None) -> Dict[str, str]:
+    """Returns the columns of `table` and their postgres data types, in table order. The
+    columns are read from information_schema once per table and process.
+
+    Parameters
+    ----------
+    table : str
+        Name of the table, quoted as in the environment.
+    conn
+        A psycopg2 database connection. If None a connection is borrowed from the shared pool.
+
+    Returns
+    -------
+    Dict[str, str]
+        Data type of every column keyed by column name, empty if the table does not exist.
+    """
+    if table not in _table_columns:
+        with borrow_connection(conn) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT column_name, data_type FROM information_schema.columns "
+                    "WHERE table_name = %s ORDER BY ordinal_position",
+                    (table.strip('"'),),
+                )
+                columns = dict(cursor.fetchall())
+        if not columns:
+            return columns
+        _table_columns[table] = columns
+    return _table_columns[table]
 
 
 def get_report_data(
     date: date,
-    conn,
+    conn=None,
     env_vars: str = f"/home/{pwd.getpwuid(os.getuid())[0]}/.env",
+    end_date: Optional[date] = None,
+    statuses: Optional[Sequence[str]] = None,
+    chunk_size: int = 10000,
 ):
-    """A function to get celigo status data for a given day.
+    """A function to get celigo status data for a given day, or for every day from `date`
+    to `end_date`. Only the reported columns are selected and rows are streamed from a
+    server side cursor, `chunk_size` rows at a time.
 
     Parameters
     ----------
     date : date
-        The specific date to produce a report about.
+        The specific date to produce a report about, or the first day of the report.
     conn
-        A psycopg2 database connection.
+        A psycopg2 database connection. If None a connection is borrowed from the shared pool.
+    env_vars: str
+        Path to a .env file containing database credentials. Default is set to users home directory.
+    end_date : Optional[date]
+        Last day (inclusive) of a report over several days, e.g. a weekly or monthly report.
+        The report then also has a "Date" column.
+    statuses : Optional[Sequence[str]]
+        Only report runs with one of these statuses, e.g. ["Failed"]. Default is every status.
+    chunk_size : int
+        Number of rows fetched from the database at a time. Default is 10000.
 
-    table : str
-        The specific table you wish to insert metrics into. The table name
-        needs to be within quotes inside the string in order to be processed
-        correctly by the database.
+    Returns
+    -------
+    Tuple[str, pd.DataFrame]
+        A filename for the report and the report, with the columns "Name", "Status", "ID"
+        and "Error".
     """
+    import pandas as pd
+
     load_dotenv(env_vars)
 
-    cursor = conn.cursor()
-    query = f'select * from {os.getenv("CELIGO_STATUS_DB")} where "Date" = %s'
-    cursor.execute(query, (str(date),))
-    records = cursor.fetchall()
-    data = []
-    for row in records:
-        info = {
-            "Name": row[1],
-            "Status": row[2],
-            "ID": row[5],
-            "Error": row[6],
-        }
-        data.append(info)
-
-    daily_run_data = pd.DataFrame(data)
-    filename = f"celigo_daily_log {date}.csv"
-
-    return filename, daily_run_data
+    columns = {
+        "File Name": "Name",
+        "Status": "Status",
+        "FMS ID": "ID",
+        "Error Code": "Error",
+    }
+    if end_date is not None:
+        columns["Date"] = "Date"
+    query = "SELECT %s FROM %s WHERE " % (
+        ", ".join(f'"{column}"' for column in columns),
+        os.getenv("CELIGO_STATUS_DB"),
+    )
+
+    if end_date is None:
+        query += '"Date" = %s'
+        params: List[object] = [str(date)]
+        filename = f"celigo_daily_log {date}.csv"
+    else:
+        query += '"Date" BETWEEN %s AND %s'
+        params = [str(date), str(end_date)]
+        filename = f"celigo_log {date} to {end_date}.csv"
+    if statuses is not None:
+        query += ' AND "Status" = ANY(%s)'
+        params.append(list(statuses))
+    if end_date is not None:
+        query += ' ORDER BY "Date", "Time"'
+
+    chunks = []
+    with borrow_connection(conn) as conn:
+        with conn.cursor(name="celigo_report_data") as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                chunks.append(pd.DataFrame(rows, columns=list(columns.values())))
+
+    if chunks:
+        report_data = pd.concat(chunks, ignore_index=True)
+    else:
+        report_data = pd.DataFrame(columns=list(columns.values()))
+
+    return filename, report_data
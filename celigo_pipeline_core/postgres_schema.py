@@ -0,0 +1,246 @@
+from datetime import date
+import hashlib
+import os
+import pwd
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+from dotenv import load_dotenv
+
+from .postgres_db_functions import (
+    borrow_connection,
+)
+
+# Columns and types of the status table, one row per processed image and day
+STATUS_COLUMNS = (
+    ("id", "serial"),
+    ("File Name", "text"),
+    ("Status", "text"),
+    ("Date", "date"),
+    ("Time", "time"),
+    ("FMS ID", "text"),
+    ("Error Code", "text"),
+)
+
+# Identifies a status row. A retry or resume on the same day replaces the row of the image
+STATUS_KEY = ("File Name", "Date")
+
+# Indexed columns of every table, keyed by the environment variable naming the table. Metrics
+# are looked up by Experiment ID (FMS ID updates) and by plate and well, statuses by day and file
+INDEXES: Dict[str, List[Tuple[str, ...]]] = {
+    "CELIGO_METRICS_DB": [("Experiment ID",), ("barcode", "Metadata_Well")],
+    "CELIGO_6_WELL_METRICS_DB": [("Experiment ID",), ("barcode", "Metadata_Well")],
+    "CELIGO_STATUS_DB": [("Date",), ("File Name",)],
+}
+
+# Longest identifier postgres keeps without truncating it
+_MAX_IDENTIFIER = 63
+
+
+def create_schema(
+    conn=None,
+    env_vars: str = f"/home/{pwd.getpwuid(os.getuid())[0]}/.env",
+    partition_status_by_date: bool = False,
+    partition_months: int = 12,
+):
+    """Creates the status table if it does not exist and the indexes of the metrics, 6 well
+    metrics and status tables (see `INDEXES`). Safe to run repeatedly, existing tables and
+    indexes are left untouched.
+
+    The metrics tables are not created here, their columns are defined by the Cell Profiler
+    pipelines. Use `verify_schema` to check that they exist.
+
+    Parameters
+    ----------
+    conn
+        A psycopg2 database connection. If None a connection is borrowed from the shared pool.
+    env_vars: str
+        Path to a .env file containing the table names. Default is set to users home directory.
+    partition_status_by_date: bool
+        If True a newly created status table is partitioned by month on "Date", with partitions
+        for `partition_months` months from the current month on and a default partition for any
+        other day. Has no effect on an existing status table.
+    partition_months: int
+        Number of monthly partitions created with `partition_status_by_date`. Default is 12.
+    """
+    load_dotenv(env_vars)
+    tables = _tables()
+
+    with borrow_connection(conn) as conn:
+        with conn.cursor() as cursor:
+            status_table = tables.get("CELIGO_STATUS_DB")
+            if status_table is not None and not _table_exists(cursor, status_table):
+                columns = ", ".join(
+                    f'"{column}" {column_type}'
+                    for column, column_type in STATUS_COLUMNS
+                )
+                if partition_status_by_date:
+                    cursor.execute(
+                        f'CREATE TABLE {status_table} ({columns}) PARTITION BY RANGE ("Date")'
+                    )
+                    _create_month_partitions(
+                        cursor, status_table, date.today(), partition_months
+                    )
+                else:
+                    cursor.execute(f"CREATE TABLE {status_table} ({columns})")
+
+            for variable, table in tables.items():
+                if not _table_exists(cursor, table):
+                    print(f"Error: table {table} ({variable}) does not exist")
+                    continue
+                for indexed in INDEXES[variable]:
+                    cursor.execute(
+                        "CREATE INDEX IF NOT EXISTS %s ON %s (%s)"
+                        % (
+                            _index_name(table, indexed),
+                            table,
+                            ", ".join(f'"{column}"' for column in indexed),
+                        )
+                    )
+        conn.commit()
+
+
+def create_date_partitions(
+    table: str,
+    start: date,
+    months: int,
+    conn=None,
+):
+    """Adds monthly partitions to a status table created with `partition_status_by_date`,
+    ahead of the months they hold (a month whose days are already in the default partition
+    cannot get its own partition).
+
+    Parameters
+    ----------
+    table: str
+        Name of the partitioned table, quoted as in the environment.
+    start: date
+        Day in the first month to add a partition for.
+    months: int
+        Number of months to add partitions for. Existing partitions are skipped.
+    conn
+        A psycopg2 database connection. If None a connection is borrowed from the shared pool.
+    """
+    with borrow_connection(conn) as conn:
+        with conn.cursor() as cursor:
+            _create_month_partitions(cursor, table, start, months, default=False)
+        conn.commit()
+
+
+def create_unique_key(
+    table: str,
+    columns: Tuple[str, ...],
+    conn=None,
+):
+    """Creates a unique index on `columns` of `table`, the conflict target `add_to_table`
+    needs for `mode="upsert"`. Fails while the table holds duplicate keys.
+
+    Parameters
+    ----------
+    table: str
+        Name of the table, quoted as in the environment.
+    columns: Tuple[str, ...]
+        Columns of the natural key, e.g. ("Experiment ID", "ObjectNumber").
+    conn
+        A psycopg2 database connection. If None a connection is borrowed from the shared pool.
+    """
+    with borrow_connection(conn) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s)"
+                % (
+                    _identifier(table, _index_suffix(columns, "key")),
+                    table,
+                    ", ".join(f'"{column}"' for column in columns),
+                )
+            )
+        conn.commit()
+
+
+def verify_schema(
+    conn=None,
+    env_vars: str = f"/home/{pwd.getpwuid(os.getuid())[0]}/.env",
+) -> List[str]:
+    """Checks that the metrics, 6 well metrics and status tables and their indexes exist.
+
+    Parameters
+    ----------
+    conn
+        A psycopg2 database connection. If None a connection is borrowed from the shared pool.
+    env_vars: str
+        Path to a .env file containing the table names. Default is set to users home directory.
+
+    Returns
+    -------
+    List[str]
+        A description of every missing table and index, empty if the schema is complete.
+    """
+    load_dotenv(env_vars)
+
+    problems = []
+    with borrow_connection(conn) as conn:
+        with conn.cursor() as cursor:
+            for variable, table in _tables().items():
+                if not _table_exists(cursor, table):
+                    problems.append(f"Table {table} ({variable}) does not exist")
+                    continue
+                for columns in INDEXES[variable]:
+                    index = _index_name(table, columns)
+                    cursor.execute("SELECT to_regclass(%s)", (index,))
+                    if cursor.fetchone()[0] is None:
+                        problems.append(
+                            f"Index {index} on {table} ({', '.join(columns)}) does not exist"
+                        )
+        conn.rollback()
+    return problems
+
+
+def _tables() -> Dict[str, str]:
+    tables = {variable: os.getenv(variable) for variable in INDEXES}
+    return {variable: table for variable, table in tables.items() if table is not None}
+
+
+def _table_exists(cursor, table: str) -> bool:
+    cursor.execute("SELECT to_regclass(%s)", (table,))
+    return cursor.fetchone()[0] is not None
+
+
+def _identifier(table: str, suffix: str) -> str:
+    """Returns a quoted identifier made of the unquoted `table` name and `suffix`, shortened
+    with a hash when it is longer than postgres allows."""
+    name = table.strip('"') + "_" + suffix
+    if len(name) > _MAX_IDENTIFIER:
+        digest = hashlib.sha1(name.encode()).hexdigest()[:8]
+        name = f"{name[:_MAX_IDENTIFIER - 9]}_{digest}"
+    return f'"{name}"'
+
+
+def _index_name(table: str, columns: Tuple[str, ...]) -> str:
+    return _identifier(table, _index_suffix(columns, "idx"))
+
+
+def _index_suffix(columns: Tuple[str, ...], kind: str) -> str:
+    return "_".join(column.lower().replace(" ", "_") for column in columns) + "_" + kind
+
+
+def _create_month_partitions(
+    cursor, table: str, start: date, months: int, default: bool = True
+):
+    month = date(start.year, start.month, 1)
+    for _ in range(months):
+        following = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)"
+            % (_identifier(table, month.strftime("%Y_%m")), table),
+            (month, following),
+        )
+        month = following
+
+    if default:
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s DEFAULT"
+            % (_identifier(table, "default"), table)
+        )
@@ -0,0 +1,65 @@
+import sys
+import types
+
+import pytest
+
+from celigo_pipeline_core.celigo_metadata import (
+    clear_metadata_cache,
+    get_metadata,
+    get_metadata_batch,
+)
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    """Replaces `CeligoUploader` and returns the paths it parsed, in order."""
+    parsed = []
+
+    class CeligoUploader:
+        def __init__(self, path, file_type):
+            parsed.append(str(path))
+            if "bad" in path.name:
+                raise ValueError(f"Can't parse {path.name}")
+            self.path = path
+
+    module = types.ModuleType("aics_pipeline_uploaders")
+    module.CeligoUploader = CeligoUploader
+    monkeypatch.setitem(sys.modules, "aics_pipeline_uploaders", module)
+
+    clear_metadata_cache()
+    yield parsed
+    clear_metadata_cache()
+
+
+def test_parsed_once(parsed):
+    first = get_metadata("/raw/plate_A1.tiff")
+    assert get_metadata("/raw/plate_A1.tiff") is first
+    assert parsed == ["/raw/plate_A1.tiff"]
+
+
+def test_failures_not_cached(parsed):
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            get_metadata("/raw/bad.tiff")
+    assert parsed == ["/raw/bad.tiff", "/raw/bad.tiff"]
+
+
+def test_clear(parsed):
+    get_metadata("/raw/plate_A1.tiff")
+    clear_metadata_cache()
+    get_metadata("/raw/plate_A1.tiff")
+    assert len(parsed) == 2
+
+
+def test_batch(parsed):
+    paths = ["/raw/plate_A1.tiff", "/raw/bad.tiff", "/raw/plate_A1.tiff"]
+    results = get_metadata_batch(paths, max_workers=2)
+
+    # Listed twice, parsed once
+    assert sorted(parsed) == ["/raw/bad.tiff", "/raw/plate_A1.tiff"]
+    assert list(results) == ["/raw/plate_A1.tiff", "/raw/bad.tiff"]
+    assert isinstance(results["/raw/bad.tiff"], ValueError)
+
+    # Cached for `get_metadata`
+    assert get_metadata("/raw/plate_A1.tiff") is results["/raw/plate_A1.tiff"]
+    assert len(parsed) == 2
@@ -0,0 +1,53 @@
+import pandas as pd
+import pytest
+
+from celigo_pipeline_core.celigo_metrics_io import (
+    read_metrics_csv,
+)
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / "ColonyDATA.csv"
+    path.write_text(
+        "ImageNumber,ObjectNumber,Area,Metadata_Well,Unused\n"
+        "1,1,10.5,A1,x\n"
+        "1,2,,A1,y\n"
+    )
+    return path
+
+
+def test_reads_table_columns(csv_path):
+    metrics = read_metrics_csv(
+        csv_path,
+        {
+            "ObjectNumber": "integer",
+            "Area": "double precision",
+            "Metadata_Well": "text",
+        },
+        keep=["ImageNumber"],
+        exclude="Metadata",
+    )
+
+    # Only the table's columns and `keep`, in file order, without excluded ones
+    assert list(metrics.columns) == ["ImageNumber", "ObjectNumber", "Area"]
+    assert metrics["ObjectNumber"].dtype == "Int64"
+    assert metrics["Area"].dtype == "float64"
+    assert pd.isna(metrics["Area"][1])
+
+
+def test_reads_every_column_without_table(csv_path):
+    metrics = read_metrics_csv(csv_path)
+    assert list(metrics.columns) == [
+        "ImageNumber",
+        "ObjectNumber",
+        "Area",
+        "Metadata_Well",
+        "Unused",
+    ]
+
+
+def test_falls_back_to_inference(csv_path):
+    # "Unused" holds text, so the declared integer type can't be parsed
+    metrics = read_metrics_csv(csv_path, {"Unused": "integer"})
+    assert list(metrics["Unused"]) == ["x", "y"]
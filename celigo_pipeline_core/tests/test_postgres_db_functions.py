@@ -0,0 +1,133 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from celigo_pipeline_core import (
+    postgres_db_functions,
+)
+from celigo_pipeline_core.postgres_db_functions import (
+    add_to_table,
+)
+
+
+class FakeCursor:
+    def __init__(self, statements):
+        self.statements = statements
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+
+    def copy_expert(self, query, buffer):
+        self.statements.append((query, buffer.read()))
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self.statements)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    conn = FakeConnection()
+
+    def execute_values(cursor, query, rows, page_size=100):
+        cursor.statements.append((query, list(rows)))
+
+    monkeypatch.setattr(postgres_db_functions.extras, "execute_values", execute_values)
+    return conn
+
+
+@pytest.fixture
+def metrics():
+    return pd.DataFrame(
+        {
+            "Experiment ID": ["a.tiff", "a.tiff"],
+            "ObjectNumber": [1, 2],
+            "Area": [10.5, 20.0],
+        }
+    )
+
+
+def test_append(conn, metrics):
+    add_to_table(conn, metrics, '"metrics"')
+
+    assert conn.statements == [
+        (
+            'COPY "metrics"("Experiment ID","ObjectNumber","Area") FROM STDIN WITH (FORMAT csv)',
+            "a.tiff,1,10.5\na.tiff,2,20.0\n",
+        )
+    ]
+    assert conn.commits == 1
+
+
+def test_replace(conn, metrics):
+    add_to_table(conn, metrics, '"metrics"', mode="replace")
+
+    delete, copy = conn.statements
+    assert delete == (
+        'DELETE FROM "metrics" WHERE ("Experiment ID") IN (VALUES %s)',
+        [("a.tiff",)],
+    )
+    assert copy[0].startswith('COPY "metrics"(')
+
+
+def test_upsert(conn, metrics):
+    add_to_table(
+        conn, metrics, '"metrics"', mode="upsert", key=("Experiment ID", "ObjectNumber")
+    )
+
+    cols = '"Experiment ID","ObjectNumber","Area"'
+    create, copy, insert, drop = conn.statements
+    assert create == (
+        'CREATE TEMP TABLE "celigo_upsert_staging" AS '
+        f'SELECT {cols} FROM "metrics" WITH NO DATA'
+    )
+    assert copy[0].startswith('COPY "celigo_upsert_staging"(')
+    assert insert == (
+        f'INSERT INTO "metrics"({cols}) SELECT {cols} FROM "celigo_upsert_staging"'
+        ' ON CONFLICT ("Experiment ID","ObjectNumber") DO UPDATE SET "Area" = EXCLUDED."Area"'
+    )
+    assert drop == 'DROP TABLE "celigo_upsert_staging"'
+
+
+def test_upsert_needs_key(conn, metrics):
+    with pytest.raises(ValueError):
+        add_to_table(conn, metrics, '"metrics"', mode="upsert")
+    assert conn.statements == []
+
+
+def test_unknown_mode(conn, metrics):
+    with pytest.raises(ValueError):
+        add_to_table(conn, metrics, '"metrics"', mode="merge")
+
+
+def test_copy_writes_nullable_integers(conn):
+    rows = pd.DataFrame({"Count": [3, np.nan], "Area": [1.5, np.nan]})
+    add_to_table(conn, rows, '"metrics"')
+
+    ((_, csv),) = conn.statements
+    assert list(pd.read_csv(io.StringIO(csv), header=None, dtype=str).iloc[0]) == [
+        "3",
+        "1.5",
+    ]
@@ -0,0 +1,71 @@
+from pathlib import Path
+
+import pytest
+
+from celigo_pipeline_core.celigo_run_state import (
+    STAGES,
+    RunStateStore,
+)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = RunStateStore(tmp_path / "state.db")
+    yield store
+    store.close()
+
+
+def test_unknown_image(store):
+    assert store.get("/raw/unknown.tiff") is None
+    assert not RunStateStore.reached(None, "created")
+
+
+def test_stage_transitions(store):
+    raw_image = Path("/raw/image.tiff")
+    store.update(raw_image, stage="created", status="Running")
+    store.update(raw_image, stage="submitted", job_IDs=[1, 2, 3])
+    store.update(raw_image, stage="processed")
+
+    record = store.get(raw_image)
+    assert record["stage"] == "processed"
+    assert record["status"] == "Running"
+    assert record["job_IDs"] == [1, 2, 3]
+
+    assert RunStateStore.reached(record, "created")
+    assert RunStateStore.reached(record, "processed")
+    assert not RunStateStore.reached(record, "metrics")
+    assert not RunStateStore.reached({"stage": None}, STAGES[0])
+
+
+def test_fields_round_trip(store):
+    store.update(
+        "/raw/image.tiff",
+        cellprofiler_output_file_paths=[Path("/work/ColonyDATA.csv")],
+        fms_IDs={"RawCeligoFMSId": "abc"},
+        metrics_index="image.tiff",
+    )
+
+    record = store.get("/raw/image.tiff")
+    assert record["cellprofiler_output_file_paths"] == ["/work/ColonyDATA.csv"]
+    assert record["fms_IDs"] == {"RawCeligoFMSId": "abc"}
+    assert record["metrics_index"] == "image.tiff"
+    assert record["started"] is not None
+
+
+def test_incomplete(store):
+    store.update("/raw/a.tiff", stage="uploaded")
+    store.update("/raw/b.tiff", stage="complete")
+    store.update("/raw/c.tiff", stage="created")
+
+    incomplete = [record["raw_image_path"] for record in store.incomplete()]
+    assert incomplete == ["/raw/a.tiff", "/raw/c.tiff"]
+
+
+def test_persists(tmp_path):
+    store = RunStateStore(tmp_path / "state.db")
+    store.update("/raw/image.tiff", stage="metrics")
+    store.close()
+
+    store = RunStateStore(tmp_path / "state.db")
+    assert store.get("/raw/image.tiff")["stage"] == "metrics"
+    store.close()
@@ -0,0 +1,43 @@
+from celigo_pipeline_core.celigo_orchestration import (
+    _accounting_states,
+    _parse_job_states,
+    _queue_states,
+)
+
+
+def test_parse_job_states_squeue():
+    states = _parse_job_states("123 RUNNING\n124 PENDING\n", " ")
+    assert states == {"123": "RUNNING", "124": "PENDING"}
+
+
+def test_parse_job_states_array_tasks():
+    states = _parse_job_states("200_0 COMPLETED\n200_1 RUNNING\n", " ")
+
+    # Every task is listed on its own, the array under its first task's state
+    assert states["200_0"] == "COMPLETED"
+    assert states["200_1"] == "RUNNING"
+    assert states["200"] == "COMPLETED"
+
+
+def test_parse_job_states_sacct():
+    states = _parse_job_states("300|CANCELLED by 1234\n301|TIMEOUT\n", "|")
+    assert states == {"300": "CANCELLED", "301": "TIMEOUT"}
+
+
+def test_parse_job_states_skips_other_lines():
+    assert _parse_job_states("\nJOBID STATE\n", "|") == {}
+
+
+def test_queue_states_unknown_jobs():
+    # squeue fails once none of the jobs are queued anymore
+    assert (
+        _queue_states(1, b"", b"slurm_load_jobs error: Invalid job id specified") == {}
+    )
+
+
+def test_queue_states_unreachable():
+    assert _queue_states(1, b"", b"Unable to contact slurm controller") is None
+
+
+def test_accounting_states_unavailable():
+    assert _accounting_states(1, b"300|FAILED\n") == {}
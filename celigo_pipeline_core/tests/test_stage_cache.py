@@ -0,0 +1,116 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from celigo_pipeline_core.celigo_stage_cache import (
+    StageCache,
+)
+
+
+class FakeImage:
+    def __init__(self, raw_image_path: Path, pipeline_path: Path):
+        self.raw_image_path = raw_image_path
+        self.pipeline_path = pipeline_path
+
+    def stage_recipes(self):
+        return [
+            [self.pipeline_path, "resize_cellprofiler_template.j2"],
+            ["ilastik_template.j2"],
+            [self.pipeline_path, "cellprofiler_template.j2"],
+        ]
+
+
+@pytest.fixture
+def image(tmp_path):
+    raw_image_path = tmp_path / "raw" / "plate_A1.tiff"
+    raw_image_path.parent.mkdir()
+    raw_image_path.write_bytes(b"raw image")
+    pipeline_path = tmp_path / "pipeline.cppipe"
+    pipeline_path.write_text("pipeline")
+    return FakeImage(raw_image_path, pipeline_path)
+
+
+def test_stage_keys(tmp_path, image):
+    cache = StageCache(tmp_path / "cache")
+    keys = cache.stage_keys(image)
+
+    assert len(set(keys)) == 3
+    assert cache.stage_keys(image) == keys
+
+
+def test_stage_keys_ignore_file_name(tmp_path, image):
+    cache = StageCache(tmp_path / "cache")
+    duplicate_path = tmp_path / "raw" / "plate_A1_rescan.tiff"
+    duplicate_path.write_bytes(b"raw image")
+
+    duplicate = FakeImage(duplicate_path, image.pipeline_path)
+    assert cache.stage_keys(duplicate) == cache.stage_keys(image)
+
+
+def test_stage_keys_chain(tmp_path, image):
+    cache = StageCache(tmp_path / "cache")
+    keys = cache.stage_keys(image)
+
+    # The pipeline determines downsampling, so every later stage changes with it
+    image.pipeline_path.write_text("changed pipeline")
+    changed = cache.stage_keys(image)
+    assert all(key != changed_key for key, changed_key in zip(keys, changed))
+
+
+def test_store_and_restore(tmp_path):
+    cache = StageCache(tmp_path / "cache")
+    outputs = [tmp_path / "work" / "a.csv", tmp_path / "work" / "b.png"]
+    outputs[0].parent.mkdir()
+    outputs[0].write_text("metrics")
+    outputs[1].write_bytes(b"outlines")
+    cache.store("key", outputs)
+
+    # Restored by position, under other names
+    restored = [tmp_path / "other" / "c.csv", tmp_path / "other" / "d.png"]
+    assert cache.restore("key", restored)
+    assert restored[0].read_text() == "metrics"
+    assert restored[1].read_bytes() == b"outlines"
+
+
+def test_restore_missing(tmp_path):
+    cache = StageCache(tmp_path / "cache")
+    assert not cache.restore("missing", [tmp_path / "out.csv"])
+    assert not (tmp_path / "out.csv").exists()
+
+
+def test_restore_incomplete_entry(tmp_path):
+    cache = StageCache(tmp_path / "cache")
+    output = tmp_path / "a.csv"
+    output.write_text("metrics")
+    cache.store("key", [output])
+
+    # An entry holding fewer outputs than asked for leaves nothing behind
+    restored = [tmp_path / "other" / "a.csv", tmp_path / "other" / "b.csv"]
+    assert not cache.restore("key", restored)
+    assert not any(path.exists() for path in restored)
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = StageCache(tmp_path / "cache", max_size=10)
+    for index, key in enumerate(["old", "new"]):
+        output = tmp_path / f"{key}.bin"
+        output.write_bytes(b"x" * 8)
+        cache.store(key, [output])
+        os.utime(cache.cache_dir / key, (index, index))
+
+    cache.evict()
+
+    assert sorted(entry.name for entry in cache.cache_dir.iterdir()) == ["new"]
+    assert cache.restore("new", [tmp_path / "restored.bin"])
+    assert not cache.restore("old", [tmp_path / "evicted.bin"])
+
+
+def test_evict_within_size(tmp_path):
+    cache = StageCache(tmp_path / "cache", max_size=100)
+    output = tmp_path / "a.bin"
+    output.write_bytes(b"x" * 8)
+    cache.store("key", [output])
+
+    cache.evict()
+    assert (cache.cache_dir / "key").exists()
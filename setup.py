@@ -41,13 +41,18 @@ dev_requirements = [
 
 requirements = ["aicsimageio[czi] ~= 4.4", "numpy ~= 1.21", "scikit-image ~= 0.18"]
 
+# Faster Cell Profiler output parsing
+arrow_requirements = ["pyarrow >= 7.0"]
+
 extra_requirements = {
     "setup": setup_requirements,
     "test": test_requirements,
     "dev": dev_requirements,
+    "arrow": arrow_requirements,
     "all": [
         *requirements,
         *dev_requirements,
+        *arrow_requirements,
     ],
 }
 
@@ -75,9 +80,8 @@ setup(
             "celigo_pipeline_cli={}.bin.celigo_pipeline_core_cli:main".format(
                 PACKAGE_NAME
             ),
-            "celigo_pipeline_directory={}.bin.run_dir_cli:main".format(
-                PACKAGE_NAME
-            ),
+            "celigo_pipeline_directory={}.bin.run_dir_cli:main".format(PACKAGE_NAME),
+            "celigo_pipeline_resume={}.bin.resume_cli:main".format(PACKAGE_NAME),
         ]
     },
     keywords="celigo_pipeline_core",